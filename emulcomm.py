@@ -33,6 +33,9 @@ socket.setattr = setattr
 import threading
 threading.hasattr = hasattr    # Fix for #1039
 
+# to catch thread.error if an eventpool thread can't be started
+import thread
+
 # to force destruction of old sockets
 import gc
 
@@ -45,26 +48,53 @@ import nonportable
 # So I can print a clean traceback when an error happens
 import tracebackrepy
 
+# the threads that run the user's events
+import eventpool
+
 # accounting
 import nanny
 
+# for the limits that change how messages are delivered and the message queue
+# counters
+import nanny_resource_limits
+
+# recvmess handles can queue their messages
+import collections
+
 # give me uniqueIDs for the comminfo table
 import idhelper
 
 # for sleep
 import time 
 
+# The SocketSelector is woken up through a pipe
+import os
+
+# Used to make the wakeup pipe non-blocking.   This will fail on Windows, but
+# select can't wait on a pipe there anyways.
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 # Armon: Used for decoding the error messages
 import errno
 
 # Armon: Used for getting the constant IP values for resolving our external IP
 import repy_constants 
 
-# The architecture is that I have a thread which "polls" all of the sockets
-# that are being listened on using select.  If a connection
-# oriented socket has a connection pending, or a message-based socket has a
-# message pending, and there are enough events it calls the appropriate
-# function.
+# Used to read all of the messages waiting on a recvmess socket.   Windows 
+# doesn't have this, there only one message is read at a time.
+try:
+  MSG_DONTWAIT = socket.MSG_DONTWAIT
+except AttributeError:
+  MSG_DONTWAIT = None
+
+# The architecture is that I have a thread which waits on all of the sockets
+# that are being listened on using epoll (select where epoll isn't 
+# available).  If a connection oriented socket has a connection pending, or 
+# a message-based socket has a message pending, and there are enough events
+# it calls the appropriate function.
 
 
 
@@ -73,8 +103,178 @@ import repy_constants
 # Table of communications structures:
 # {'type':'UDP','localip':ip, 'localport':port,'function':func,'socket':s, outgoing:True, 'closing_lock':lockobj}
 # {'type':'TCP','remotehost':None, 'remoteport':None,'localip':None,'localport':None, 'socket':s, 'function':func, outgoing:False, 'closing_lock':lockobj}
+#
+# The table adds 'loopback' to each entry, which is True if the remote host 
+# (or the local IP if there is no remote host) is a loopback address.   This 
+# is used for accounting.
+
+# A dictionary of commhandle -> entry which also keeps indexes so that the
+# entries can be found by socket, by local ip / port and by TCP connection 
+# without scanning the table.   Entries are added with [] and removed with 
+# del.   The remotehost and remoteport must be changed with set_remote so the
+# indexes are updated.
+#
+# The same entry may be in the table under two handles when recvmess or
+# waitforconn replace a handle.
+class CommInfoTable(dict):
+
+  def __init__(self):
+    dict.__init__(self)
+
+    # protects the indexes (and adding / removing entries)
+    self.indexlock = threading.Lock()
+
+    # Each index maps a key to a dictionary of {commhandle:True}
+    # file descriptor of the socket
+    self.byfd = {}
+    # (type, localip, localport, outgoing)
+    self.bytipo = {}
+    # (localip, localport, remotehost, remoteport) for outgoing TCP sockets
+    self.byconnection = {}
+
+    # commhandle -> list of (index, key) so the handle can be removed
+    self.handlekeys = {}
+
+    # the number of handles that aren't outgoing
+    self.listeningcount = 0
+
+
+  def __setitem__(self, commhandle, entry):
+    self.indexlock.acquire()
+    try:
+      if commhandle in self:
+        self._remove_keys(commhandle)
+      dict.__setitem__(self, commhandle, entry)
+      self._add_keys(commhandle)
+    finally:
+      self.indexlock.release()
+
+
+  def __delitem__(self, commhandle):
+    self.indexlock.acquire()
+    try:
+      if commhandle not in self:
+        raise KeyError, commhandle
+      self._remove_keys(commhandle)
+      dict.__delitem__(self, commhandle)
+    finally:
+      self.indexlock.release()
+
+
+  # Set the remote host and port of an entry (after an outgoing connection
+  # is made)
+  def set_remote(self, commhandle, remotehost, remoteport):
+    self.indexlock.acquire()
+    try:
+      self._remove_keys(commhandle)
+      entry = self[commhandle]
+      entry['remotehost'] = remotehost
+      entry['remoteport'] = remoteport
+      self._add_keys(commhandle)
+    finally:
+      self.indexlock.release()
+
+
+  # Private.   Index a handle.   Call with the lock held
+  def _add_keys(self, commhandle):
+    entry = self[commhandle]
+
+    if 'remotehost' in entry and entry['remotehost']:
+      entry['loopback'] = is_loopback(entry['remotehost'])
+    elif entry['localip']:
+      entry['loopback'] = is_loopback(entry['localip'])
+    else:
+      entry['loopback'] = False
+
+    keylist = []
+    try:
+      keylist.append((self.byfd, entry['socket'].fileno()))
+    except socket.error:
+      # The socket is closed, it can't be found by descriptor
+      pass
+
+    keylist.append((self.bytipo, (entry['type'], entry['localip'], entry['localport'], entry['outgoing'])))
+
+    if entry['type'] == 'TCP' and entry['outgoing']:
+      keylist.append((self.byconnection, (entry['localip'], entry['localport'], entry['remotehost'], entry['remoteport'])))
+
+    for (index, key) in keylist:
+      if key not in index:
+        index[key] = {}
+      index[key][commhandle] = True
+
+    self.handlekeys[commhandle] = keylist
+
+    if not entry['outgoing']:
+      self.listeningcount = self.listeningcount + 1
+
+
+  # Private.   Remove a handle from the indexes.   Call with the lock held
+  def _remove_keys(self, commhandle):
+    for (index, key) in self.handlekeys[commhandle]:
+      del index[key][commhandle]
+      if not index[key]:
+        del index[key]
+    del self.handlekeys[commhandle]
+
+    if not self[commhandle]['outgoing']:
+      self.listeningcount = self.listeningcount - 1
+
+
+  # Private.   Returns the handles for a key as a list
+  def _lookup(self, index, key):
+    self.indexlock.acquire()
+    try:
+      if key not in index:
+        return []
+      return index[key].keys()
+    finally:
+      self.indexlock.release()
+
+
+  # Returns (entry, commhandle) for a socket object.   Raises KeyError if it
+  # isn't in the table
+  def find_socket(self, socketobject):
+    try:
+      fd = socketobject.fileno()
+    except socket.error:
+      raise KeyError, "Can't find commhandle"
+
+    for commhandle in self._lookup(self.byfd, fd):
+      try:
+        entry = self[commhandle]
+      except KeyError:
+        continue
+      # The descriptor may have been reused
+      if entry['socket'] is socketobject:
+        return entry, commhandle
+    raise KeyError, "Can't find commhandle"
+
+
+  # Returns a handle with the given type, local ip / port and outgoing flag
+  # or None
+  def find_tipo(self, socktype, ip, port, outgoing):
+    for commhandle in self._lookup(self.bytipo, (socktype, ip, port, outgoing)):
+      if commhandle in self:
+        return commhandle
+    return None
 
-comminfo = {}
+
+  # Returns the handle of the outgoing TCP connection or None
+  def find_connection(self, localip, localport, remoteip, remoteport):
+    for commhandle in self._lookup(self.byconnection, (localip, localport, remoteip, remoteport)):
+      if commhandle in self:
+        return commhandle
+    return None
+
+
+  # Returns True if there are sockets that aren't outgoing
+  def has_listening(self):
+    return self.listeningcount > 0
+
+
+
+comminfo = CommInfoTable()
 
 # If we have a preference for an IP/Interface this flag is set to True
 user_ip_interface_preferences = False
@@ -93,6 +293,11 @@ user_specified_ip_interface_list = []
 allowediplist = []
 cachelock = threading.Lock()  # This allows only a single simultaneous cache update
 
+# When the cache was last updated (from getruntime).   The cache is only 
+# updated again when it is older than repy_constants.IP_CACHE_TTL or, on 
+# Linux, when the kernel says an interface or address changed.
+ipcacheupdatetime = None
+
 
 # Determines if a specified IP address is allowed in the context of user settings
 def ip_is_allowed(ip):
@@ -132,6 +337,8 @@ def update_ip_cache():
   global user_specified_ip_interface_list
   global allow_nonspecified_ips
   
+  global ipcacheupdatetime
+  
   # If there is no preference, this is a no-op
   if not user_ip_interface_preferences:
     return
@@ -141,8 +348,25 @@ def update_ip_cache():
   
   # If there is any exception release the cachelock
   try:  
+    # This also starts listening for changes the first time
+    if nonportable.ostype == "Linux":
+      changed = nonportable.os_api.interface_addresses_changed()
+    else:
+      changed = None
+
+    # The cache is still good
+    if not changed and ipcacheupdatetime is not None and \
+        nonportable.getruntime() - ipcacheupdatetime < repy_constants.IP_CACHE_TTL:
+      return
+
     # Stores the IP's
     allowed_list = []
+
+    # Get the IPs of all of the interfaces at once if possible
+    try:
+      interface_addresses = nonportable.os_api.get_interface_addresses()
+    except:
+      interface_addresses = None
   
     # Iterate through the allowed list, handle each element
     for (is_ip_addr, value) in user_specified_ip_interface_list:
@@ -151,6 +375,11 @@ def update_ip_cache():
         unique_append(allowed_list, value)
     
       # Handle interfaces
+      elif interface_addresses is not None:
+        if value.strip() in interface_addresses:
+          for interface_ip in interface_addresses[value.strip()]:
+            unique_append(allowed_list, interface_ip)
+
       else:
         try:
           # Get the IP's associated with the NIC
@@ -181,6 +410,7 @@ def update_ip_cache():
   
     # Update the global cache
     allowediplist = bindable_list
+    ipcacheupdatetime = nonportable.getruntime()
   
   finally:      
     # Release the lock
@@ -426,23 +656,35 @@ selectorstarted = False
 
 # return the table entry for this socketobject
 def find_socket_entry(socketobject):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['socket'] is socketobject:
-      return comminfo[commhandle], commhandle
-  raise KeyError, "Can't find commhandle"
+  return comminfo.find_socket(socketobject)
+
 
 
 
+# Notified when an EventDeliverer finishes, so that wait_for_event doesn't
+# have to sleep long when all of the events are in use.   (Events used by 
+# other things, like timers, are noticed when the wait times out.)
+event_finished = threading.Condition()
 
 # wait until there is a free event
 def wait_for_event(eventname):
+  waitstart = None
   while True:
     try:
       nanny.tattle_add_item('events',eventname)
       break
     except Exception:
-      # They must be over their event limit.   I'll sleep and check later
-      time.sleep(.1)
+      # They must be over their event limit.   I'll wait and check later
+      if waitstart is None:
+        waitstart = nonportable.getruntime()
+      event_finished.acquire()
+      try:
+        event_finished.wait(.1)
+      finally:
+        event_finished.release()
+
+  if waitstart is not None:
+    nanny.tattle_throttle_wait('events', 1, nonportable.getruntime() - waitstart)
 
 
 
@@ -460,12 +702,8 @@ def should_selector_exit():
       tracebackrepy.handle_internalerror("SocketSelector is started when" +
           ' selectorstarted is False', 39)
 
-    # Got the lock...
-    for comm in comminfo.values():
-      # I'm listening and waiting so all is well
-      if not comm['outgoing']:
-        break
-    else:
+    # Got the lock...   If I'm listening and waiting then all is well
+    if not comminfo.has_listening():
       # there is no listening function so I should exit...
       selectorstarted = False
       # I'm exiting...
@@ -484,6 +722,11 @@ def should_selector_exit():
 # This function starts a thread to handle an entry with a readable socket in 
 # the comminfo table
 def start_event(entry, handle,eventhandle):
+  # stopcomm may have been called while we waited for the event
+  if 'stopped' in entry:
+    nanny.tattle_remove_item('events',eventhandle)
+    return
+
   if entry['type'] == 'UDP':
     # some sort of socket error, I'll assume they closed the socket or it's
     # not important
@@ -497,7 +740,7 @@ def start_event(entry, handle,eventhandle):
 
     # wait if we're over the limit
     if data:
-      if is_loopback(entry['localip']):
+      if entry['loopback']:
         nanny.tattle_quantity('looprecv',len(data))
       else:
        # We will charge looprecv for UDP from the net, (see #887 for details)
@@ -520,13 +763,46 @@ def start_event(entry, handle,eventhandle):
 
   # or it's a TCP accept event...
   elif entry['type'] == 'TCP':
+    accept_connections(entry, handle, eventhandle)
+
+
+  else:
+    # Should never get here
+    # This will cause the program to exit and log things if logging is
+    # enabled. -Brent
+    tracebackrepy.handle_internalerror("In start event, Unknown entry type '"+entry['type']+"'", 51)
+
+
+
+# Accepts the connections waiting on a waitforconn socket and starts an event
+# for each.   The caller has already gotten the event for the first one.   
+# This accepts until there are no more connections, but at most a backlog's
+# worth, so other sockets aren't starved.
+def accept_connections(entry, handle, eventhandle):
+  backlog = get_connection_backlog()
+
+  # On Linux, see if the accept queue filled up (in which case the kernel 
+  # drops new connections until it is drained)
+  queuefull = None
+  if nonportable.ostype == "Linux":
+    try:
+      (queued, maxqueued) = nonportable.os_api.get_accept_queue_length(entry['socket'])
+    except socket.error:
+      pass
+    else:
+      queuefull = queued > 0 and queued >= maxqueued
+
+  accepted = 0
+  while True:
     try:
       realsocket, addr = entry['socket'].accept()
     except socket.error:
-      # they closed in the meantime?
+      # no more connections (or they closed in the meantime?)
       nanny.tattle_remove_item('events',eventhandle)
-      return
+      break
     
+    accepted = accepted + 1
+
     # put this handle in the table
     newhandle = generate_commhandle()
     comminfo[newhandle] = {'type':'TCP','remotehost':addr[0], 'remoteport':addr[1],'localip':entry['localip'],'localport':entry['localport'],'socket':realsocket,'outgoing':True, 'closing_lock':threading.Lock()}
@@ -544,239 +820,618 @@ def start_event(entry, handle,eventhandle):
       # enabled. -Brent
       tracebackrepy.handle_internalerror("Can't start TCP EventDeliverer '"+str(e)+"'", 23)
 
+    if accepted >= backlog:
+      break
 
-  else:
-    # Should never get here
-    # This will cause the program to exit and log things if logging is
-    # enabled. -Brent
-    tracebackrepy.handle_internalerror("In start event, Unknown entry type '"+entry['type']+"'", 51)
+    # Get the event for the next connection, waiting if we're over the limit
+    eventhandle = idhelper.getuniqueid()
+    wait_for_event(eventhandle)
+    if entry['loopback']:
+      nanny.tattle_quantity('looprecv',0)
+    else:
+      nanny.tattle_quantity('netrecv',0)
 
+    if 'stopped' in entry:
+      nanny.tattle_remove_item('events',eventhandle)
+      break
 
+  # Without TCP_INFO, accepting a full backlog means the queue was full
+  if queuefull is None:
+    queuefull = accepted >= backlog
 
-# Armon: What is the maximum number of samples to perform per second?
-# This is to prevent excessive sampling if there is a bad socket and
-# select() returns before timing out
-MAX_SAMPLES_PER_SEC = 10
-TIME_BETWEEN_SAMPLES = 1.0 / MAX_SAMPLES_PER_SEC
+  nanny_resource_limits.count_accepted_connections(accepted, queuefull)
 
-# Check for sockets using select and fire up user event threads as needed.
-#
-# This class holds nearly all of the complexity in this module.   It's 
-# basically just a loop that gets pending sockets (using select) and then
-# fires up events that call user provided functions
-class SocketSelector(threading.Thread):
-  
-  def __init__(self):
-    threading.Thread.__init__(self, name="SocketSelector")
 
 
-  # Gets a list of all the sockets which are ready to have
-  # accept() called on them
-  def get_acceptable_sockets(self):
-    # get the list of socket objects we might have a pending request on
-    requestlist = []
-    for comm in comminfo.values():
-      if not comm['outgoing']:
-        requestlist.append(comm['socket'])
+# Private.   Returns the listen backlog for waitforconn sockets
+def get_connection_backlog():
+  try:
+    backlog = int(nanny_resource_limits.resource_limit('connbacklog'))
+  except KeyError:
+    # The restrictions weren't loaded
+    backlog = 0
 
-    # nothing to request.   We should loop back around and check if all 
-    # sockets have been closed
-    if requestlist == []:
-      return []
+  if backlog <= 0:
+    return repy_constants.CONN_BACKLOG_DEFAULT
+  return backlog
 
-    # Perform a select on these sockets
-    try:
-      # Call select
-      (acceptable, not_applic, has_excp) = select.select(requestlist,[],requestlist,0.5)
-    
-      # Add all the sockets with exceptions to the acceptable list
-      for sock in has_excp:
-        if sock not in acceptable:
-          acceptable.append(sock)
 
-      # Return the acceptable list
-      return acceptable
-    
-    # There was probably an exception on the socket level, check individually
-    except:
 
-      # Hold the ready sockets
-      readylist = []
+# Private.   Returns the receive / send buffer size for TCP sockets
+def get_connection_buffer():
+  try:
+    connbuffer = int(nanny_resource_limits.resource_limit('connbuffer'))
+  except KeyError:
+    # The restrictions weren't loaded
+    connbuffer = 0
 
-      # Check each requested socket
-      for socket in requestlist:
-        try:
-          (accept_will_block, write_will_block) = socket_state(socket, "r")
-          if not accept_will_block:
-            readylist.append(socket)
-        
-        # Ignore errors, probably the socket is closed.
-        except:
-          pass
+  if connbuffer <= 0:
+    return repy_constants.CONN_BUFFER_DEFAULT
+  return connbuffer
 
-      # Return the ready list
-      return readylist
 
 
+# Private.   Returns the length of the recvmess message queues, 0 if the 
+# messages aren't queued
+def get_message_queue_length():
+  try:
+    return int(nanny_resource_limits.resource_limit('messqueue'))
+  except KeyError:
+    # The restrictions weren't loaded
+    return 0
 
-  def run(self):
-    # Keep track of the last sample time
-    # updated when there are no ready sockets
-    last_sample = 0
 
-    while True:
 
-      # I'll stop myself only when there are no active threads to monitor
-      if should_selector_exit():
-        return
+# Private.   Returns the receive buffer size for recvmess sockets
+def get_message_receive_buffer():
+  try:
+    rcvbuf = int(nanny_resource_limits.resource_limit('messrcvbuf'))
+  except KeyError:
+    # The restrictions weren't loaded
+    rcvbuf = 0
 
-      # If the last sample with 0 ready sockets was less than TIME_BETWEEN_SAMPLES
-      # seconds ago, sleep a while. This is to prevent a tight loop from consuming
-      # CPU time doing nothing.
-      current_time = nonportable.getruntime()
-      time_diff = current_time - last_sample
-      if time_diff < TIME_BETWEEN_SAMPLES:
-        time.sleep(TIME_BETWEEN_SAMPLES - time_diff)
+  if rcvbuf <= 0:
+    return repy_constants.MESS_RCVBUF_DEFAULT
+  return rcvbuf
 
-      # Get all the ready sockets
-      readylist = self.get_acceptable_sockets()
 
-      # If there is nothing to do, potentially delay the next sample
-      if len(readylist) == 0:
-        last_sample = current_time
 
-      # go through the pending sockets, grab an event and then start a thread
-      # to handle the connection
-      for thisitem in readylist:
-        try: 
-          commtableentry,commhandle = find_socket_entry(thisitem)
-        except KeyError:
-          # let's skip this one, it's likely it was closed in the interim
-          continue
+# Reads the messages waiting on a recvmess socket into the handle's queue 
+# and starts an event to deliver them if one isn't running.   Messages that
+# don't fit in the queue are dropped.   This reads at most a queue's worth 
+# of messages, so other sockets aren't starved.
+def queue_messages(entry, maxlength):
+  received = []
+  while len(received) < maxlength:
+    try:
+      if MSG_DONTWAIT is None:
+        data, addr = entry['socket'].recvfrom(65535)
+      else:
+        data, addr = entry['socket'].recvfrom(65535, MSG_DONTWAIT)
+    except socket.error:
+      # no more messages (or they closed in the meantime)
+      break
 
-        # now it's time to get the event...   I'll loop until there is a free
-        # event
-        eventhandle = idhelper.getuniqueid()
-        wait_for_event(eventhandle)
+    if data:
+      received.append((data, addr))
 
-        # wait if already oversubscribed
-        if is_loopback(commtableentry['localip']):
-          nanny.tattle_quantity('looprecv',0)
-        else:
-          nanny.tattle_quantity('netrecv',0)
+    # Without MSG_DONTWAIT this would block once the socket is empty
+    if MSG_DONTWAIT is None:
+      break
 
-        # Now I can start a thread to run the user's code...
-        start_event(commtableentry,commhandle,eventhandle)
-      
+  startevent = False
+  queuedcount = 0
+  droppedcount = 0
 
+  entry['messqueuelock'].acquire()
+  try:
+    for item in received:
+      if len(entry['messqueue']) < maxlength:
+        entry['messqueue'].append(item)
+        queuedcount = queuedcount + 1
+      else:
+        droppedcount = droppedcount + 1
 
+    # Only one event delivers the messages for a handle
+    if entry['messqueue'] and not entry['messqueuerunning']:
+      entry['messqueuerunning'] = True
+      startevent = True
+  finally:
+    entry['messqueuelock'].release()
 
+  nanny_resource_limits.count_queued_messages(queuedcount, 0, droppedcount)
 
+  if not startevent:
+    return
 
+  # now it's time to get the event...   I'll loop until there is a free
+  # event
+  eventhandle = idhelper.getuniqueid()
+  wait_for_event(eventhandle)
 
+  # If stopcomm was called while we waited, deliver_queued_messages drops 
+  # the messages
+  try:
+    EventDeliverer(deliver_queued_messages, (entry,), eventhandle).start()
+  except Exception, e:
+    # This is an internal error I think...
+    tracebackrepy.handle_internalerror("Can't start queued UDP EventDeliverer '" + str(e)+"'", 29)
 
-# this gives an actual event to the user's code
-class EventDeliverer(threading.Thread):
-  func = None
-  args = None
-  eventid = None
 
-  def __init__(self, f, a,e):
-    self.func = f
-    self.args = a
-    self.eventid = e
 
-    # Initialize with a custom and unique thread name
-    threading.Thread.__init__(self,name=idhelper.get_new_thread_name(COMM_PREFIX))
+# Delivers the messages in a recvmess handle's queue, in the order they 
+# arrived, until the queue is empty.   This runs as an event.
+def deliver_queued_messages(entry):
+  while True:
+    # stopcomm or a new recvmess may have changed the handle
+    try:
+      currententry, handle = find_socket_entry(entry['socket'])
+    except KeyError:
+      currententry = None
 
-  def run(self):
+    entry['messqueuelock'].acquire()
     try:
-      self.func(*(self.args))
-    except:
-      # we probably should exit if they raise an exception in a thread...
-      tracebackrepy.handle_exception()
-      harshexit.harshexit(14)
+      # If the handle was stopped, the messages are dropped
+      if currententry is not entry or 'stopped' in entry:
+        droppedcount = len(entry['messqueue'])
+        entry['messqueue'].clear()
+        entry['messqueuerunning'] = False
+        nanny_resource_limits.count_queued_messages(-droppedcount, 0, droppedcount)
+        return
 
+      if not entry['messqueue']:
+        entry['messqueuerunning'] = False
+        return
+
+      data, addr = entry['messqueue'].popleft()
     finally:
-      # our event is going away...
-      nanny.tattle_remove_item('events',self.eventid)
-      
+      entry['messqueuelock'].release()
 
+    nanny_resource_limits.count_queued_messages(0, 1, 0)
 
+    # We will charge looprecv for UDP from the net, (see #887 for details)
+    nanny.tattle_quantity('looprecv',len(data))
 
+    entry['function'](addr[0], addr[1], data, handle)
 
-        
-#### used by other threads to interact with the SocketSelector...
 
 
-# private.   Check if the SocketSelector is running and start it if it isn't
-def check_selector():
-  global selectorstarted
+# Armon: What is the maximum number of samples to perform per second?
+# This is to prevent excessive sampling if there is a bad socket and
+# select() returns before timing out
+MAX_SAMPLES_PER_SEC = 10
+TIME_BETWEEN_SAMPLES = 1.0 / MAX_SAMPLES_PER_SEC
 
-  # acquire the lock. 
-  if selectorlock.acquire():
-    # If I've not started, then start me...
-    if not selectorstarted:
-      # wait until there is a free event...
-      wait_for_event("SocketSelector")
-      selectorstarted = True
-      SocketSelector().start()
+# Private.   Returns a (readfd, writefd) pipe that is non-blocking and isn't
+# inherited by processes we start.   This is used to wake up threads that are
+# waiting in select / poll.   Raises OSError if a pipe can't be created
+def create_wakeup_pipe():
+  (readfd, writefd) = os.pipe()
+  for fd in [readfd, writefd]:
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+  return (readfd, writefd)
 
-    # verify a thread with the name "SocketSelector" is running
-    for threadobj in threading.enumerate():
-      if threadobj.getName() == "SocketSelector":
-        # all is well
-        selectorlock.release()
-        return
-  
-    # this is bad.   The socketselector went away...
-    # This will cause the program to exit and log things if logging is
-    # enabled. -Brent
-    tracebackrepy.handle_internalerror("SocketSelector died", 59)
 
 
+# How long select waits when there is no wakeup pipe (on Windows).   Elsewhere
+# the SocketSelector blocks until a socket is ready or it is woken up.
+SELECT_TIMEOUT = 0.5
 
 
-# return the table entry for this type of socket, ip, port 
-def find_tip_entry(socktype, ip, port):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port:
-      return comminfo[commhandle], commhandle
-  return (None,None)
+# Keeps track of the listening sockets so that the SocketSelector can wait
+# for them without rebuilding the list from the comminfo table.   Sockets are
+# registered when recvmess / waitforconn create them and unregistered in
+# cleanup.   On Linux this uses epoll, elsewhere it falls back to select.
+#
+# Registering or unregistering a socket writes a byte to the wakeup pipe so
+# that a blocked SocketSelector will notice new sockets (for select) and
+# check whether it should exit.
+#
+# The epoll object and pipe are created on first use, so that they are not
+# shared with the resource monitor process.
+class SocketPoller:
 
+  def __init__(self):
+    # protects the socket tables and creating the epoll object / pipe
+    self.lock = threading.Lock()
 
+    # file descriptor -> socket object, and the reverse.   The descriptor is
+    # remembered because it can't be looked up after the socket is closed
+    self.fdtosocket = {}
+    self.sockettofd = {}
 
-# Find a commhandle, given TIPO: type, ip, port, outgoing
-def find_tipo_commhandle(socktype, ip, port, outgoing):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == socktype and comminfo[commhandle]['localip'] == ip and comminfo[commhandle]['localport'] == port and comminfo[commhandle]['outgoing'] == outgoing:
-      return commhandle
-  return None
+    self.initialized = False
+    self.epollobj = None
+    self.wakeupread = None
+    self.wakeupwrite = None
 
 
-# Find an outgoing TCP commhandle, given local ip, local port, remote ip, remote port, 
-def find_outgoing_tcp_commhandle(localip, localport, remoteip, remoteport):
-  for commhandle in comminfo.keys():
-    if comminfo[commhandle]['type'] == "TCP" and comminfo[commhandle]['localip'] == localip \
-    and comminfo[commhandle]['localport'] == localport and comminfo[commhandle]['remotehost'] == remoteip \
-    and comminfo[commhandle]['remoteport'] == remoteport and comminfo[commhandle]['outgoing'] == True:
-      return commhandle
-  return None
+  # Private.   Set up the wakeup pipe and epoll object.   Call with the lock
+  # held.
+  def _initialize(self):
+    if self.initialized:
+      return
+    self.initialized = True
 
+    # select can only wait on sockets on Windows, so I'll use a timeout there
+    if fcntl is not None:
+      (self.wakeupread, self.wakeupwrite) = create_wakeup_pipe()
 
+    # epoll is only on Linux with Python 2.6 or later
+    if nonportable.ostype == "Linux" and self.wakeupread is not None:
+      try:
+        self.epollobj = select.epoll()
+      except (AttributeError, IOError, OSError):
+        self.epollobj = None
+      else:
+        self.epollobj.register(self.wakeupread, select.EPOLLIN)
 
 
+  # Start waiting for the given socket to be readable
+  def register(self, sock):
+    self.lock.acquire()
+    try:
+      self._initialize()
 
+      fd = sock.fileno()
+      self.fdtosocket[fd] = sock
+      self.sockettofd[sock] = fd
+      if self.epollobj is not None:
+        self.epollobj.register(fd, select.EPOLLIN | select.EPOLLPRI)
+    finally:
+      self.lock.release()
 
-######################### Simple Public Functions ##########################
+    self.wakeup()
 
 
+  # Stop waiting for the given socket.   Call this before closing the socket
+  def unregister(self, sock):
+    self.lock.acquire()
+    try:
+      if sock not in self.sockettofd:
+        return
+      fd = self.sockettofd[sock]
+      del self.sockettofd[sock]
+      del self.fdtosocket[fd]
 
-# Public interface
-def gethostbyname_ex(name):
-  """
-   <Purpose>
-      Provides information about a hostname.   Calls socket.gethostbyname_ex()
+      if self.epollobj is not None:
+        try:
+          self.epollobj.unregister(fd)
+        except (IOError, OSError):
+          # the socket was already closed
+          pass
+    finally:
+      self.lock.release()
+
+    self.wakeup()
+
+
+  # Wake up the SocketSelector if it is waiting
+  def wakeup(self):
+    if self.wakeupwrite is None:
+      return
+    try:
+      os.write(self.wakeupwrite, "x")
+    except OSError:
+      # the pipe is full so a wakeup is already pending
+      pass
+
+
+  # Private.   Read everything in the wakeup pipe
+  def _drain_wakeups(self):
+    try:
+      while os.read(self.wakeupread, 512):
+        pass
+    except OSError:
+      # nothing left to read
+      pass
+
+
+  # Returns a list of the registered sockets that are readable or have an
+  # error.   This blocks until there is a socket ready or wakeup is called,
+  # in which case the list may be empty.
+  def poll(self):
+    self.lock.acquire()
+    try:
+      self._initialize()
+      requestlist = self.fdtosocket.values()
+    finally:
+      self.lock.release()
+
+    if self.epollobj is not None:
+      return self._poll_epoll()
+    return self._poll_select(requestlist)
+
+
+  # Private.   Wait using epoll
+  def _poll_epoll(self):
+    try:
+      eventlist = self.epollobj.poll()
+    except IOError, e:
+      # Interrupted by a signal, the caller will just call poll again
+      if e[0] == errno.EINTR:
+        return []
+      raise
+
+    readylist = []
+    for (fd, eventmask) in eventlist:
+      if fd == self.wakeupread:
+        self._drain_wakeups()
+        continue
+
+      # this could have been unregistered since epoll returned
+      try:
+        readylist.append(self.fdtosocket[fd])
+      except KeyError:
+        pass
+
+    return readylist
+
+
+  # Private.   Wait using select
+  def _poll_select(self, requestlist):
+    # nothing to request.   We should loop back around and check if all 
+    # sockets have been closed
+    if self.wakeupread is None and requestlist == []:
+      time.sleep(SELECT_TIMEOUT)
+      return []
+
+    if self.wakeupread is None:
+      readrequest = requestlist
+      timeout = SELECT_TIMEOUT
+    else:
+      readrequest = requestlist + [self.wakeupread]
+      timeout = None
+
+    # Perform a select on these sockets
+    try:
+      (acceptable, not_applic, has_excp) = select.select(readrequest,[],requestlist,timeout)
+
+    except select.error, e:
+      # Interrupted by a signal, the caller will just call poll again
+      if e[0] == errno.EINTR:
+        return []
+      return self._check_sockets_individually(requestlist)
+
+    # There was probably an exception on the socket level
+    except:
+      return self._check_sockets_individually(requestlist)
+
+    if self.wakeupread in acceptable:
+      self._drain_wakeups()
+      acceptable.remove(self.wakeupread)
+  
+    # Add all the sockets with exceptions to the acceptable list
+    for sock in has_excp:
+      if sock not in acceptable:
+        acceptable.append(sock)
+
+    # Return the acceptable list
+    return acceptable
+
+
+  # Private.   If select fails, check each socket individually
+  def _check_sockets_individually(self, requestlist):
+    # Hold the ready sockets
+    readylist = []
+
+    # Check each requested socket
+    for socket in requestlist:
+      try:
+        (accept_will_block, write_will_block) = socket_state(socket, "r")
+        if not accept_will_block:
+          readylist.append(socket)
+      
+      # Ignore errors, probably the socket is closed.
+      except:
+        pass
+
+    # Pause so that a bad socket doesn't cause a tight loop
+    if readylist == []:
+      time.sleep(TIME_BETWEEN_SAMPLES)
+
+    # Return the ready list
+    return readylist
+
+
+
+# The sockets the SocketSelector waits on
+socketpoller = SocketPoller()
+
+
+
+# Check for sockets using epoll or select and fire up user event threads as 
+# needed.
+#
+# This class holds nearly all of the complexity in this module.   It's 
+# basically just a loop that gets pending sockets (from the socketpoller) and
+# then fires up events that call user provided functions
+class SocketSelector(threading.Thread):
+  
+  def __init__(self):
+    threading.Thread.__init__(self, name="SocketSelector")
+
+
+  def run(self):
+    while True:
+
+      # I'll stop myself only when there are no active threads to monitor
+      if should_selector_exit():
+        return
+
+      # Block until there are ready sockets or the sockets change
+      readylist = socketpoller.poll()
+
+      # Close the sockets stopcomm didn't wait for.   This is done before
+      # starting events so that there are no events for them after stopcomm
+      # returns
+      run_pending_cleanups()
+
+      # go through the pending sockets, grab an event and then start a thread
+      # to handle the connection
+      handledcount = 0
+      for thisitem in readylist:
+        try: 
+          commtableentry,commhandle = find_socket_entry(thisitem)
+        except KeyError:
+          # let's skip this one, it's likely it was closed in the interim
+          continue
+
+        # stopcomm(handle, wait=False) was called, it will be cleaned up
+        # after the next poll
+        if 'stopped' in commtableentry:
+          continue
+
+        handledcount = handledcount + 1
+
+        # Queued messages are charged as they are delivered, so that a burst
+        # can be read while the handler is busy
+        if commtableentry['type'] == 'UDP':
+          messagequeuelength = get_message_queue_length()
+          if messagequeuelength > 0:
+            queue_messages(commtableentry, messagequeuelength)
+            continue
+
+        # now it's time to get the event...   I'll loop until there is a free
+        # event
+        eventhandle = idhelper.getuniqueid()
+        wait_for_event(eventhandle)
+
+        # wait if already oversubscribed
+        if commtableentry['loopback']:
+          nanny.tattle_quantity('looprecv',0)
+        else:
+          nanny.tattle_quantity('netrecv',0)
+
+        # Now I can start a thread to run the user's code...
+        start_event(commtableentry,commhandle,eventhandle)
+
+      # If sockets are ready but none of them are in the table, don't spin
+      # until cleanup unregisters them
+      if readylist and handledcount == 0:
+        time.sleep(TIME_BETWEEN_SAMPLES)
+      
+
+
+
+
+
+
+
+# this gives an actual event to the user's code.   The event is run by a
+# thread from the eventpool
+class EventDeliverer:
+  func = None
+  args = None
+  eventid = None
+
+  def __init__(self, f, a,e):
+    self.func = f
+    self.args = a
+    self.eventid = e
+
+  # queue the event to the pool.   The thread is given a custom and unique
+  # name when it runs the event
+  def start(self):
+    eventpool.queue_event(self.run, (), COMM_PREFIX)
+
+  def run(self):
+    try:
+      self.func(*(self.args))
+
+      # charge anything that was batched up during the event
+      nanny.flush_thread_charges()
+    except:
+      # we probably should exit if they raise an exception in a thread...
+      tracebackrepy.handle_exception()
+      harshexit.harshexit(14)
+
+    finally:
+      # our event is going away...
+      nanny.tattle_remove_item('events',self.eventid)
+
+      # let the SocketSelector know if it's waiting for an event
+      event_finished.acquire()
+      try:
+        event_finished.notify()
+      finally:
+        event_finished.release()
+      
+
+
+
+
+        
+#### used by other threads to interact with the SocketSelector...
+
+
+# private.   Check if the SocketSelector is running and start it if it isn't
+def check_selector():
+  global selectorstarted
+
+  # acquire the lock. 
+  if selectorlock.acquire():
+    # If I've not started, then start me...
+    if not selectorstarted:
+      # wait until there is a free event...
+      wait_for_event("SocketSelector")
+      selectorstarted = True
+      SocketSelector().start()
+
+    # verify a thread with the name "SocketSelector" is running
+    for threadobj in threading.enumerate():
+      if threadobj.getName() == "SocketSelector":
+        # all is well
+        selectorlock.release()
+        return
+  
+    # this is bad.   The socketselector went away...
+    # This will cause the program to exit and log things if logging is
+    # enabled. -Brent
+    tracebackrepy.handle_internalerror("SocketSelector died", 59)
+
+
+
+
+# return the table entry for this type of socket, ip, port 
+def find_tip_entry(socktype, ip, port):
+  for outgoing in [False, True]:
+    commhandle = comminfo.find_tipo(socktype, ip, port, outgoing)
+    if commhandle is not None:
+      try:
+        return comminfo[commhandle], commhandle
+      except KeyError:
+        # it was just removed
+        pass
+  return (None,None)
+
+
+
+# Find a commhandle, given TIPO: type, ip, port, outgoing
+def find_tipo_commhandle(socktype, ip, port, outgoing):
+  return comminfo.find_tipo(socktype, ip, port, outgoing)
+
+
+# Find an outgoing TCP commhandle, given local ip, local port, remote ip, remote port, 
+def find_outgoing_tcp_commhandle(localip, localport, remoteip, remoteport):
+  return comminfo.find_connection(localip, localport, remoteip, remoteport)
+
+
+
+
+
+
+######################### Simple Public Functions ##########################
+
+
+
+# Public interface
+def gethostbyname_ex(name):
+  """
+   <Purpose>
+      Provides information about a hostname.   Calls socket.gethostbyname_ex()
 
    <Arguments>
       name:
@@ -795,11 +1450,207 @@ def gethostbyname_ex(name):
 
   restrictions.assertisallowed('gethostbyname_ex',name)
 
+  # Looking up a name again doesn't cost anything
+  result = get_cached_hostname(name)
+  if result is not None:
+    return result
+
   # charge 4K for a look up...   I don't know the right number, but we should
   # charge something.   We'll always charge to the netsend interface...
   nanny.tattle_quantity('netsend',4096) 
   nanny.tattle_quantity('netrecv',4096)
-  return socket.gethostbyname_ex(name)
+
+  result = socket.gethostbyname_ex(name)
+  cache_hostname(name, result)
+  return result
+
+
+
+# Public interface
+def gethostbyname_ex_batch(namelist):
+  """
+   <Purpose>
+      Looks up several host names at once, e.g. to look up all of the other 
+      hosts a program will talk to when it starts.   The names that aren't
+      cached are looked up in parallel.
+
+   <Arguments>
+      namelist:
+         A list of host names
+
+   <Exceptions>
+      Any name isn't allowed by the restrictions.
+
+   <Side Effects>
+      The results are cached, so gethostbyname_ex won't need to look the 
+      names up again.
+
+   <Returns>
+      A list with an entry for each name: the (hostname, aliaslist, 
+      ipaddrlist) tuple that gethostbyname_ex would return, or a string 
+      describing the error if the name couldn't be looked up.
+  """
+  for name in namelist:
+    restrictions.assertisallowed('gethostbyname_ex',name)
+
+  resultdict = {}
+  lookuplist = []
+  for name in namelist:
+    if name in resultdict or name in lookuplist:
+      continue
+    result = get_cached_hostname(name)
+    if result is None:
+      lookuplist.append(name)
+    else:
+      resultdict[name] = result
+
+  if lookuplist:
+    # charge 4K per look up, as gethostbyname_ex does
+    nanny.tattle_quantity('netsend',4096 * len(lookuplist)) 
+    nanny.tattle_quantity('netrecv',4096 * len(lookuplist))
+
+    HostnameLookupBatch(lookuplist, resultdict).run()
+
+  resultlist = []
+  for name in namelist:
+    resultlist.append(resultdict[name])
+  return resultlist
+
+
+
+# Looks up names for gethostbyname_ex_batch.   The calling thread and up to
+# HOSTNAME_LOOKUP_THREADS - 1 threads from the eventpool take names from the
+# list until it is empty.   Each pool thread uses an event, so there are only
+# as many as there are free events.
+class HostnameLookupBatch:
+
+  def __init__(self, lookuplist, resultdict):
+    self.lookuplist = lookuplist
+    self.resultdict = resultdict
+
+    # Notified when a pool thread is done
+    self.donecondition = threading.Condition()
+    self.runningcount = 0
+
+
+  # Look up all of the names and return when they are done
+  def run(self):
+    for count in xrange(min(len(self.lookuplist), repy_constants.HOSTNAME_LOOKUP_THREADS) - 1):
+      eventhandle = idhelper.getuniqueid()
+      try:
+        nanny.tattle_add_item('events',eventhandle)
+      except Exception:
+        # There are no free events, so this thread does the rest
+        break
+
+      self.donecondition.acquire()
+      self.runningcount = self.runningcount + 1
+      self.donecondition.release()
+
+      try:
+        eventpool.queue_event(self.run_event, (eventhandle,), COMM_PREFIX)
+      except thread.error:
+        self.event_done(eventhandle)
+        break
+
+    self.lookup_names()
+
+    self.donecondition.acquire()
+    try:
+      while self.runningcount > 0:
+        self.donecondition.wait()
+    finally:
+      self.donecondition.release()
+
+
+  # Runs in a pool thread
+  def run_event(self, eventhandle):
+    try:
+      self.lookup_names()
+    finally:
+      self.event_done(eventhandle)
+
+
+  # Private.   Release a pool thread's event
+  def event_done(self, eventhandle):
+    nanny.tattle_remove_item('events',eventhandle)
+
+    # let the SocketSelector know if it's waiting for an event
+    event_finished.acquire()
+    try:
+      event_finished.notify()
+    finally:
+      event_finished.release()
+
+    self.donecondition.acquire()
+    try:
+      self.runningcount = self.runningcount - 1
+      self.donecondition.notify()
+    finally:
+      self.donecondition.release()
+
+
+  # Private.   Look up names until the list is empty.   Errors are stored as
+  # strings
+  def lookup_names(self):
+    while True:
+      # list.pop is atomic, so the threads can share the list
+      try:
+        name = self.lookuplist.pop()
+      except IndexError:
+        return
+
+      try:
+        result = socket.gethostbyname_ex(name)
+      except Exception, e:
+        # e.g. socket.gaierror, or TypeError for a name with a NUL byte
+        self.resultdict[name] = str(e)
+      else:
+        cache_hostname(name, result)
+        self.resultdict[name] = result
+
+
+
+# gethostbyname_ex caches the names it looks up, so a program that refers to
+# other hosts by name isn't charged for a lookup every time.   Entries 
+# expire after repy_constants.HOSTNAME_CACHE_TTL seconds, and the oldest is 
+# dropped when there are HOSTNAME_CACHE_SIZE.   The cache maps each name to
+# (the time it was looked up, the result).
+hostnamecache = {}
+hostnamecachelock = threading.Lock()
+
+
+# Private.   Returns the cached result for a name, or None
+def get_cached_hostname(name):
+  hostnamecachelock.acquire()
+  try:
+    if name not in hostnamecache:
+      return None
+
+    (lookuptime, result) = hostnamecache[name]
+    if nonportable.getruntime() - lookuptime >= repy_constants.HOSTNAME_CACHE_TTL:
+      del hostnamecache[name]
+      return None
+
+    return result
+  finally:
+    hostnamecachelock.release()
+
+
+# Private.   Adds a result to the cache
+def cache_hostname(name, result):
+  hostnamecachelock.acquire()
+  try:
+    if name not in hostnamecache and len(hostnamecache) >= repy_constants.HOSTNAME_CACHE_SIZE:
+      oldestname = None
+      for cachedname in hostnamecache:
+        if oldestname is None or hostnamecache[cachedname][0] < hostnamecache[oldestname][0]:
+          oldestname = cachedname
+      del hostnamecache[oldestname]
+
+    hostnamecache[name] = (nonportable.getruntime(), result)
+  finally:
+    hostnamecachelock.release()
 
 
 
@@ -938,7 +1789,7 @@ def is_loopback(host):
 
 
 # Public interface !!!
-def stopcomm(commhandle):
+def stopcomm(commhandle, wait=True):
   """
    <Purpose>
       Stop handling events for a commhandle.   This works for both message and
@@ -947,6 +1798,10 @@ def stopcomm(commhandle):
    <Arguments>
       commhandle:
          A commhandle as returned by recvmess or waitforconn.
+      wait:
+         If False, return without waiting for the socket to be closed.   The
+         socket is closed (and no more events are started for it) shortly 
+         after.
 
    <Exceptions>
       None.
@@ -963,14 +1818,30 @@ def stopcomm(commhandle):
   if not is_valid_commhandle(commhandle):
     raise Exception("Invalid commhandle specified!")
 
-  # if it has already been cleaned up, exit.
-  if commhandle not in comminfo:
+  # if it has already been cleaned up (or stopped without waiting), exit.
+  if commhandle not in comminfo or is_stopped(commhandle):
     # Armon: Semantic update, stopcomm needs to return True/False
     # since the handle does not exist we will return False
     return False
 
   restrictions.assertisallowed('stopcomm',comminfo[commhandle])
 
+  # The SocketSelector is running while there are listening sockets, so let
+  # it do the cleanup.   The handle is stopped now so that no more events 
+  # start for it.
+  if not wait and not comminfo[commhandle]['outgoing']:
+    if not stop_handle(commhandle):
+      return False
+
+    pending_cleanups_lock.acquire()
+    try:
+      if commhandle not in pending_cleanups:
+        pending_cleanups.append(commhandle)
+    finally:
+      pending_cleanups_lock.release()
+    socketpoller.wakeup()
+    return True
+
   cleanup(commhandle)
  
   # Armon: Semantic update, we successfully closed
@@ -983,6 +1854,93 @@ def stopcomm(commhandle):
 RETRY_INTERVAL = 0.2 # In seconds
 
 
+# Handles from stopcomm(commhandle, wait=False) that the SocketSelector should
+# clean up
+pending_cleanups = []
+pending_cleanups_lock = threading.Lock()
+
+
+# Private.   Marks a listening handle as stopped and stops the SocketSelector
+# from waiting on its socket.   The handle stays in comminfo until it is 
+# cleaned up, but no more events are started for it and stopcomm returns 
+# False for it.   Returns False if it was already stopped or is gone.
+def stop_handle(handle):
+  try:
+    entry = comminfo[handle]
+  except KeyError:
+    return False
+
+  entry['closing_lock'].acquire()
+  try:
+    if handle not in comminfo or 'stopped' in entry:
+      return False
+    entry['stopped'] = True
+  finally:
+    entry['closing_lock'].release()
+
+  socketpoller.unregister(entry['socket'])
+  return True
+
+
+
+# Private.   Returns True if stopcomm(handle, wait=False) was called for the
+# handle
+def is_stopped(handle):
+  try:
+    return 'stopped' in comminfo[handle]
+  except KeyError:
+    return False
+
+
+
+# Private.   Called by the SocketSelector to clean up the handles stopcomm
+# didn't wait for
+def run_pending_cleanups():
+  while True:
+    pending_cleanups_lock.acquire()
+    try:
+      if not pending_cleanups:
+        return
+      handle = pending_cleanups.pop(0)
+    finally:
+      pending_cleanups_lock.release()
+
+    cleanup(handle)
+
+
+
+# Private.   Closes a socket and returns True if the socket's descriptor is
+# known to be closed.   socket.close() only drops the reference to the 
+# underlying socket, which isn't closed until nothing else refers to it (e.g.
+# a thread using it), so the underlying socket is closed directly.
+#
+# The socket object is closed first, so that a thread that still has it 
+# gets EBADF rather than using the descriptor number after it is reused.   
+# The caller must have unregistered the socket from the socketpoller and 
+# woken the threads waiting on the descriptor.
+def close_real_socket(realsocket):
+  try:
+    underlyingsocket = realsocket._sock
+  except AttributeError:
+    underlyingsocket = None
+
+  try:
+    realsocket.close()
+    if underlyingsocket is not None:
+      underlyingsocket.close()
+  except:
+    pass
+
+  if underlyingsocket is None:
+    return False
+
+  try:
+    return underlyingsocket.fileno() == -1
+  except socket.error:
+    # Some versions raise an error for a closed socket
+    return True
+
+
 # Private
 def safe_delete_handle(handle):
   # Armon: lock the cleanup so that only one thread will do the cleanup, but
@@ -1022,6 +1980,11 @@ def cleanup(handle):
   # if it's in the table then remove the entry and tattle...
   try:
     if handle in comminfo:
+      # Stop the SocketSelector from waiting on this socket before it's
+      # closed (and the descriptor is reused)
+      if not comminfo[handle]['outgoing']:
+        socketpoller.unregister(comminfo[handle]['socket'])
+
       # Armon: Shutdown the socket for writing prior to close
       # to unblock any threads that are writing
       try:
@@ -1029,47 +1992,211 @@ def cleanup(handle):
       except:
         pass
 
+      info = comminfo[handle]  # Store the info
+
+      # The entry is deleted below, after the port is free.   Until then, 
+      # recv / send see this and don't use the socket
+      info['closed'] = True
+
+      # Wake up any recv / send that is waiting on the socket before the 
+      # descriptor is closed
+      if 'wakeup' in info:
+        info['wakeup'].wake()
+
+      closed = close_real_socket(info['socket'])
+
+      if info['outgoing']:
+        nanny.tattle_remove_item('outsockets', handle)
+      else:
+        nanny.tattle_remove_item('insockets', handle)
+    
+        # Armon: Block while the socket is not yet cleaned up
+        # Get the socket info
+        ip = info['localip']
+        port = info['localport']
+        socketType = info['type']
+        tcp = (socketType == 'TCP') # Check if this is a TCP typed connection
+    
+        # Loop until the socket no longer exists
+        # BUG: There exists a potential race condition here. The problem is that
+        # the socket may be cleaned up and then before we are able to check for it again
+        # another process binds to the ip/port we are checking. This would cause us to detect
+        # the socket from the other process and we would block indefinately while that socket
+        # is open.
+        #
+        # If the descriptor is closed the port is free, since the processes
+        # we start don't inherit it (portable_popen uses close_fds).   That
+        # isn't possible on Windows, so there we have to ask the OS.
+        if not closed or nonportable.ostype in ["Windows", "WindowsCE"]:
+          while nonportable.os_api.exists_listening_network_socket(ip,port, tcp):
+            time.sleep(RETRY_INTERVAL)
+      
+      # Delete the entry last, so that other stopcomm operations will block
+      try: # Guard against a rare and poorly understood error. #1052
+        del comminfo[handle]
+      except KeyError:
+        pass
+
+      # The SocketSelector may need to exit now that the socket is gone
+      if not info['outgoing']:
+        socketpoller.wakeup()
+
+  finally:
+    # Always release the lock
+    handle_lock.release()
+
+
+
+####################### Message sending #############################
+
+
+
+# sendmess keeps the sockets it sends from open, so that the next message 
+# from the same local IP / port doesn't need a new socket.   The sockets are
+# in comminfo as outgoing UDP entries (which recvmess ignores) and count as 
+# outsockets.
+SEND_SOCKET_CACHE_SIZE = 8
+
+# The handles of the cached sockets, least recently used first
+sendsocketcache = []
+sendsocketcachelock = threading.Lock()
+
+# A cached socket is in use from get_send_socket until release_send_socket.
+# This maps the handle to how many threads are using it.   Sockets that are 
+# in use aren't closed to make room, and a socket that is removed from the 
+# cache while it is in use is closed when it is released.
+sendsocketusers = {}
+
+
+# Private.   Returns (socket, commhandle) for sending messages from localip /
+# localport.   The commhandle is None if the socket couldn't be cached, in 
+# which case the caller must close it.   Otherwise the caller must call
+# release_send_socket when it is done.   Raises socket.error if the socket 
+# can't be bound.
+def get_send_socket(localip, localport):
+  sendsocketcachelock.acquire()
+  try:
+    handle = find_tipo_commhandle('UDP', localip, localport, True)
+    if handle in sendsocketcache:
       try:
-        comminfo[handle]['socket'].close()
+        s = comminfo[handle]['socket']
+      except KeyError:
+        # it was just removed
+        pass
+      else:
+        sendsocketcache.remove(handle)
+        sendsocketcache.append(handle)
+        _use_send_socket(handle)
+        return s, handle
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+      # the send buffer must also be set or it will constrain UDP sendmess
+      # size on Mac. 
+      s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 66000)
+
+      if localip:
+        s.bind((localip,localport))
+    except:
+      try:
+        s.close()
       except:
         pass
-      
-      info = comminfo[handle]  # Store the info
+      raise
+
+    # If the cache is full of sockets that are in use, don't cache this one
+    if len(sendsocketcache) >= SEND_SOCKET_CACHE_SIZE and not _evict_lru_send_socket():
+      return s, None
+
+    # If the program is using all of its outsockets, give up cached sockets
+    # to make room.   If there aren't any, don't cache this one
+    handle = generate_commhandle()
+    while True:
+      try:
+        nanny.tattle_add_item('outsockets',handle)
+        break
+      except Exception:
+        if not _evict_lru_send_socket():
+          return s, None
+
+    comminfo[handle] = {'type':'UDP','localip':localip, 'localport':localport,'socket':s, 'outgoing':True, 'closing_lock':threading.Lock() }
+    sendsocketcache.append(handle)
+    _use_send_socket(handle)
+    return s, handle
+
+  finally:
+    sendsocketcachelock.release()
+
+
+
+# Private.   Marks a cached socket as in use.   Call with sendsocketcachelock
+# held
+def _use_send_socket(handle):
+  sendsocketusers[handle] = sendsocketusers.get(handle, 0) + 1
+
+
+
+# Private.   Called when the caller of get_send_socket is done with a cached
+# socket
+def release_send_socket(handle):
+  sendsocketcachelock.acquire()
+  try:
+    sendsocketusers[handle] = sendsocketusers[handle] - 1
+    if sendsocketusers[handle] > 0:
+      return
+    del sendsocketusers[handle]
+
+    # It was removed from the cache while it was in use
+    if handle not in sendsocketcache:
+      cleanup(handle)
+  finally:
+    sendsocketcachelock.release()
+
+
+
+# Private.   Removes a socket from the cache and closes it unless it is in 
+# use, in which case it is closed when it is released.   Call with 
+# sendsocketcachelock held
+def _evict_send_socket(handle):
+  sendsocketcache.remove(handle)
+  if handle not in sendsocketusers:
+    cleanup(handle)
+
+
+
+# Private.   Closes the least recently used cached socket that isn't in use.
+# Returns False if there weren't any.   Call with sendsocketcachelock held
+def _evict_lru_send_socket():
+  for handle in sendsocketcache:
+    if handle not in sendsocketusers:
+      _evict_send_socket(handle)
+      return True
+  return False
+
 
-      if info['outgoing']:
-        nanny.tattle_remove_item('outsockets', handle)
-      else:
-        nanny.tattle_remove_item('insockets', handle)
-    
-        # Armon: Block while the socket is not yet cleaned up
-        # Get the socket info
-        ip = info['localip']
-        port = info['localport']
-        socketType = info['type']
-        tcp = (socketType == 'TCP') # Check if this is a TCP typed connection
-    
-        # Loop until the socket no longer exists
-        # BUG: There exists a potential race condition here. The problem is that
-        # the socket may be cleaned up and then before we are able to check for it again
-        # another process binds to the ip/port we are checking. This would cause us to detect
-        # the socket from the other process and we would block indefinately while that socket
-        # is open.
-        while nonportable.os_api.exists_listening_network_socket(ip,port, tcp):
-          time.sleep(RETRY_INTERVAL)
-      
-      # Delete the entry last, so that other stopcomm operations will block
-      try: # Guard against a rare and poorly understood error. #1052
-        del comminfo[handle]
-      except KeyError:
-        pass
 
+# Private.   Closes the cached socket for localip / localport, if there is
+# one, so that the port can be bound
+def evict_send_socket(localip, localport):
+  sendsocketcachelock.acquire()
+  try:
+    handle = find_tipo_commhandle('UDP', localip, localport, True)
+    if handle in sendsocketcache:
+      _evict_send_socket(handle)
   finally:
-    # Always release the lock
-    handle_lock.release()
+    sendsocketcachelock.release()
 
 
 
-####################### Message sending #############################
+# Private.   Closes the least recently used cached socket that isn't in use.
+# Returns False if there weren't any
+def evict_lru_send_socket():
+  sendsocketcachelock.acquire()
+  try:
+    return _evict_lru_send_socket()
+  finally:
+    sendsocketcachelock.release()
 
 
 
@@ -1146,6 +2273,10 @@ def sendmess(desthost, destport, message,localip=None,localport = None):
   if localip and localport:
     # let's see if the socket already exists...
     commtableentry,commhandle = find_tip_entry('UDP',localip,localport)
+
+    # sockets sendmess cached are used below
+    if commhandle and commtableentry['outgoing']:
+      commhandle = None
   else:
     # no, we'll skip
     commhandle = None
@@ -1176,22 +2307,15 @@ def sendmess(desthost, destport, message,localip=None,localport = None):
       return bytessent
   
 
-  # open a new socket
-  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
- 
-  # the send buffer must also be set or it will constrain UDP sendmess
-  # size on Mac. 
-  s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 66000)
-
+  # get a socket (it stays open for the next message if it's cached)
   try:
-    if localip:
-      try:
-        s.bind((localip,localport))
-      except socket.error, e:
-        if firsterror:
-          raise Exception, firsterror
-        raise Exception, e
+    s, sendhandle = get_send_socket(localip, localport)
+  except socket.error, e:
+    if firsterror:
+      raise Exception, firsterror
+    raise Exception, e
 
+  try:
     # wait if already oversubscribed
     if is_loopback(desthost):
       nanny.tattle_quantity('loopsend',0)
@@ -1208,11 +2332,187 @@ def sendmess(desthost, destport, message,localip=None,localport = None):
     return bytessent
 
   finally:
-    # close no matter what
+    # close it unless it's cached
+    if sendhandle is None:
+      try:
+        s.close()
+      except:
+        pass
+    else:
+      release_send_socket(sendhandle)
+
+
+
+
+# Sends a message for sendmess_batch and returns the number of bytes sent or 
+# the error as a string
+def _sendmess_batch_one(sock, desthost, destport, message):
+  try:
+    return sock.sendto(message,(desthost,destport))
+  except socket.error, e:
+    return str(e)
+
+
+
+# Public interface!!!
+def sendmess_batch(messagelist, localip=None, localport=None):
+  """
+   <Purpose>
+      Send several messages from the same socket.   This is faster than 
+      calling sendmess for each message because the socket is only set up 
+      once and, on Linux, the messages are sent with a single sendmmsg call.
+
+   <Arguments>
+      messagelist:
+         A list of (desthost, destport, message) 
+      localhost (optional):
+         The local IP to send the messages from 
+      localport (optional):
+         The local port to send the messages from (0 for a random port)
+
+   <Exceptions>
+      The same exceptions as sendmess for invalid arguments, if a message 
+      isn't allowed or if the socket can't be bound.   Errors sending 
+      a message are returned instead.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A list with an entry for each message: the number of bytes sent, or 
+      a string describing the error if the message couldn't be sent.
+  """
+  # Check that if either localip or local port is specified, that both are
+  if (localip != None and localport == None) or (localport != None and localip == None):
+    raise Exception("Localip and localport must be specified simultaneously.")
+  
+  # Assign the default value to localport if none given
+  if localport == None:
+    localport = 0
+
+  if not localip or localip == '0.0.0.0':
+    localip = None
+
+  if not is_valid_network_port(localport, True):
+    raise Exception("Local port number must be an integer, between 1 and 65535.")
+
+  # Every message must be allowed before any are sent.   They are checked as 
+  # sendmess calls so the restrictions files don't need another call
+  for (desthost, destport, message) in messagelist:
+    if not is_valid_network_port(destport):
+      raise Exception("Destination port number must be an integer, between 1 and 65535.")
+
+    restrictions.assertisallowed('sendmess', desthost, destport, message,localip,localport)
+
+  if localport:
+    nanny.tattle_check('messport',localport)
+
+  # Armon: Check if the specified local ip is allowed
+  # this check only makes sense if the localip is specified
+  if localip and not ip_is_allowed(localip):
+    raise Exception, "IP '"+str(localip)+"' is not allowed."
+  
+  # If there is a preference, but no localip, then get one
+  elif user_ip_interface_preferences and not localip:
+    # Use whatever getmyip returns
+    localip = getmyip()
+
+  if localip and localport:
+    # let's see if the socket already exists...
+    commtableentry,commhandle = find_tip_entry('UDP',localip,localport)
+
+    # sockets sendmess cached are used through get_send_socket, so they 
+    # aren't closed while the batch is sent
+    if commhandle and commtableentry['outgoing']:
+      commhandle = None
+  else:
+    commhandle = None
+
+  # The recvmess socket or a cached socket is left open
+  cached = False
+  if commhandle:
+    s = commtableentry['socket']
+  else:
     try:
-      s.close()
-    except:
-      pass
+      s, commhandle = get_send_socket(localip, localport)
+    except socket.error, e:
+      raise Exception, e
+    cached = commhandle is not None
+
+  try:
+    loopbacklist = []
+    for (desthost, destport, message) in messagelist:
+      loopbacklist.append(is_loopback(desthost))
+
+    # wait if already oversubscribed
+    if True in loopbacklist:
+      nanny.tattle_quantity('loopsend',0)
+    if False in loopbacklist:
+      nanny.tattle_quantity('netsend',0)
+
+    resultlist = [None] * len(messagelist)
+
+    # sendmmsg only takes IP addresses and str messages, everything else is 
+    # sent one at a time
+    mmsgindexlist = []
+    for index in xrange(len(messagelist)):
+      (desthost, destport, message) = messagelist[index]
+      if nonportable.ostype == "Linux" and nonportable.os_api.sendmmsg_supported() and \
+          type(message) is str and is_valid_ip_address(desthost):
+        mmsgindexlist.append(index)
+      else:
+        resultlist[index] = _sendmess_batch_one(s, desthost, destport, message)
+
+    position = 0
+    while position < len(mmsgindexlist):
+      batchindexlist = mmsgindexlist[position:]
+      batch = []
+      for index in batchindexlist:
+        batch.append(messagelist[index])
+
+      try:
+        sentlist = nonportable.os_api.send_udp_messages(s.fileno(), batch)
+      except socket.error:
+        sentlist = []
+
+      for count in xrange(len(sentlist)):
+        resultlist[batchindexlist[count]] = int(sentlist[count])
+      position = position + len(sentlist)
+
+      # sendmmsg stops at the first message it can't send.   Send that one 
+      # with sendto to get the error and continue with the rest
+      if position < len(mmsgindexlist):
+        index = mmsgindexlist[position]
+        (desthost, destport, message) = messagelist[index]
+        resultlist[index] = _sendmess_batch_one(s, desthost, destport, message)
+        position = position + 1
+
+  finally:
+    # close the socket if it was opened for the batch
+    if commhandle is None:
+      try:
+        s.close()
+      except:
+        pass
+    elif cached:
+      release_send_socket(commhandle)
+
+  loopbytes = 0
+  netbytes = 0
+  for index in xrange(len(messagelist)):
+    if type(resultlist[index]) is not int:
+      continue
+    if loopbacklist[index]:
+      loopbytes = loopbytes + resultlist[index]
+    else:
+      netbytes = netbytes + resultlist[index]
+
+  if True in loopbacklist:
+    nanny.tattle_quantity('loopsend',loopbytes)
+  if False in loopbacklist:
+    nanny.tattle_quantity('netsend',netbytes)
+
+  return resultlist
 
 
 
@@ -1283,10 +2583,15 @@ def recvmess(localip, localport, function):
 
   # check if I'm already listening on this port / ip
   # NOTE: I check as though there might be a socket open that is sending a
-  # message.   This is nonsense since sendmess doesn't result in a socket 
-  # persisting.   This is done so that if sockets for sendmess are cached 
-  # later (as seems likely) the resulting code will not break.
+  # message.   sendmess caches its sockets as outgoing entries, so they 
+  # aren't found here (and are closed below).
   oldhandle = find_tipo_commhandle('UDP', localip, localport, False)
+
+  # A handle stopcomm didn't wait for can't be reused, so finish closing it
+  if oldhandle and is_stopped(oldhandle):
+    cleanup(oldhandle)
+    oldhandle = None
+
   if oldhandle:
     # if it was already there, update the function and return
     comminfo[oldhandle]['function'] = function
@@ -1304,6 +2609,9 @@ def recvmess(localip, localport, function):
     # Return the new handle
     return handle
     
+  # sendmess may have a socket bound to this ip / port
+  evict_send_socket(localip, localport)
+
   # we'll need to add it, so add a socket...
   nanny.tattle_add_item('insockets',handle)
 
@@ -1313,7 +2621,8 @@ def recvmess(localip, localport, function):
     s.bind((localip,localport))
 
     # set the receive buffer size to slightly more than 64K+e (see ticket #887)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 66000)
+    # unless the restrictions set it
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, get_message_receive_buffer())
     # the send buffer must also be set or it will constrain UDP sendmess
     # size on Mac.   I set it here because this socket may be used for sending
     s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 66000)
@@ -1328,7 +2637,10 @@ def recvmess(localip, localport, function):
     raise
 
   # set up our table entry
-  comminfo[handle] = {'type':'UDP','localip':localip, 'localport':localport,'function':function,'socket':s, 'outgoing':False, 'closing_lock':threading.Lock() }
+  comminfo[handle] = {'type':'UDP','localip':localip, 'localport':localport,'function':function,'socket':s, 'outgoing':False, 'closing_lock':threading.Lock(), 'messqueue':collections.deque(), 'messqueuelock':threading.Lock(), 'messqueuerunning':False }
+
+  # have the selector wait for messages on this socket
+  socketpoller.register(s)
 
   # start the selector if it's not running already
   check_selector()
@@ -1352,7 +2664,7 @@ def recvmess(localip, localport, function):
 
 
 # Public interface!!!
-def openconn(desthost, destport,localip=None, localport=None,timeout=None):
+def openconn(desthost, destport,localip=None, localport=None,timeout=None,reuse=False):
   """
    <Purpose>
       Opens a connection, returning a socket-like object
@@ -1368,6 +2680,11 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
          The local port to use for communication (0 for a random port)
       timeout (optional):
          The maximum amount of time to wait to connect
+      reuse (optional):
+         If True, the connection is kept open when it is closed, and is 
+         returned by a later openconn with reuse to the same host / port 
+         (from the same local ip / port).   This also returns such a 
+         connection if there is one.
 
    <Exceptions>
       As from socket.connect, etc.
@@ -1428,6 +2745,16 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
     localip = getmyip()
 
   restrictions.assertisallowed('openconn',desthost,destport,localip,localport)
+
+  # Use an idle connection if there is one.   Otherwise, make sure one isn't
+  # using the local port
+  reusekey = (desthost, destport, localip, localport)
+  if reuse:
+    handle = get_idle_connection(reusekey)
+    if handle is not None:
+      return emulated_socket(handle)
+  elif localport:
+    discard_idle_connections(reusekey)
   
   # Get our start time
   starttime = nonportable.getruntime()
@@ -1458,86 +2785,332 @@ def openconn(desthost, destport,localip=None, localport=None,timeout=None):
       raise Exception, "Timed out checking for socket cleanup!"
         
 
-  if localport:
-    nanny.tattle_check('connport',localport)
+  if localport:
+    nanny.tattle_check('connport',localport)
+
+  handle = generate_commhandle()
+
+  # If allocation of an outsocket fails, we garbage collect and try again
+  # -- this forces destruction of unreferenced objects, which is how we
+  # free resources.   The sockets sendmess cached and idle connections are
+  # given up first.
+  try:
+    nanny.tattle_add_item('outsockets',handle)
+  except:
+    if not evict_lru_send_socket() and not evict_idle_connection():
+      gc.collect()
+    nanny.tattle_add_item('outsockets',handle)
+
+  
+  try:
+    s = get_real_socket(localip,localport)
+
+    # prevent excessive TCP buffering (#895)
+    connbuffer = get_connection_buffer()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, connbuffer)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, connbuffer)
+
+  
+    # add the socket to the comminfo table
+    comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':s, 'outgoing':True, 'closing_lock':threading.Lock()}
+    if reuse:
+      comminfo[handle]['reusekey'] = reusekey
+  except:
+    # the socket wasn't passed to the user prog...
+    nanny.tattle_remove_item('outsockets',handle)
+    raise
+
+
+  try:
+    # This makes the socket non-blocking, so connect returns right away and
+    # we wait for the connection with poll
+    thissock = emulated_socket(handle)
+    realsocket = comminfo[handle]['socket']
+
+    # Store exceptions until we exit the loop, default to timed out
+    # in case we are given a very small timeout
+    connect_exception = Exception("Connection timed out!")
+
+    # Ignore errors and retry if we have not yet reached the timeout
+    while nonportable.getruntime() - starttime < timeout:
+      errnum = realsocket.connect_ex((desthost,destport))
+
+      # Connected
+      if errnum == 0:
+        break
+
+      if is_connect_in_progress_error(errnum):
+        # Wait for the connection, then call connect_ex again to find out
+        # if it worked
+        wait_for_connect(realsocket, timeout - (nonportable.getruntime() - starttime))
+        errnum = realsocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if errnum == 0:
+          errnum = realsocket.connect_ex((desthost,destport))
+          if errnum == 0:
+            break
+          # Still connecting, the loop ends if the time is up
+          if is_connect_in_progress_error(errnum):
+            continue
+        waited = True
+      else:
+        waited = False
+
+      e = socket.error(errnum, os.strerror(errnum))
+
+      # Check if the socket is already connected (EISCONN or WSAEISCONN)
+      if is_already_connected_exception(e):
+        break
+
+      # Check if this is recoverable, only continue if it is
+      elif not is_recoverable_network_exception(e):
+        raise e
+
+      else:
+        # Store the exception
+        connect_exception = e
+
+      # Sleep a bit if connect failed right away, avoid excessive iterations
+      # of the loop
+      if not waited:
+        time.sleep(RETRY_INTERVAL)
+    else:
+      # Raise any exception that was raised
+      if connect_exception != None:
+        raise connect_exception
+
+    comminfo.set_remote(handle, desthost, destport)
+  
+  except:
+    cleanup(handle)
+    raise
+
+  return thissock
+
+
+
+# Private.   Determines if an error from connect_ex means the connection is 
+# still being made
+def is_connect_in_progress_error(errnum):
+  try:
+    errname = errno.errorcode[errnum]
+  except KeyError:
+    return False
+
+  return errname in ["EINPROGRESS", "EALREADY", "EWOULDBLOCK", 
+      "WSAEINPROGRESS", "WSAEALREADY", "WSAEWOULDBLOCK"]
+
+
+
+# Private.   Waits up to timeout seconds for a non-blocking connect to 
+# finish.   This may return early, so the caller should check the socket.
+def wait_for_connect(realsocket, timeout):
+  if timeout <= 0:
+    return
+
+  try:
+    if select_poll is not None:
+      poller = select_poll()
+      poller.register(realsocket.fileno(), select.POLLOUT | select.POLLERR | select.POLLHUP)
+      poller.poll(timeout * 1000)
+    else:
+      socket_state(realsocket, "w", timeout)
+  except (select.error, socket.error), e:
+    # EINTR, or the socket was closed
+    pass
+
+
+
+# Connections opened with openconn(..., reuse=True) aren't closed when the 
+# program closes them, so that another openconn with reuse to the same place
+# can use them.   An idle connection stays in comminfo (and counts as an 
+# outsocket) under a new handle, so the closed socket object can't use it.
+# At most repy_constants.CONNECTION_POOL_SIZE connections are kept, for up to
+# repy_constants.CONNECTION_POOL_IDLE_TIME seconds each.   While there are
+# idle connections, a background timer checks them every 
+# CONNECTION_POOL_CHECK_INTERVAL seconds and closes the ones that expired or
+# that the other side closed.
+
+# (reusekey, handle, the time it was closed), oldest first
+idleconnections = []
+idleconnectionslock = threading.Lock()
+
+# Whether the timer that checks the idle connections is set.   Protected by
+# idleconnectionslock
+idleconnectionstimerset = False
+
+
+# Private.   Called when a socket is closed.   Keeps the connection if it 
+# was opened with reuse and nothing has been received that the program 
+# didn't read.   Returns True if the connection was kept.
+def park_connection(commhandle, emulsocket):
+  try:
+    entry = comminfo[commhandle]
+  except KeyError:
+    return False
+
+  if 'reusekey' not in entry:
+    return False
+
+  # The program didn't read everything or the other side closed
+  if emulsocket.recvclosed or len(emulsocket.recvbuffer) > emulsocket.recvoffset:
+    return False
+  if not is_idle_connection(entry['socket']):
+    return False
+
+  newhandle = generate_commhandle()
+
+  idleconnectionslock.acquire()
+  try:
+    # Keep cleanup from closing it while the handle is changed
+    entry['closing_lock'].acquire()
+    try:
+      if commhandle not in comminfo:
+        return False
+
+      del comminfo[commhandle]
+      comminfo[newhandle] = entry
+      nanny.tattle_remove_item('outsockets',commhandle)
+    finally:
+      entry['closing_lock'].release()
+
+    # Threads blocked on the old socket object wait on this
+    if 'wakeup' in entry:
+      entry['wakeup'].wake()
+
+    try:
+      nanny.tattle_add_item('outsockets',newhandle)
+    except Exception:
+      # Another thread took the outsocket, so close the connection.   The 
+      # outsocket isn't held, but removing it again is harmless
+      cleanup(newhandle)
+      return True
+
+    idleconnections.append((entry['reusekey'], newhandle, nonportable.getruntime()))
+
+    if len(idleconnections) > repy_constants.CONNECTION_POOL_SIZE:
+      cleanup(idleconnections.pop(0)[1])
+
+    _set_idle_connections_timer()
+    return True
+  finally:
+    idleconnectionslock.release()
+
+
+
+# Private.   Sets the timer that checks the idle connections, unless it is 
+# already set.   Call with idleconnectionslock held
+def _set_idle_connections_timer():
+  global idleconnectionstimerset
+
+  if idleconnectionstimerset:
+    return
+
+  # The check is quick, so it doesn't use one of the program's events, and 
+  # it doesn't keep the program from exiting
+  eventpool.EventTimer(repy_constants.CONNECTION_POOL_CHECK_INTERVAL, check_idle_connections, (), COMM_PREFIX, background=True).start()
+  idleconnectionstimerset = True
+
+
+
+# Private.   Closes the idle connections that expired or that the other 
+# side closed (or sent something on).   This runs from a timer, and sets the
+# timer again while there are idle connections.
+def check_idle_connections():
+  global idleconnectionstimerset
+
+  idleconnectionslock.acquire()
+  try:
+    idleconnectionstimerset = False
+    now = nonportable.getruntime()
+
+    for (key, handle, closedtime) in idleconnections[:]:
+      try:
+        realsocket = comminfo[handle]['socket']
+      except KeyError:
+        realsocket = None
+
+      if realsocket is None or not is_idle_connection(realsocket) or now - closedtime >= repy_constants.CONNECTION_POOL_IDLE_TIME:
+        idleconnections.remove((key, handle, closedtime))
+        cleanup(handle)
+
+    if idleconnections:
+      _set_idle_connections_timer()
+  finally:
+    idleconnectionslock.release()
+
 
-  handle = generate_commhandle()
 
-  # If allocation of an outsocket fails, we garbage collect and try again
-  # -- this forces destruction of unreferenced objects, which is how we
-  # free resources.
+# Private.   Determines if a connection can be used again.   Data waiting to
+# be read (or the other side closing) means it can't
+def is_idle_connection(realsocket):
   try:
-    nanny.tattle_add_item('outsockets',handle)
-  except:
-    gc.collect()
-    nanny.tattle_add_item('outsockets',handle)
+    (read_will_block, write_will_block) = socket_state(realsocket, "r")
+  except (select.error, socket.error):
+    return False
 
-  
+  return read_will_block
+
+
+
+# Private.   Returns the handle of an idle connection for the key (removing
+# it from the idle connections), or None.   Connections that can't be used
+# are closed
+def get_idle_connection(reusekey):
+  idleconnectionslock.acquire()
   try:
-    s = get_real_socket(localip,localport)
+    now = nonportable.getruntime()
 
-    # prevent excessive TCP buffering (#895)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 10000)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 10000)
+    # Use the most recent connection first, it is the least likely to have
+    # been closed by the other side
+    index = len(idleconnections) - 1
+    while index >= 0:
+      (key, handle, closedtime) = idleconnections[index]
+      if key == reusekey:
+        del idleconnections[index]
 
-  
-    # add the socket to the comminfo table
-    comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':s, 'outgoing':True, 'closing_lock':threading.Lock()}
-  except:
-    # the socket wasn't passed to the user prog...
-    nanny.tattle_remove_item('outsockets',handle)
-    raise
+        try:
+          realsocket = comminfo[handle]['socket']
+        except KeyError:
+          realsocket = None
 
+        if realsocket is not None and is_idle_connection(realsocket) and now - closedtime < repy_constants.CONNECTION_POOL_IDLE_TIME:
+          return handle
 
-  try:
-    thissock = emulated_socket(handle)
-    # We set a timeout before we connect.  This allows us to timeout slow 
-    # connections...
-    oldtimeout = comminfo[handle]['socket'].gettimeout()
- 
-    # Set the new timeout
-    comminfo[handle]['socket'].settimeout(timeout)
+        cleanup(handle)
 
-    # Store exceptions until we exit the loop, default to timed out
-    # in case we are given a very small timeout
-    connect_exception = Exception("Connection timed out!")
+      index = index - 1
 
-    # Ignore errors and retry if we have not yet reached the timeout
-    while nonportable.getruntime() - starttime < timeout:
-      try:
-        comminfo[handle]['socket'].connect((desthost,destport))
-        break
-      except Exception,e:
-        # Check if the socket is already connected (EISCONN or WSAEISCONN)
-        if is_already_connected_exception(e):
-          break
+    return None
+  finally:
+    idleconnectionslock.release()
 
-        # Check if this is recoverable, only continue if it is
-        elif not is_recoverable_network_exception(e):
-          raise
 
-        else:
-          # Store the exception
-          connect_exception = e
 
-        # Sleep a bit, avoid excessive iterations of the loop
-        time.sleep(0.2)
-    else:
-      # Raise any exception that was raised
-      if connect_exception != None:
-        raise connect_exception
+# Private.   Closes the idle connections for the key.   This is done before
+# binding to a local port that an idle connection may be using.
+def discard_idle_connections(reusekey):
+  idleconnectionslock.acquire()
+  try:
+    for (key, handle, closedtime) in idleconnections[:]:
+      if key == reusekey:
+        idleconnections.remove((key, handle, closedtime))
+        cleanup(handle)
+  finally:
+    idleconnectionslock.release()
 
-    comminfo[handle]['remotehost']=desthost
-    comminfo[handle]['remoteport']=destport
-  
-  except:
-    cleanup(handle)
-    raise
-  else:
-    # and restore the old timeout...
-    comminfo[handle]['socket'].settimeout(oldtimeout)
 
-  return thissock
+
+# Private.   Closes the oldest idle connection to free an outsocket.   Returns
+# True if there was one.
+def evict_idle_connection():
+  idleconnectionslock.acquire()
+  try:
+    if not idleconnections:
+      return False
+    cleanup(idleconnections.pop(0)[1])
+    return True
+  finally:
+    idleconnectionslock.release()
 
 
 
@@ -1593,6 +3166,12 @@ def waitforconn(localip, localport,function):
   
   # check if I'm already listening on this port / ip
   oldhandle = find_tipo_commhandle('TCP', localip, localport, False)
+
+  # A handle stopcomm didn't wait for can't be reused, so finish closing it
+  if oldhandle and is_stopped(oldhandle):
+    cleanup(oldhandle)
+    oldhandle = None
+
   if oldhandle:
     # if it was already there, update the function and return
     comminfo[oldhandle]['function'] = function
@@ -1617,18 +3196,25 @@ def waitforconn(localip, localport,function):
   try:
     mainsock = get_real_socket(localip,localport)
 
-    # prevent excessive TCP buffering (#895)
-    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 10000)
-    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 10000)
+    # prevent excessive TCP buffering (#895).   The accepted sockets get the
+    # same buffer sizes
+    connbuffer = get_connection_buffer()
+    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, connbuffer)
+    mainsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, connbuffer)
 
-    # NOTE: Should this be anything other than a hardcoded number?
-    mainsock.listen(5)
+    mainsock.listen(get_connection_backlog())
+
+    # The SocketSelector accepts until there are no more connections, so 
+    # accept must not block
+    mainsock.setblocking(0)
     # set up our table entry
     comminfo[handle] = {'type':'TCP','remotehost':None, 'remoteport':None,'localip':localip,'localport':localport,'socket':mainsock, 'outgoing':False, 'function':function, 'closing_lock':threading.Lock()}
   except:
     nanny.tattle_remove_item('insockets',handle)
     raise
 
+  # have the selector wait for connections on this socket
+  socketpoller.register(mainsock)
 
   # start the selector if it's not running already
   check_selector()
@@ -1722,6 +3308,130 @@ def socket_state(realsock, waitfor="rw", timeout=0.0):
 
 
 # Public.   We pass these to the users for communication purposes
+# A pipe that cleanup writes to, so that threads waiting in recv or send on 
+# the socket notice the close right away.   The pipe is closed when nothing
+# refers to it anymore.
+class SocketWakeup:
+
+  def __init__(self):
+    (self.readfd, self.writefd) = create_wakeup_pipe()
+
+
+  def wake(self):
+    try:
+      os.write(self.writefd, "x")
+    except OSError:
+      # The pipe is full, so it's already readable
+      pass
+
+
+  def __del__(self):
+    for fd in [self.readfd, self.writefd]:
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+
+
+# poll isn't available on Windows
+try:
+  select_poll = select.poll
+except AttributeError:
+  select_poll = None
+
+
+# Private.   Returns the socket for a handle.   Raises KeyError if the handle
+# was cleaned up or is being cleaned up
+def get_open_socket(commhandle):
+  entry = comminfo[commhandle]
+  if 'closed' in entry:
+    raise KeyError, "Socket closed"
+  return entry['socket']
+
+
+
+# Private.   Returns True if the handle was cleaned up or is being cleaned 
+# up.   An error from a socket that is being closed (e.g. EBADF) should be 
+# reported as the socket being closed.
+def is_closed_handle(commhandle):
+  try:
+    get_open_socket(commhandle)
+  except KeyError:
+    return True
+  return False
+
+
+
+# Private.   Returns the SocketWakeup for a handle, creating it if needed.
+# Returns None if a pipe can't be used.   Raises KeyError if the handle was
+# cleaned up
+def get_socket_wakeup(commhandle):
+  handle_lock = comminfo[commhandle]['closing_lock']
+
+  # The lock keeps cleanup from missing a wakeup that is being added
+  handle_lock.acquire()
+  try:
+    entry = comminfo[commhandle]
+    if 'closed' in entry:
+      raise KeyError, "Socket closed"
+    if 'wakeup' not in entry:
+      try:
+        entry['wakeup'] = SocketWakeup()
+      except OSError:
+        # Out of file descriptors?
+        return None
+    return entry['wakeup']
+  finally:
+    handle_lock.release()
+
+
+
+# Private.   Blocks until the socket is ready for reading ("r") or writing 
+# ("w") or the handle is cleaned up.   This may return early, so the caller
+# should retry the operation.
+def wait_for_socket(commhandle, realsocket, waitfor):
+  if select_poll is None or fcntl is None:
+    wakeup = None
+  else:
+    wakeup = get_socket_wakeup(commhandle)
+
+  # Without a pipe to wake us up, wait a little at a time so that if the 
+  # socket is closed in another thread, we notice it
+  if wakeup is None:
+    socket_state(realsocket, waitfor, 0.2)
+    return
+
+  pollobj = select_poll()
+  try:
+    if waitfor == "r":
+      pollobj.register(realsocket.fileno(), select.POLLIN | select.POLLPRI)
+    else:
+      pollobj.register(realsocket.fileno(), select.POLLOUT)
+  except socket.error:
+    # EBADF, the socket was closed after we got the wakeup
+    if is_closed_handle(commhandle):
+      raise KeyError, "Socket closed"
+    raise
+  pollobj.register(wakeup.readfd, select.POLLIN)
+
+  try:
+    pollobj.poll()
+  except select.error, e:
+    # Interrupted by a signal, the caller will retry
+    if e[0] != errno.EINTR:
+      raise
+
+
+
+# buffer is not available once the user's code is running
+mybuffer = buffer
+
+# How much emulated_socket reads from the real socket at a time.   Smaller 
+# recvs are served from what was read.
+RECV_BUFFER_SIZE = 65536
+
+
 class emulated_socket:
   # This is an index into the comminfo table...
 
@@ -1730,6 +3440,14 @@ class emulated_socket:
   def __init__(self, handle):
     self.commid = handle
 
+    # Data that was read from the real socket but not given to the user yet
+    # starts at recvoffset in recvbuffer.   recvclosed is set once the other
+    # side closes the socket.   recvlock serializes the recv calls.
+    self.recvbuffer = ''
+    self.recvoffset = 0
+    self.recvclosed = False
+    self.recvlock = threading.Lock()
+
     # Armon: Get the real socket
     try:
       realsocket = comminfo[handle]['socket']
@@ -1776,6 +3494,11 @@ class emulated_socket:
     # prevent TOCTOU race with client changing the object's properties
     mycommid = self.commid
     restrictions.assertisallowed('socket.close')
+
+    # A connection opened with reuse is kept open for another openconn.   The
+    # other side doesn't see the close.
+    if park_connection(mycommid, self):
+      return True
     
     # Armon: Semantic update, return whatever stopcomm does.
     # This will result in socket.close() returning a True/False indicator
@@ -1807,36 +3530,203 @@ class emulated_socket:
     mycommid = self.commid
     restrictions.assertisallowed('socket.recv',bytes)
 
+    if bytes < 0:
+      raise ValueError, "negative buffersize in recv"
+
     # I set this here so that I don't screw up accounting with a keyerror later
+    this_is_loopback = self._get_loopback(mycommid)
+
+    self.recvlock.acquire()
+    try:
+      if self.recvoffset == len(self.recvbuffer):
+        self._fill_recv_buffer(mycommid, this_is_loopback)
+
+      datarecvd = self.recvbuffer[self.recvoffset:self.recvoffset + bytes]
+      self.recvoffset = self.recvoffset + len(datarecvd)
+    finally:
+      self.recvlock.release()
+
+    # Armon: Calculate the length of the data
+    data_length = len(datarecvd)
+    
+    # Raise an exception if there was no data
+    if data_length == 0:
+      raise Exception("Socket closed")
+
+    # do accounting here...
+    self._charge_recv(this_is_loopback, data_length)
+
+    return datarecvd
+
+
+
+  def recvuntil(self, delimiter, maxbytes):
+    """
+      <Purpose>
+        Receives data from a socket up to and including a delimiter.
+
+      <Arguments>
+        delimiter:
+           The string that ends the data.
+        maxbytes:
+           The maximum number of bytes to return.   If the delimiter isn't 
+           in the first maxbytes bytes, these bytes are returned.
+
+      <Exceptions>
+        Exception if the socket is closed either locally or remotely before
+        the delimiter (or maxbytes bytes) arrives.   The data that did arrive
+        can still be read with recv.
+
+      <Side Effects>
+        This call will block the thread until the data arrives.
+
+      <Returns>
+        The data received from the socket (as a string), ending with the 
+        delimiter unless maxbytes bytes were returned.
+    """
+    # prevent TOCTOU race with client changing the object's properties
+    mycommid = self.commid
+    restrictions.assertisallowed('socket.recv',maxbytes)
+
+    if delimiter == '':
+      raise ValueError, "The delimiter must not be empty"
+    if maxbytes <= 0:
+      raise ValueError, "maxbytes must be positive"
+
+    this_is_loopback = self._get_loopback(mycommid)
+
+    self.recvlock.acquire()
+    try:
+      # How many of the buffered bytes don't have to be searched again
+      searched = 0
+      while True:
+        index = self.recvbuffer.find(delimiter, self.recvoffset + searched, self.recvoffset + maxbytes)
+        if index != -1:
+          end = index + len(delimiter)
+          break
+
+        available = len(self.recvbuffer) - self.recvoffset
+        if available >= maxbytes:
+          end = self.recvoffset + maxbytes
+          break
+
+        # The delimiter may start in the last few bytes
+        searched = max(0, available - len(delimiter) + 1)
+        self._fill_recv_buffer(mycommid, this_is_loopback)
+
+      datarecvd = self.recvbuffer[self.recvoffset:end]
+      self.recvoffset = end
+    finally:
+      self.recvlock.release()
+
+    self._charge_recv(this_is_loopback, len(datarecvd))
+
+    return datarecvd
+
+
+
+  def recvexactly(self, bytes):
+    """
+      <Purpose>
+        Receives an exact number of bytes from a socket.
+
+      <Arguments>
+        bytes: 
+           The number of bytes to read.
+
+      <Exceptions>
+        Exception if the socket is closed either locally or remotely before
+        all of the bytes arrive.   The data that did arrive can still be read
+        with recv.
+
+      <Side Effects>
+        This call will block the thread until the data arrives.
+
+      <Returns>
+        The data received from the socket (as a string).
+    """
+    # prevent TOCTOU race with client changing the object's properties
+    mycommid = self.commid
+    restrictions.assertisallowed('socket.recv',bytes)
+
+    if bytes < 0:
+      raise ValueError, "negative buffersize in recvexactly"
+
+    this_is_loopback = self._get_loopback(mycommid)
+
+    self.recvlock.acquire()
+    try:
+      # Collect the pieces so that a large recv doesn't copy the data for 
+      # every read
+      datalist = []
+      needed = bytes
+      while True:
+        data = self.recvbuffer[self.recvoffset:self.recvoffset + needed]
+        self.recvoffset = self.recvoffset + len(data)
+        datalist.append(data)
+        needed = needed - len(data)
+        if needed == 0:
+          break
+
+        try:
+          self._fill_recv_buffer(mycommid, this_is_loopback)
+        except:
+          # Put back what was read so the user can still get it
+          self.recvbuffer = ''.join(datalist) + self.recvbuffer[self.recvoffset:]
+          self.recvoffset = 0
+          raise
+    finally:
+      self.recvlock.release()
+
+    datarecvd = ''.join(datalist)
+    self._charge_recv(this_is_loopback, len(datarecvd))
+
+    return datarecvd
+
+
+
+  # Private.   Returns whether the socket is loopback, which is needed for
+  # accounting
+  def _get_loopback(self, mycommid):
     try:
-      this_is_loopback = is_loopback(comminfo[mycommid]['remotehost'])
+      return comminfo[mycommid]['loopback']
     # they likely closed the connection
     except KeyError:
       raise Exception, "Socket closed"
 
+
+
+  # Private.   Charges for the data given to the user
+  def _charge_recv(self, this_is_loopback, data_length):
+    if this_is_loopback:
+      nanny.tattle_quantity('looprecv',data_length)
+    else:
+      nanny.tattle_quantity('netrecv',data_length)
+
+
+
+  # Private.   Reads from the real socket into the receive buffer, blocking
+  # until there is data.   Raises an exception if the socket is closed.  Call
+  # with recvlock held.
+  def _fill_recv_buffer(self, mycommid, this_is_loopback):
+    if self.recvclosed:
+      raise Exception("Socket closed")
+
     # wait if already oversubscribed
     if this_is_loopback:
       nanny.tattle_quantity('looprecv',0)
     else:
       nanny.tattle_quantity('netrecv',0)
 
-    datarecvd = 0
-    # loop until we recv the information (looping is needed for Windows)
+    # loop until we recv the information.   The socket is non-blocking, so 
+    # try the recv first and wait for data only if there isn't any
     while True:
       try:
-        # the timeout is needed so that if the socket is closed in another 
-        # thread, we notice it
-        # BUG: What should the timeout be?   What is the right value?
-        #comminfo[mycommid]['socket'].settimeout(0.2)
-        
         # Armon: Get the real socket
-        realsocket = comminfo[mycommid]['socket']
+        realsocket = get_open_socket(mycommid)
 	
-        # Check if the socket is ready for reading
-        (read_will_block, write_will_block) = socket_state(realsocket, "r", 0.2)	
-        if not read_will_block:
-          datarecvd = realsocket.recv(bytes)
-          break
+        datarecvd = realsocket.recv(RECV_BUFFER_SIZE)
+        break
 
       # they likely closed the connection
       except KeyError:
@@ -1846,34 +3736,44 @@ class emulated_socket:
       except Exception, e:
         # Check if this error is recoverable
         if is_recoverable_network_exception(e):
+          # I'm blocked, so charge anything I've batched up
+          nanny.flush_thread_charges()
+
+          try:
+            wait_for_socket(mycommid, realsocket, "r")
+          except KeyError:
+            raise Exception, "Socket closed"
+          except Exception, e:
+            if is_terminated_connection_exception(e) or is_closed_handle(mycommid):
+              raise Exception("Socket closed")
+            elif not is_recoverable_network_exception(e):
+              raise
           continue
 
         # Otherwise, raise the exception
         else:
-          # Check if this is a connection termination
-          if is_terminated_connection_exception(e):
+          # Check if this is a connection termination, or an error (EBADF)
+          # because the socket was closed in another thread
+          if is_terminated_connection_exception(e) or is_closed_handle(mycommid):
             raise Exception("Socket closed")
           else:
             raise
 
-    # Armon: Calculate the length of the data
-    data_length = len(datarecvd)
-    
-    # Raise an exception if there was no data
-    if data_length == 0:
+    # The other side closed the socket
+    if datarecvd == '':
+      self.recvclosed = True
       raise Exception("Socket closed")
 
-    # do accounting here...
-    if this_is_loopback:
-      nanny.tattle_quantity('looprecv',data_length)
+    # Keep any data that hasn't been given to the user yet
+    if self.recvoffset == len(self.recvbuffer):
+      self.recvbuffer = datarecvd
     else:
-      nanny.tattle_quantity('netrecv',data_length)
-
-    return datarecvd
+      self.recvbuffer = self.recvbuffer[self.recvoffset:] + datarecvd
+    self.recvoffset = 0
 
 
 
-  def send(self,message):
+  def send(self,message,offset=0):
     """
       <Purpose>
         Sends data on a socket.   It may send fewer bytes than requested.   
@@ -1881,9 +3781,14 @@ class emulated_socket:
       <Arguments>
         message:
           The string to send.
+        offset:
+          Where in message to start sending from.   This allows the rest of
+          a message to be sent without copying it (e.g. 
+          sock.send(message, sent)).
 
       <Exceptions>
         Exception if the socket is closed either locally or remotely.
+        ValueError if the offset is not in the message.
 
       <Side Effects>
         This call may block the thread until the other side calls recv.
@@ -1896,14 +3801,58 @@ class emulated_socket:
     mycommid = self.commid
     restrictions.assertisallowed('socket.send',message)
 
+    if offset < 0 or offset > len(message):
+      raise ValueError, "The offset is not in the message"
+
     # I factor this out because we must do the accounting at the bottom of this
     # function and I want to make sure we account properly even if they close 
     # the socket right after their data is sent
     try:
-      this_is_loopback = is_loopback(comminfo[mycommid]['remotehost'])
+      this_is_loopback = comminfo[mycommid]['loopback']
+    except KeyError:
+      raise Exception, "Socket closed!"
+
+    return self._send(mycommid, message, offset, this_is_loopback)
+
+
+
+  def sendall(self,message):
+    """
+      <Purpose>
+        Sends all of the data on a socket.
+
+      <Arguments>
+        message:
+          The string to send.
+
+      <Exceptions>
+        Exception if the socket is closed either locally or remotely.   Some
+        of the data may have been sent.
+
+      <Side Effects>
+        This call may block the thread until the other side calls recv.
+
+      <Returns>
+        None.
+    """
+    # prevent TOCTOU race with client changing the object's properties
+    mycommid = self.commid
+    restrictions.assertisallowed('socket.send',message)
+
+    try:
+      this_is_loopback = comminfo[mycommid]['loopback']
     except KeyError:
       raise Exception, "Socket closed!"
 
+    offset = 0
+    while offset < len(message):
+      offset = offset + self._send(mycommid, message, offset, this_is_loopback)
+
+
+
+  # Private.   Sends part of message starting at offset and returns the number
+  # of bytes sent
+  def _send(self, mycommid, message, offset, this_is_loopback):
     # wait if already oversubscribed
     if this_is_loopback:
       nanny.tattle_quantity('loopsend',0)
@@ -1913,32 +3862,50 @@ class emulated_socket:
     try:
       # Trim the message size to be less than the sendbuffersize.
       # This is a fix for http://support.microsoft.com/kb/823764
-      message = message[:comminfo[mycommid]['sendbuffersize']-1]
+      sendsize = comminfo[mycommid]['sendbuffersize']-1
     except KeyError:
       raise Exception, "Socket closed!"
 
-    # loop until we send the information (looping is needed for Windows)
+    # A buffer refers to the part of the message without copying it.   
+    # Unicode is converted when it's sent, so it is sliced instead
+    if type(message) is str:
+      message = mybuffer(message, offset, sendsize)
+    else:
+      message = message[offset:offset+sendsize]
+
+    # loop until we send the information.   The socket is non-blocking, so 
+    # try the send first and wait only if the buffer is full
     while True:
       try:
         # Armon: Get the real socket
-        realsocket = comminfo[mycommid]['socket']
+        realsocket = get_open_socket(mycommid)
 	
-        # Check if the socket is ready for writing, wait 0.2 seconds
-        (read_will_block, write_will_block) = socket_state(realsocket, "w", 0.2)
-        if not write_will_block:
-          bytessent = realsocket.send(message)
-          break
-      
+        bytessent = realsocket.send(message)
+        break
+
       except KeyError:
         raise Exception, "Socket closed"
 
       except Exception,e:
         # Determine if the exception is fatal
         if is_recoverable_network_exception(e):
+          # I'm blocked, so charge anything I've batched up
+          nanny.flush_thread_charges()
+
+          try:
+            wait_for_socket(mycommid, realsocket, "w")
+          except KeyError:
+            raise Exception, "Socket closed"
+          except Exception, e:
+            if is_terminated_connection_exception(e) or is_closed_handle(mycommid):
+              raise Exception("Socket closed")
+            elif not is_recoverable_network_exception(e):
+              raise
           continue
         else:
-          # Check if this is a conn. term., and give a more specific exception.
-          if is_terminated_connection_exception(e):
+          # Check if this is a conn. term. (or the socket was closed in 
+          # another thread), and give a more specific exception.
+          if is_terminated_connection_exception(e) or is_closed_handle(mycommid):
             raise Exception("Socket closed")
           else:
             raise
@@ -1967,10 +3934,16 @@ class emulated_socket:
 
     try:
       # Get the real socket
-      realsocket = comminfo[self.commid]['socket']
+      realsocket = get_open_socket(self.commid)
 
       # Call into socket_state with no timout to return instantly
-      return socket_state(realsocket)
+      (recv_will_block, send_will_block) = socket_state(realsocket)
+
+      # recv won't block if there is data that was already read
+      if self.recvoffset < len(self.recvbuffer):
+        recv_will_block = False
+
+      return (recv_will_block, send_will_block)
     
     # The socket is closed or in the process of being closed...
     except KeyError:
@@ -1978,7 +3951,7 @@ class emulated_socket:
 
     except Exception, e:
       # Determine if the socket is closed
-      if is_terminated_connection_exception(e):
+      if is_terminated_connection_exception(e) or is_closed_handle(self.commid):
         raise Exception("Socket closed")
       
       # Otherwise raise whatever we have
@@ -12,6 +12,8 @@
 
 import restrictions
 import nanny
+# needed for the disk used per file
+import repy_constants
 # needed for listdir and remove
 import os 
 import idhelper
@@ -88,7 +90,11 @@ def removefile(filename):
       if filename == fileinfo[filehandle]['filename']:
         raise Exception, 'File "'+filename+'" is open with handle "'+filehandle+'"'
 
+    filesize = os.path.getsize(filename)
     result = os.remove(filename)
+
+    # Give back the space the file used
+    nanny.tattle_disk_change(-(filesize + repy_constants.DISK_USE_PER_FILE))
   finally:
     fileinfolock.release()
 
@@ -153,7 +159,12 @@ def emulated_open(filename, mode="rb"):
 
   elif mode == "w" or mode == "w+":
     file_object = emulated_file(filename, "rw", create=True)
-    fileinfo[file_object.filehandle]['fobj'].truncate()
+    thisfileinfo = fileinfo[file_object.filehandle]
+    thisfileinfo['fobj'].truncate()
+
+    # Give back the space the old contents used
+    nanny.tattle_disk_change(-thisfileinfo['size'])
+    thisfileinfo['size'] = 0
 
   elif mode == "a" or mode == "a+":
     file_object = emulated_file(filename, "rw", create=True)
@@ -173,6 +184,18 @@ fileinfo = {}
 fileinfolock = threading.Lock()
 
 
+# Charges for the space a write of writeamt bytes at the current position 
+# will add to the file.   Raises KeyError if the file is closed and an 
+# Exception if there isn't enough disk left.
+def _charge_disk_for_write(filehandle, writeamt):
+  thisfileinfo = fileinfo[filehandle]
+
+  endposition = thisfileinfo['fobj'].tell() + writeamt
+  if endposition > thisfileinfo['size']:
+    nanny.tattle_disk_change(endposition - thisfileinfo['size'])
+    thisfileinfo['size'] = endposition
+
+
 # Checks the filename for disallowed characters and raises an error if it 
 # exists
 # JAC: THIS IS TURNED INTO A NO-OP BY REPYPORTABILITY / REPYHELPER!!!
@@ -302,16 +325,28 @@ class emulated_file:
         # Create a file by opening it in write mode and then closing it.
         restrictions.assertisallowed('file.__init__', filename, 'wb')
 
+        # Every file is charged some disk space, even if it is empty
+        nanny.tattle_disk_change(repy_constants.DISK_USE_PER_FILE)
+
         # Allocate a resource.
         try:
           nanny.tattle_add_item('filesopened', self.filehandle)
         except Exception:
           # Ok, maybe we can free up a file by garbage collecting.
-          gc.collect()
-          nanny.tattle_add_item('filesopened', self.filehandle)
+          try:
+            gc.collect()
+            nanny.tattle_add_item('filesopened', self.filehandle)
+          except:
+            nanny.tattle_disk_change(-repy_constants.DISK_USE_PER_FILE)
+            raise
 
         # Create the file, and then free up the resource.
-        created_file = myfile(filename, 'wb')
+        try:
+          created_file = myfile(filename, 'wb')
+        except:
+          nanny.tattle_disk_change(-repy_constants.DISK_USE_PER_FILE)
+          nanny.tattle_remove_item('filesopened', self.filehandle)
+          raise
         created_file.close()
         nanny.tattle_remove_item('filesopened', self.filehandle)
 
@@ -329,8 +364,10 @@ class emulated_file:
         gc.collect()
         nanny.tattle_add_item('filesopened', self.filehandle)
 
+      # The size is kept so that writes can be charged for the disk they use
       fileinfo[self.filehandle] = {'filename':filename, \
-          'mode':actual_mode, 'fobj':myfile(filename, actual_mode)}
+          'mode':actual_mode, 'fobj':myfile(filename, actual_mode), \
+          'size':os.path.getsize(filename)}
       self.name = filename
       self.mode = mode
 
@@ -483,15 +520,17 @@ class emulated_file:
     # wait if it's already over used
     nanny.tattle_quantity('filewrite',0)
 
+    writeamt = len(str(writeitem))
+
     if "w" in self.mode:
       try:
+        _charge_disk_for_write(myfilehandle, writeamt)
         retval = fileinfo[myfilehandle]['fobj'].write(writeitem)
       except KeyError:
         raise ValueError("Invalid file object (probably closed).")
     else:
       raise ValueError("write() isn't allowed on read-only file objects!")
 
-    writeamt = len(str(writeitem))
     nanny.tattle_quantity('filewrite',writeamt)
 
     return retval
@@ -515,6 +554,7 @@ class emulated_file:
 
     for writeitem in writelist:
       strtowrite = str(writeitem)
+      _charge_disk_for_write(myfilehandle, len(strtowrite))
       fileinfo[myfilehandle]['fobj'].write(strtowrite)
       nanny.tattle_quantity('filewrite', len(strtowrite))
 
@@ -9,7 +9,6 @@
    cancelling timers.
 """
 
-import threading
 import thread # Armon: this is to catch thread.error
 import time
 import restrictions
@@ -25,6 +24,9 @@ import tracebackrepy
 # for harshexit
 import harshexit
 
+# the timers are run by threads from the eventpool
+import eventpool
+
 
 timerinfo = {}
 # Table of timer structures:
@@ -94,6 +96,9 @@ def sleep(seconds):
   """
 
   restrictions.assertisallowed('sleep',seconds)
+
+  # Charge anything I've batched up before I go idle
+  nanny.flush_thread_charges()
   
   # Use the do_sleep implementation in misc
   misc.do_sleep(seconds)
@@ -132,10 +137,8 @@ def settimer(waittime, function, args):
 
   nanny.tattle_add_item('events',eventhandle)
 
-  tobj = threading.Timer(waittime,functionwrapper,[function] + [eventhandle] + [args])
-
-  # Set the name of the thread
-  tobj.setName(idhelper.get_new_thread_name(EVENT_PREFIX))
+  # The thread that runs the function will be named with EVENT_PREFIX
+  tobj = eventpool.EventTimer(waittime,functionwrapper,[function] + [eventhandle] + [args], EVENT_PREFIX)
 
   timerinfo[eventhandle] = {'timer':tobj}
   
@@ -171,6 +174,9 @@ def functionwrapper(func, timerhandle, args):
     # Exit if they throw an uncaught exception
     tracebackrepy.handle_exception()
     harshexit.harshexit(30)
+
+  # charge anything that was batched up during the event
+  nanny.flush_thread_charges()
     
   # remove the event before I exit
   nanny.tattle_remove_item('events',timerhandle)
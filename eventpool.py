@@ -0,0 +1,313 @@
+"""
+   Author: agent
+
+   Start Date: 18 October 2026
+
+   Description:
+
+   A pool of threads that run the user's events (incoming messages, incoming
+   connections and timers).   Starting a new thread for every event is
+   expensive when a lot of messages arrive, so the threads are kept around
+   and reused.
+
+   The number of threads is bounded by the 'events' resource limit.   The
+   caller must already hold an event (nanny.tattle_add_item('events',...))
+   for each event it queues, so there are never more events to run than
+   threads.
+
+   Timers are kept in a heap that a single thread waits on.   When a timer
+   expires, its function is queued to the pool.
+
+   The pool threads are daemon threads and are never stopped.   repy.py uses
+   get_idle_thread_count() so that they don't keep the program from exiting.
+"""
+
+import threading
+import thread # to catch thread.error
+import heapq
+
+# So that events can be run in FIFO order
+import collections
+
+# To give each event a unique thread name
+import idhelper
+
+# To get the limit on the number of events
+import nanny_resource_limits
+
+# For the time the timers expire
+import nonportable
+
+# For printing exceptions
+import tracebackrepy
+
+# For harshexit if a thread can't be started
+import harshexit
+
+# To clear the API call throttle waits are attributed to after each event
+import nanny
+
+
+# The pool threads are named with this prefix until they run an event.   The
+# name is changed to one with the event's prefix before each event is run
+POOL_PREFIX = "_POOL:"
+
+# Protects all of the state below.   The pool threads wait on the condition
+# for events to be queued
+pool_lock = threading.Lock()
+pool_condition = threading.Condition(pool_lock)
+
+# The events that are waiting for a thread.   Each is a tuple
+# (function, args, threadprefix)
+pending_events = collections.deque()
+
+# How many pool threads there are and how many are waiting for an event.
+# I'm using lists because I need globals, but don't want to use the global
+# keyword.
+pool_thread_count = [0]
+idle_thread_count = [0]
+
+
+# Private.   How many threads the pool may have
+def _get_max_pool_threads():
+  try:
+    return nanny_resource_limits.resource_limit('events')
+  except KeyError:
+    # The restrictions weren't loaded, so there isn't a limit
+    return None
+
+
+
+# A thread that runs events from the pool until the program exits
+class EventThread(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self, name=idhelper.get_new_thread_name(POOL_PREFIX))
+    self.setDaemon(True)
+
+
+  def run(self):
+    while True:
+      (function, args, threadprefix) = self.get_next_event()
+
+      # Every event gets a unique thread name, just as if it had its own
+      # thread
+      self.setName(idhelper.get_new_thread_name(threadprefix))
+
+      try:
+        function(*args)
+      except:
+        # The functions that are queued do their own error handling, so this
+        # is a bug.
+        tracebackrepy.handle_internalerror("Uncaught exception in an event thread", 88)
+
+      # The next event shouldn't be attributed to a call this one made
+      nanny.set_api_call(None)
+
+
+  # Wait until there is an event to run and return it
+  def get_next_event(self):
+    pool_condition.acquire()
+    try:
+      idle_thread_count[0] = idle_thread_count[0] + 1
+      while not pending_events:
+        pool_condition.wait()
+      idle_thread_count[0] = idle_thread_count[0] - 1
+
+      return pending_events.popleft()
+    finally:
+      pool_condition.release()
+
+
+
+def queue_event(function, args, threadprefix):
+  """
+  <Purpose>
+    Runs a function in a thread from the pool.
+
+  <Arguments>
+    function:
+      The function to call.
+    args:
+      A tuple or list of arguments to pass to the function.
+    threadprefix:
+      The prefix for the name of the thread while it runs the function (e.g.
+      emulcomm.COMM_PREFIX).
+
+  <Exceptions>
+    thread.error if a new thread is needed but can't be started.
+
+  <Side Effects>
+    May start a new pool thread.   The function should do its own exception
+    handling, an exception that escapes is treated as an internal error.
+
+  <Returns>
+    None.
+  """
+  pool_condition.acquire()
+  try:
+    pending_events.append((function, args, threadprefix))
+
+    # If there is an idle thread, wake it up.   Otherwise add a thread unless
+    # the pool is full, in which case the event waits for a thread to finish
+    maxthreads = _get_max_pool_threads()
+    if idle_thread_count[0] >= len(pending_events) or \
+        (maxthreads is not None and pool_thread_count[0] >= maxthreads):
+      pool_condition.notify()
+      return
+
+    try:
+      EventThread().start()
+    except thread.error:
+      pending_events.pop()
+      raise
+
+    pool_thread_count[0] = pool_thread_count[0] + 1
+  finally:
+    pool_condition.release()
+
+
+
+
+#### Timers
+
+# Protects the timer heap.   The timer thread waits on the condition for the
+# next timer to expire or a new timer to be added
+timer_lock = threading.Lock()
+timer_condition = threading.Condition(timer_lock)
+
+# A heap of [expiretime, sequence number, EventTimer].   The sequence number
+# keeps timers that expire at the same time in the order they were set
+timer_heap = []
+timer_sequence = [0]
+
+# The thread that waits on the heap, None until the first timer is set
+timer_thread = [None]
+
+
+# Runs a function in a pool thread after a delay.   This has the same
+# interface as threading.Timer.   A background timer is for repy's own 
+# housekeeping: it doesn't keep the program from exiting and the caller 
+# doesn't need to hold an event for it.
+class EventTimer:
+
+  def __init__(self, waittime, function, args, threadprefix, background=False):
+    self.waittime = waittime
+    self.function = function
+    self.args = args
+    self.threadprefix = threadprefix
+    self.background = background
+
+
+  # Add the timer to the heap
+  def start(self):
+    expiretime = nonportable.getruntime() + self.waittime
+
+    timer_condition.acquire()
+    try:
+      if timer_thread[0] is None:
+        newthread = TimerThread()
+        newthread.start()
+        timer_thread[0] = newthread
+
+      heapq.heappush(timer_heap, [expiretime, timer_sequence[0], self])
+      timer_sequence[0] = timer_sequence[0] + 1
+
+      # The timer thread may need to wake up earlier
+      timer_condition.notify()
+    finally:
+      timer_condition.release()
+
+
+  # Remove the timer from the heap if it hasn't expired
+  def cancel(self):
+    timer_condition.acquire()
+    try:
+      for index in xrange(len(timer_heap)):
+        if timer_heap[index][2] is self:
+          del timer_heap[index]
+          heapq.heapify(timer_heap)
+
+          # So the timer thread doesn't wait for a timer that was removed
+          timer_condition.notify()
+          break
+    finally:
+      timer_condition.release()
+
+
+
+# Waits for timers to expire and queues them to the pool
+class TimerThread(threading.Thread):
+
+  def __init__(self):
+    threading.Thread.__init__(self, name=idhelper.get_new_thread_name(POOL_PREFIX))
+    self.setDaemon(True)
+
+
+  def run(self):
+    # The expired timer is queued with the lock held, so that 
+    # get_idle_thread_count always sees it in either the heap or the pool
+    timer_condition.acquire()
+    try:
+      while True:
+        if not timer_heap:
+          timer_condition.wait()
+          continue
+
+        waittime = timer_heap[0][0] - nonportable.getruntime()
+        if waittime > 0:
+          timer_condition.wait(waittime)
+          continue
+
+        timerobj = heapq.heappop(timer_heap)[2]
+        try:
+          queue_event(timerobj.function, timerobj.args, timerobj.threadprefix)
+        except thread.error:
+          # Set exit code 56, which stands for a Threading Error
+          # The Node manager will detect this and handle it
+          harshexit.harshexit(56)
+    finally:
+      timer_condition.release()
+
+
+
+def get_idle_thread_count():
+  """
+  <Purpose>
+    Returns the number of threads that belong to the pool but have nothing
+    to do.   repy.py uses this to tell when the program is finished.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The number of idle threads.
+  """
+  # The locks are acquired in the same order as the timer thread does
+  timer_condition.acquire()
+  try:
+    pool_condition.acquire()
+    try:
+      # Idle threads that haven't picked up a queued event yet aren't idle
+      idlecount = max(0, idle_thread_count[0] - len(pending_events))
+    finally:
+      pool_condition.release()
+
+    # The timer thread is idle if there are no timers, other than 
+    # background timers
+    if timer_thread[0] is not None:
+      for (expiretime, sequence, timerobj) in timer_heap:
+        if not timerobj.background:
+          break
+      else:
+        idlecount = idlecount + 1
+  finally:
+    timer_condition.release()
+
+  return idlecount
@@ -37,6 +37,10 @@ osrealtype = None
 # global   (the purpose of this is described below)
 statusexiting = [False]
 
+# Functions (with no arguments) to call the first time harshexit is called, 
+# e.g. to write out statistics.   These shouldn't block.
+exitfunctions = []
+
 
 
 class UnsupportedSystemException(Exception):
@@ -109,6 +113,12 @@ def harshexit(val):
       # generic error, normal exit, or exitall in the user code...
       statusstorage.write_status("Terminated")
 
+    for exitfunction in exitfunctions:
+      try:
+        exitfunction()
+      except:
+        pass
+
     # We intentionally do not release the lock.   We don't want anyone else 
     # writing over our status information (we're killing them).
     
@@ -11,14 +11,20 @@ Description:
 
 import os           # Provides some convenience functions
 
+import ctypes       # Needed for clock_gettime
+import ctypes.util  # Helps to find librt
+
 import nix_common_api as nix_api # Import the Common API
 
 import textops      # Import seattlelib's text processing lib
 import portable_popen  # For Popen
 
+import socket       # To convert IP addresses for /proc/net
+import struct       # To convert IP addresses for /proc/net
+import fcntl        # For the SIOCGIFCONF ioctl
+import errno        # To check for a netlink overrun
+
 # Manually import the common functions we want
-exists_outgoing_network_socket = nix_api.exists_outgoing_network_socket
-exists_listening_network_socket = nix_api.exists_listening_network_socket
 get_available_interfaces = nix_api.get_available_interfaces
 
 # Libc
@@ -28,13 +34,70 @@ libc = nix_api.libc
 myopen = open # This is an annoying restriction of repy
 syscall = libc.syscall # syscall function
 
+# clock_gettime and friends are in librt on older versions of glibc
+try:
+  clock_gettime = libc.clock_gettime
+  clock_getcpuclockid = libc.clock_getcpuclockid
+except AttributeError:
+  librt = ctypes.CDLL(ctypes.util.find_library("rt"))
+  clock_gettime = librt.clock_gettime
+  clock_getcpuclockid = librt.clock_getcpuclockid
+
+# sendmmsg was added in glibc 2.14.   The errno is read with ctypes.get_errno,
+# which needs a library loaded with use_errno (python 2.6 and later)
+try:
+  libc_errno = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  libc_sendmmsg = libc_errno.sendmmsg
+except (TypeError, AttributeError):
+  libc_sendmmsg = None
+
 # Globals
 last_stat_data = None   # Store the last array of data from _get_proc_info_by_pid
+netlink_socket = None   # The rtnetlink socket, created by interface_addresses_changed
+netlink_unavailable = False # Set if the rtnetlink socket can't be created
+cpu_clock_ids = {}      # Maps a pid to the id of its CPU clock
 
 # Constants
 JIFFIES_PER_SECOND = 100.0
 PAGE_SIZE = os.sysconf('SC_PAGESIZE')
 GETTID = 224 # Get the thread id of the currently executing thread
+CLOCK_MONOTONIC = 1 # Clock that cannot be set and is not affected by NTP
+CLOCK_PROCESS_CPUTIME_ID = 2 # CPU clock for the calling process
+
+SIOCGIFCONF = 0x8912 # ioctl to list the interfaces and their IPv4 addresses
+IFREQ_NAME_SIZE = 16 # The size of the interface name in struct ifreq
+# The size of struct ifreq, which is bigger on 64 bit systems
+if struct.calcsize("P") == 8:
+  IFREQ_SIZE = 40
+else:
+  IFREQ_SIZE = 32
+
+TCP_INFO = 11 # getsockopt option that returns struct tcp_info
+TCP_INFO_SIZE = 104 # Enough of struct tcp_info for the fields we use
+# For a listening socket, tcpi_unacked is the number of connections waiting
+# to be accepted and tcpi_sacked is the backlog.   These are the two 32 bit
+# fields after 8 bytes of flags and four other 32 bit fields.
+TCP_INFO_ACCEPT_QUEUE_OFFSET = 24
+
+NETLINK_ROUTE = 0 # rtnetlink, which sends notifications about the interfaces
+RTMGRP_LINK = 0x1 # Notifications that an interface was added, removed or changed
+RTMGRP_IPV4_IFADDR = 0x10 # Notifications that an IPv4 address was added or removed
+
+# Maps the state numbers in /proc/net/tcp to the names netstat uses
+TCP_STATES = {
+1:"ESTABLISHED",
+2:"SYN_SENT",
+3:"SYN_RECV",
+4:"FIN_WAIT1",
+5:"FIN_WAIT2",
+6:"TIME_WAIT",
+7:"CLOSE",
+8:"CLOSE_WAIT",
+9:"LAST_ACK",
+10:"LISTEN",
+11:"CLOSING"
+}
+TCP_LISTEN_STATE = 10
 
 # Maps each field in /proc/{pid}/stat to an index when split by spaces
 FIELDS = {
@@ -183,6 +246,35 @@ def get_process_rss(force_update=False, pid=None):
   return rss_bytes
 
 
+def get_process_virtual_memory(pid):
+  """
+  <Purpose>
+    Returns the virtual memory size and the size of the data segment (private
+    writable memory, including the heap and thread stacks) of a process.
+
+  <Arguments>
+    pid: The process identifier for the process to query.
+
+  <Exceptions>
+    An exception will be raised if the sizes cannot be read.
+
+  <Returns>
+    A tuple (virtual size, data size) in bytes.
+  """
+  fileo = myopen("/proc/"+str(pid)+"/status","r")
+  lines = fileo.readlines()
+  fileo.close()
+
+  sizes = {}
+  for line in lines:
+    # Lines look like "VmData:     1234 kB"
+    fields = line.split()
+    if len(fields) == 3 and fields[0] in ["VmSize:", "VmData:"]:
+      sizes[fields[0]] = int(fields[1]) * 1024
+
+  return (sizes["VmSize:"], sizes["VmData:"])
+
+
 # Get the id of the currently executing thread
 def _get_current_thread_id():
   # Syscall for GETTID
@@ -223,6 +315,101 @@ def get_current_thread_cpu_time():
   return total_time
 
 
+# Structure for clock_gettime
+class _timespec(ctypes.Structure):
+  _fields_ = [("tv_sec", ctypes.c_long),
+              ("tv_nsec", ctypes.c_long)]
+
+
+# Reads a clock with clock_gettime, returns the time in seconds
+def _clock_gettime(clock_id):
+  timespec = _timespec()
+
+  if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+    raise Exception, "clock_gettime failed for clock "+str(clock_id)+"!"
+
+  return timespec.tv_sec + timespec.tv_nsec / 1000000000.0
+
+
+# Get the id of the CPU clock of a process
+def _get_process_cpu_clock_id(pid):
+  # Use the cached value if possible
+  if pid in cpu_clock_ids:
+    return cpu_clock_ids[pid]
+
+  if pid == os.getpid():
+    clock_id = CLOCK_PROCESS_CPUTIME_ID
+
+  else:
+    clock_id_value = ctypes.c_int()
+    error = clock_getcpuclockid(pid, ctypes.byref(clock_id_value))
+    if error != 0:
+      raise Exception, "clock_getcpuclockid failed for pid "+str(pid)+"! Error: "+str(error)
+    clock_id = clock_id_value.value
+
+  cpu_clock_ids[pid] = clock_id
+  return clock_id
+
+
+# Read the CPU time of a process from /proc/PID/schedstat
+def _get_process_schedstat_cpu_time(pid):
+  fileo = myopen("/proc/"+str(pid)+"/schedstat","r")
+  data = fileo.read()
+  fileo.close()
+
+  # The first field is the time spent on the cpu in nanoseconds
+  return int(data.split(" ")[0]) / 1000000000.0
+
+
+def get_precise_process_cpu_time(pid):
+  """
+  <Purpose>
+    Returns the total CPU time used by a process with nanosecond resolution,
+    rather than the jiffy resolution of get_process_cpu_time.   The CPU clock
+    of the process is used if possible, then /proc/PID/schedstat.   If neither
+    is available this falls back to get_process_cpu_time.
+    
+  <Arguments>
+    pid: The process identifier for the process to query.
+
+  <Exceptions>
+    An exception will be raised if the process has died.
+  
+  <Returns>
+    The total cpu time.
+  """
+  try:
+    return _clock_gettime(_get_process_cpu_clock_id(pid))
+  except Exception:
+    # The process may have died, don't keep using the old clock
+    if pid in cpu_clock_ids:
+      del cpu_clock_ids[pid]
+
+  try:
+    return _get_process_schedstat_cpu_time(pid)
+  except (IOError, OSError, ValueError):
+    pass
+
+  # This will raise an exception if the process is gone
+  return get_process_cpu_time(pid)
+
+
+def get_monotonic_time():
+  """
+  <Purpose>
+    Returns the time of a high resolution clock that only moves forward and is
+    not affected by NTP resets.   This is only useful for measuring elapsed 
+    time.
+
+  <Exceptions>
+    An exception will be raised if the clock is unavailable.
+
+  <Returns>
+    A floating amount of time in seconds.
+  """
+  return _clock_gettime(CLOCK_MONOTONIC)
+
+
 def get_system_uptime():
   """
   <Purpose>
@@ -306,6 +493,97 @@ def get_system_thread_count():
 
 
 
+def get_interface_addresses():
+  """
+  <Purpose>
+    Returns the IPv4 addresses of all of the interfaces that are up, using 
+    the SIOCGIFCONF ioctl.   Aliases (e.g. eth0:1) are separate interfaces.
+
+  <Exceptions>
+    IOError if the ioctl fails.
+
+  <Returns>
+    A dictionary mapping each interface name to a list of its IP addresses.
+  """
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    # If the buffer is filled there may be more interfaces, so try again 
+    # with a bigger one
+    buffersize = IFREQ_SIZE * 32
+    while True:
+      ifreqbuffer = ctypes.create_string_buffer(buffersize)
+      ifconf = struct.pack("iP", buffersize, ctypes.addressof(ifreqbuffer))
+      ifconf = fcntl.ioctl(sock.fileno(), SIOCGIFCONF, ifconf)
+      length = struct.unpack("iP", ifconf)[0]
+      if length < buffersize:
+        break
+      buffersize = buffersize * 2
+  finally:
+    sock.close()
+
+  data = ifreqbuffer.raw[:length]
+
+  # Each struct ifreq has the name, then a struct sockaddr_in (the family and
+  # port are 4 bytes, then the address)
+  interfaces = {}
+  for offset in xrange(0, length - IFREQ_SIZE + 1, IFREQ_SIZE):
+    name = data[offset:offset + IFREQ_NAME_SIZE].split("\0")[0]
+    ipoffset = offset + IFREQ_NAME_SIZE + 4
+    ip = socket.inet_ntoa(data[ipoffset:ipoffset + 4])
+
+    if name not in interfaces:
+      interfaces[name] = []
+    if ip not in interfaces[name]:
+      interfaces[name].append(ip)
+
+  return interfaces
+
+
+
+def interface_addresses_changed():
+  """
+  <Purpose>
+    Checks if the kernel sent a notification that an interface or IPv4 
+    address was added, removed or changed since the last call.   This 
+    listens on an rtnetlink socket, which is created on the first call.
+
+  <Returns>
+    True if something changed (or this is the first call), False if not.
+    None if the notifications aren't available.
+  """
+  global netlink_socket
+  global netlink_unavailable
+
+  if netlink_unavailable:
+    return None
+
+  if netlink_socket is None:
+    try:
+      newsocket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+      newsocket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+      newsocket.setblocking(0)
+    except (socket.error, AttributeError):
+      netlink_unavailable = True
+      return None
+
+    netlink_socket = newsocket
+    return True
+
+  # Read all of the notifications.   Their contents don't matter.
+  changed = False
+  while True:
+    try:
+      netlink_socket.recv(65536)
+    except socket.error, e:
+      # If notifications were dropped, something changed
+      if e[0] == errno.ENOBUFS:
+        changed = True
+        continue
+      return changed
+    changed = True
+
+
+
 def get_interface_ip_addresses(interfaceName):
   """
   <Purpose>
@@ -317,6 +595,15 @@ def get_interface_ip_addresses(interfaceName):
   <Returns>
     A list of IP addresses associated with the interface.
   """
+  try:
+    interfaces = get_interface_addresses()
+  except IOError:
+    # Use ifconfig instead
+    pass
+  else:
+    if interfaceName.strip() in interfaces:
+      return interfaces[interfaceName.strip()]
+    return []
 
   # Launch up a shell, get the feed back
   # We use ifconfig with the interface name.
@@ -344,3 +631,235 @@ def get_interface_ip_addresses(interfaceName):
 
   # Done, return the interfaces
   return ipaddressList
+
+
+
+# Converts an IP and port to the form used in /proc/net/tcp and udp, e.g.
+# 127.0.0.1:80 is 0100007F:0050.   The kernel prints the address as a number
+# in host byte order.   Raises socket.error if the IP isn't valid
+def _get_proc_net_address(ip, port):
+  packedip = socket.inet_aton(ip)
+  return "%08X:%04X" % (struct.unpack("=I", packedip)[0], port)
+
+
+# Reads /proc/net/tcp or /proc/net/udp and returns a list of 
+# (local address, remote address, state number) for each socket.   Returns
+# None if the file can't be read
+def _read_proc_net_sockets(protocol):
+  try:
+    fileo = myopen("/proc/net/"+protocol, "r")
+  except IOError:
+    return None
+
+  try:
+    data = fileo.read()
+  finally:
+    fileo.close()
+
+  socketlist = []
+  # The first line is a header
+  for line in data.split("\n")[1:]:
+    fields = line.split()
+    if len(fields) < 4:
+      continue
+    socketlist.append((fields[1], fields[2], int(fields[3], 16)))
+
+  return socketlist
+
+
+def exists_outgoing_network_socket(localip, localport, remoteip, remoteport):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified unique tuple.
+    Assumes TCP.   This reads /proc/net/tcp, and uses netstat if it can't.
+
+  <Arguments>
+    localip: The IP address of the local socket
+    localport: The port of the local socket
+    remoteip:  The IP of the remote host
+    remoteport: The port of the remote host
+    
+  <Returns>
+    A Tuple, indicating the existence and state of the socket. E.g. (Exists (True/False), State (String or None))
+
+  """
+  # This only works if all are not of the None type
+  if not (localip and localport and remoteip and remoteport):
+    return (False, None)
+
+  try:
+    localaddress = _get_proc_net_address(localip, localport)
+    remoteaddress = _get_proc_net_address(remoteip, remoteport)
+  except socket.error:
+    # Not an IP address, so there can't be a socket with it
+    return (False, None)
+
+  socketlist = _read_proc_net_sockets("tcp")
+  if socketlist is None:
+    return nix_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  for (local, remote, state) in socketlist:
+    if local == localaddress and remote == remoteaddress:
+      if state in TCP_STATES:
+        return (True, TCP_STATES[state])
+      return (True, str(state))
+
+  return (False, None)
+
+
+
+def exists_listening_network_socket(ip, port, tcp):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified ip and port which is the LISTEN state.
+    This reads /proc/net/tcp or /proc/net/udp, and uses netstat if it can't.
+  
+  <Arguments>
+    ip: The IP address of the listening socket
+    port: The port of the listening socket
+    tcp: Is the socket of TCP type, else UDP
+    
+  <Returns>
+    True or False.
+  """
+  # This only works if both are not of the None type
+  if not (ip and port):
+    return False
+
+  try:
+    address = _get_proc_net_address(ip, port)
+  except socket.error:
+    # Not an IP address, so there can't be a socket with it
+    return False
+
+  if tcp:
+    socketlist = _read_proc_net_sockets("tcp")
+  else:
+    socketlist = _read_proc_net_sockets("udp")
+
+  if socketlist is None:
+    return nix_api.exists_listening_network_socket(ip, port, tcp)
+
+  # UDP connections are stateless, so for TCP check for the LISTEN state
+  # and for UDP, just check that there exists a UDP port
+  for (local, remote, state) in socketlist:
+    if local == address and (not tcp or state == TCP_LISTEN_STATE):
+      return True
+
+  return False
+
+
+
+# Structures for sendmmsg
+class _sockaddr_in(ctypes.Structure):
+  _fields_ = [("sin_family", ctypes.c_ushort),
+              ("sin_port", ctypes.c_ushort),
+              ("sin_addr", ctypes.c_uint),
+              ("sin_zero", ctypes.c_char * 8)]
+
+class _iovec(ctypes.Structure):
+  _fields_ = [("iov_base", ctypes.c_void_p),
+              ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+  _fields_ = [("msg_name", ctypes.c_void_p),
+              ("msg_namelen", ctypes.c_uint),
+              ("msg_iov", ctypes.POINTER(_iovec)),
+              ("msg_iovlen", ctypes.c_size_t),
+              ("msg_control", ctypes.c_void_p),
+              ("msg_controllen", ctypes.c_size_t),
+              ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+  _fields_ = [("msg_hdr", _msghdr),
+              ("msg_len", ctypes.c_uint)]
+
+
+def sendmmsg_supported():
+  """
+  <Purpose>
+    Determines if send_udp_messages can be used.
+
+  <Returns>
+    True if libc has sendmmsg, False otherwise.
+  """
+  return libc_sendmmsg is not None
+
+
+def send_udp_messages(sockfd, messagelist):
+  """
+  <Purpose>
+    Sends several UDP messages with a single sendmmsg call.
+
+  <Arguments>
+    sockfd: The file descriptor of an IPv4 UDP socket
+    messagelist: A list of (ip, port, message).   The ip must be an IP
+                 address, not a host name
+
+  <Exceptions>
+    socket.error if the first message can't be sent or an ip isn't valid.
+
+  <Returns>
+    A list with the number of bytes sent for each message that was sent.
+    This is shorter than messagelist if the kernel stopped early, e.g.
+    because of an error sending the next message.
+  """
+  count = len(messagelist)
+  addresses = (_sockaddr_in * count)()
+  iovecs = (_iovec * count)()
+  headers = (_mmsghdr * count)()
+
+  # The buffers point into the message strings, so keep a reference to them
+  # until the call returns
+  buffers = []
+
+  for index in xrange(count):
+    (ip, port, message) = messagelist[index]
+
+    addresses[index].sin_family = socket.AF_INET
+    addresses[index].sin_port = socket.htons(port)
+    # The address is kept in network byte order
+    addresses[index].sin_addr = struct.unpack("=I", socket.inet_aton(ip))[0]
+
+    messagebuffer = ctypes.c_char_p(message)
+    buffers.append(messagebuffer)
+    iovecs[index].iov_base = ctypes.cast(messagebuffer, ctypes.c_void_p)
+    iovecs[index].iov_len = len(message)
+
+    header = headers[index].msg_hdr
+    header.msg_name = ctypes.cast(ctypes.byref(addresses[index]), ctypes.c_void_p)
+    header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+    header.msg_iov = ctypes.pointer(iovecs[index])
+    header.msg_iovlen = 1
+
+  sentcount = libc_sendmmsg(sockfd, headers, count, 0)
+  if sentcount < 0:
+    errnum = ctypes.get_errno()
+    raise socket.error(errnum, os.strerror(errnum))
+
+  sentlist = []
+  for index in xrange(sentcount):
+    sentlist.append(headers[index].msg_len)
+  return sentlist
+
+
+
+def get_accept_queue_length(sock):
+  """
+  <Purpose>
+    Returns how many connections are waiting to be accepted on a listening
+    TCP socket, and how many may wait.
+
+  <Arguments>
+    sock: A listening TCP socket
+
+  <Exceptions>
+    socket.error if the kernel doesn't support TCP_INFO.
+
+  <Returns>
+    A tuple (queued, backlog).
+  """
+  tcpinfo = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_SIZE)
+  if len(tcpinfo) < TCP_INFO_ACCEPT_QUEUE_OFFSET + 8:
+    raise socket.error("TCP_INFO is too short")
+  return struct.unpack_from("=II", tcpinfo, TCP_INFO_ACCEPT_QUEUE_OFFSET)
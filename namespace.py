@@ -115,6 +115,9 @@ import emultimer
 import emulcomm
 import emulmisc
 
+# To restore the API call throttle waits are attributed to
+import nanny
+
 # Used to get SafeDict
 import safe
 
@@ -393,6 +396,20 @@ def allow_return_gethostbyname_ex(retval):
 
 
 
+def allow_args_gethostbyname_ex_batch(namelist):
+  _require_list_of_strings(namelist)
+
+
+
+def allow_return_gethostbyname_ex_batch(retval):
+  _require_list(retval)
+  for item in retval:
+    # A string is the error for a name that couldn't be looked up
+    if type(item) is not str:
+      allow_return_gethostbyname_ex(item)
+
+
+
 def allow_args_recvmess_callback(remoteIP, remoteport, message, commhandle):
   # The callback function should receive the following arguments:
   # (remoteIP, remoteport, message, commhandle)
@@ -464,7 +481,25 @@ def allow_args_sendmess(desthost, destport, message, localip=None, localport=Non
 
 
 
-def allow_args_openconn(desthost, destport, localip=None, localport=0, timeout=5):
+def allow_args_sendmess_batch(messagelist, localip=None, localport=None):
+
+  _require_list(messagelist)
+  for item in messagelist:
+    _require_tuple_or_list(item)
+    if len(item) != 3:
+      raise NamespaceRequirementError
+    _require_string(item[0])
+    _require_integer(item[1])
+    _require_string(item[2])
+
+  if localip is not None:
+    _require_string(localip)
+  if localport is not None:
+    _require_integer(localport)
+
+
+
+def allow_args_openconn(desthost, destport, localip=None, localport=0, timeout=5, reuse=False):
   # TODO: the wiki:RepyLibrary gives localport=0 as the default for this function,
   # slightly different than the localport=None it gives for sendmess(). This
   # should either be verified as intentional or made the same.
@@ -484,6 +519,8 @@ def allow_args_openconn(desthost, destport, localip=None, localport=0, timeout=5
   if timeout is not None:
     _require_integer_or_float(timeout)
 
+  _require_bool(reuse)
+
 
 
 def allow_args_waitforconn_callback(remoteip, remoteport, socketlikeobj, thiscommhandle, listencommhandle):
@@ -548,13 +585,15 @@ def wrap_args_waitforconn(localip, localport, function):
 
 
 
-def allow_args_stopcomm(wrapped_commhandle):
+def allow_args_stopcomm(wrapped_commhandle, wait=True):
   try:
     if wrapped_commhandle._wrapped__type_name != "commhandle":
       raise NamespaceRequirementError
   except AttributeError:
     raise NamespaceRequirementError
 
+  _require_bool(wait)
+
 
 
 
@@ -569,6 +608,14 @@ def allow_return_list_of_strings(retval):
 
 
 
+def allow_return_sendmess_batch(retval):
+  _require_list(retval)
+  for item in retval:
+    if not _is_in(type(item), [int, long, str]):
+      raise NamespaceRequirementError
+
+
+
 def allow_args_settimer(waittime, function, args):
   _require_integer_or_float(waittime)
   _require_user_function(function)
@@ -629,6 +676,13 @@ def unwrap_single_arg(*args, **kwargs):
 
 
 
+# Unwraps the first argument and passes the rest as they are
+def unwrap_first_arg(*args, **kwargs):
+  unwrapped_args = (args[0]._wrapped__object,) + args[1:]
+  return unwrapped_args, kwargs
+
+
+
 ##############################################################################
 # Constants that define which functions should be wrapped and how. These are
 # used by the functions wrap_and_insert_api_functions() and
@@ -685,6 +739,10 @@ USERCONTEXT_WRAPPER_INFO = {
       {'target_func' : emulcomm.gethostbyname_ex,
        'arg_checking_func' : allow_args_single_string,
        'return_checking_func' : allow_return_gethostbyname_ex},
+  'gethostbyname_ex_batch' :
+      {'target_func' : emulcomm.gethostbyname_ex_batch,
+       'arg_checking_func' : allow_args_gethostbyname_ex_batch,
+       'return_checking_func' : allow_return_gethostbyname_ex_batch},
 
   # message receive (UDP)
   'recvmess' :
@@ -699,6 +757,10 @@ USERCONTEXT_WRAPPER_INFO = {
       {'target_func' : emulcomm.sendmess,
        'arg_checking_func' : allow_args_sendmess,
        'return_checking_func' : allow_return_integer},
+  'sendmess_batch' :
+      {'target_func' : emulcomm.sendmess_batch,
+       'arg_checking_func' : allow_args_sendmess_batch,
+       'return_checking_func' : allow_return_sendmess_batch},
 
   # reliable comm channel (TCP)
   'openconn' :
@@ -723,7 +785,7 @@ USERCONTEXT_WRAPPER_INFO = {
   'stopcomm' :
       {'target_func' : emulcomm.stopcomm,
        'arg_checking_func' : allow_args_stopcomm,
-       'arg_unwrapping_func' : unwrap_single_arg,
+       'arg_unwrapping_func' : unwrap_first_arg,
        'return_checking_func' : allow_return_bool},
 
   # sets a timer
@@ -904,7 +966,14 @@ def allow_args_emulated_socket(socket):
 
 
 
-def allow_args_emulated_socket_send(socket, data):
+def allow_args_emulated_socket_send(socket, data, offset=0):
+  _require_emulated_socket(socket)
+  _require_string(data)
+  _require_integer(offset)
+
+
+
+def allow_args_emulated_socket_sendall(socket, data):
   _require_emulated_socket(socket)
   _require_string(data)
 
@@ -916,6 +985,13 @@ def allow_args_emulated_socket_recv(socket, bytes):
 
 
 
+def allow_args_emulated_socket_recvuntil(socket, delimiter, maxbytes):
+  _require_emulated_socket(socket)
+  _require_string(delimiter)
+  _require_integer(maxbytes)
+
+
+
 SOCKET_OBJECT_WRAPPER_INFO = {
   'close' :
       {'target_func' : emulcomm.emulated_socket.close,
@@ -926,11 +1002,26 @@ SOCKET_OBJECT_WRAPPER_INFO = {
       {'target_func' : emulcomm.emulated_socket.recv,
        'arg_checking_func' : allow_args_emulated_socket_recv,
        'return_checking_func' : allow_return_string},
+
+  'recvuntil' :
+      {'target_func' : emulcomm.emulated_socket.recvuntil,
+       'arg_checking_func' : allow_args_emulated_socket_recvuntil,
+       'return_checking_func' : allow_return_string},
+
+  'recvexactly' :
+      {'target_func' : emulcomm.emulated_socket.recvexactly,
+       'arg_checking_func' : allow_args_emulated_socket_recv,
+       'return_checking_func' : allow_return_string},
        
   'send' :
       {'target_func' : emulcomm.emulated_socket.send,
        'arg_checking_func' : allow_args_emulated_socket_send,
        'return_checking_func' : allow_return_integer},
+
+  'sendall' :
+      {'target_func' : emulcomm.emulated_socket.sendall,
+       'arg_checking_func' : allow_args_emulated_socket_sendall,
+       'return_checking_func' : allow_return_none},
   
   # Armon: Add the willblock() call. Takes no args, and returns a bool tuple with 2 entries.
   'willblock' :
@@ -1473,6 +1564,10 @@ class NamespaceAPIFunctionWrapper(object):
     if self.__arg_unwrapping_func is not None:
       args, kwargs = self.__arg_unwrapping_func(*args, **kwargs)
 
+    # The API call this is (set by restrictions.assertisallowed) only lasts
+    # until it returns
+    previouscall = nanny.get_api_call()
+
     try:
       # If it's a string rather than a function, then this is our convention
       # for indicating that we want to wrap the function of this particular
@@ -1488,6 +1583,7 @@ class NamespaceAPIFunctionWrapper(object):
         retval = self.__target_func(*args, **kwargs)
       
     except Exception, e:
+      nanny.set_api_call(previouscall)
       self._check_raised_exception(e)
       
       # Armon: Do a normal "raise" rather than "raise e" so that the traceback
@@ -1495,6 +1591,8 @@ class NamespaceAPIFunctionWrapper(object):
       # want to reduce the traceback to only the lowest module on the stack.
       raise
 
+    nanny.set_api_call(previouscall)
+
     # Copy first, then check.
     retval = self._copy(retval)
     self._check_return_value(retval)
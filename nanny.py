@@ -25,6 +25,15 @@ import threading
 # needed for handling internal errors
 import tracebackrepy
 
+# for the batching and tracing settings
+import repy_constants
+
+# needed to dump the throttle waits on request
+import signal
+
+# needed for harshexit.exitfunctions
+import harshexit
+
 # common functionality needed between nanny and nonportable
 import nanny_resource_limits
 nanny_resource_limits.init(nonportable.getruntime)
@@ -51,8 +60,11 @@ individual_item_resources = nanny_resource_limits.individual_item_resources
 item_resources = fungible_item_resources + individual_item_resources
 
 
+# These aren't used up, they change how repy delivers messages
+setting_resources = nanny_resource_limits.setting_resources
+
 # This is used by restrictions.py to set up our tables
-known_resources = quantity_resources + item_resources 
+known_resources = quantity_resources + item_resources + setting_resources
 
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
@@ -116,25 +128,337 @@ def update_resource_consumption_table(resource):
 
 
 
-# I want to wait until a resource can be used again...
-def sleep_until_resource_drains(resource):
+# The last thread waiting on each renewable resource.   Throttled threads
+# queue up behind it so that they are woken in the order they arrived.
+renewable_resource_wait_queue_tail = nanny_resource_limits.renewable_resource_wait_queue_tail
+
+
+
+# Returns how long it will take for a resource to drain back under its limit.
+# The caller must hold the lock for the resource.
+def get_resource_drain_time(resource):
 
   # It'll never drain!
   if resource_restriction_table[resource] == 0:
     raise Exception, "Resource '"+resource+"' limit set to 0, won't drain!"
-    
 
-  # We may need to go through this multiple times because other threads may
-  # also block and consume resources.
-  while resource_consumption_table[resource] > resource_restriction_table[resource]:
+  overage = resource_consumption_table[resource] - resource_restriction_table[resource]
+
+  if overage <= 0:
+    return 0.0
+
+  return overage / resource_restriction_table[resource]
+
+
+
+# I want to wait until a resource can be used again...   The charge has already
+# been added to the consumption table, so all that is left is to wait for my
+# turn (the thread ahead of me in the queue) and then for my drain time to
+# pass.   The lock for the resource is not held while I'm sleeping.
+def sleep_until_resource_drains(resource, quantity, draintime, predecessor, myticket):
+
+  waitstart = nonportable.getruntime()
+
+  try:
+    # Wait until the threads that arrived before me are done.   This keeps
+    # many small charges from jumping ahead of a large charge and starving it
+    if predecessor is not None:
+      predecessor.wait()
+
+    # We may need to go through this multiple times because sleep may return
+    # early.
+    while True:
+      sleeptime = draintime - nonportable.getruntime()
+      if sleeptime <= 0:
+        break
+      time.sleep(sleeptime)
+
+  finally:
+    # Let the next thread in line go (even if something went wrong)
+    myticket.set()
+
+    # If no one queued up behind me, clean up after myself
+    renewable_resource_lock_table[resource].acquire()
+    try:
+      if renewable_resource_wait_queue_tail[resource] is myticket:
+        renewable_resource_wait_queue_tail[resource] = None
+    finally:
+      renewable_resource_lock_table[resource].release()
+
+  tattle_throttle_wait(resource, quantity, nonportable.getruntime() - waitstart)
+
+
+
 
-    # Sleep until we're expected to be under quota
-    sleeptime = (resource_consumption_table[resource] - resource_restriction_table[resource]) / resource_restriction_table[resource]
 
-    time.sleep(sleeptime)
 
+
+# Charges a renewable resource right away.   This blocks until the resource has
+# drained if it is oversubscribed.
+def charge_renewable_resource(resource, quantity):
+
+  # get the lock for this resource.   This is only held while the tables are
+  # updated, never while sleeping, so other threads can still charge the 
+  # resource while I'm throttled
+  renewable_resource_lock_table[resource].acquire()
+  
+  # release the lock afterwards no matter what
+  try: 
+    # update the resource counters based upon the current time.
     update_resource_consumption_table(resource)
 
+    # It's renewable, so I can wait for it to clear
+    if resource not in renewable_resources:
+      # Should never have a quantity tattle for a non-renewable resource
+      # This will cause the program to exit and log things if logging is
+      # enabled. -Brent
+      tracebackrepy.handle_internalerror("Resource '" + resource + 
+          "' is not renewable!", 133)
+  
+
+    resource_consumption_table[resource] = resource_consumption_table[resource] + quantity
+    nanny_resource_limits.resource_consumption_version += 1
+
+    # figure out when I'm expected to be under quota
+    draintime = get_resource_drain_time(resource)
+
+    predecessor = renewable_resource_wait_queue_tail[resource]
+
+    # If I'm under quota and no one is ahead of me, I'm done
+    if draintime == 0.0 and (predecessor is None or predecessor.isSet()):
+      return
+
+    # Otherwise I'll block.   Get in line behind whoever is waiting...
+    myticket = threading.Event()
+    renewable_resource_wait_queue_tail[resource] = myticket
+    draintime = draintime + nonportable.getruntime()
+  
+  finally:
+    # release the lock for this resource
+    renewable_resource_lock_table[resource].release()
+    
+  # I'll block if I'm over...
+  sleep_until_resource_drains(resource, quantity, draintime, predecessor, myticket)
+
+
+
+
+# Per thread state for batching small renewable charges.   The 'pending' 
+# attribute maps a resource to a list of [quantity, flushtime] where flushtime
+# is the time.time() by which the charge must be flushed.
+thread_charge_state = threading.local()
+
+
+# Adds a charge to the calling thread's batch.   Returns None if nothing needs
+# to be charged now, otherwise the quantity that must be charged (this 
+# includes anything the thread had batched up for the resource).
+def batch_thread_charge(resource, quantity):
+
+  # Not something I can batch (let the normal path deal with errors like a 
+  # zero limit or a non-renewable resource)
+  if resource not in renewable_resource_wait_queue_tail:
+    return quantity
+
+  limit = resource_restriction_table[resource]
+  if limit <= 0:
+    return quantity
+
+  try:
+    pending = thread_charge_state.pending
+  except AttributeError:
+    pending = thread_charge_state.pending = {}
+
+  if resource in pending:
+    pendingcharge = pending[resource]
+  else:
+    pendingcharge = None
+
+  if quantity == 0:
+    # This is a check to see if the resource is oversubscribed.   If I have a
+    # pending charge, I'll block when it is flushed.   If no thread is 
+    # waiting on the resource, it isn't oversubscribed.
+    if pendingcharge is not None or renewable_resource_wait_queue_tail[resource] is None:
+      return None
+    return 0
+
+  # Large charges aren't batched
+  threshold = min(repy_constants.NANNY_BATCH_MAX_QUANTITY, 
+      limit * repy_constants.NANNY_BATCH_LIMIT_FRACTION)
+
+  if pendingcharge is None:
+    if quantity >= threshold:
+      return quantity
+    pending[resource] = [quantity, time.time() + repy_constants.NANNY_BATCH_MAX_DELAY]
+    return None
+
+  pendingcharge[0] = pendingcharge[0] + quantity
+
+  # Flush the batch once it is large or old enough
+  if pendingcharge[0] >= threshold or time.time() >= pendingcharge[1]:
+    del pending[resource]
+    return pendingcharge[0]
+
+  return None
+
+
+
+
+
+
+
+# Throttle wait tracing.   Every time a thread has to wait for a resource (a
+# renewable resource to drain or a free event), the wait is recorded along 
+# with the API call the thread was in.   This shows which limit is slowing a
+# program down.
+
+# The API call each thread is in.   The 'call' attribute is set by 
+# restrictions.assertisallowed (e.g. 'socket.send' or 'file.read') when the 
+# thread isn't already in an API call, so the calls an API function makes 
+# (e.g. sendmess calling getmyip) don't replace it.   The namespace restores
+# the previous value when the API call returns, and the eventpool clears it 
+# after each event.
+thread_api_call = threading.local()
+
+
+def get_api_call():
+  """
+  <Purpose>
+    Returns the API call the current thread is in.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The name of the call, or None if the thread isn't in an API call.
+  """
+  try:
+    return thread_api_call.call
+  except AttributeError:
+    return None
+
+
+
+def set_api_call(call):
+  """
+  <Purpose>
+    Sets the API call the current thread is in, which throttle waits are 
+    attributed to.
+
+  <Arguments>
+    call:
+      The name of the call, or None if the thread isn't in an API call.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    None.
+  """
+  thread_api_call.call = call
+
+# Waits are put into buckets by how long they were (in seconds).   The last
+# bucket is everything longer.
+throttle_wait_bucket_limits = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 
+    1.0, 2.0, 5.0]
+
+# Maps a resource to a list of the number of waits in each bucket
+throttle_wait_histograms = {}
+
+# Maps a tuple (resource, call) to a list of [number of waits, total wait 
+# time, longest wait, total quantity]
+throttle_wait_calls = {}
+
+# This protects the tables and the trace file
+throttle_wait_lock = threading.Lock()
+
+# If --throttletrace was given, each wait is written here, as well as the 
+# summary on exit or on SIGUSR1
+throttle_trace_file = None
+
+
+# Writes the summary of the throttle waits.   The caller must hold the
+# throttle_wait_lock.
+def write_throttle_wait_summary(fileobj):
+  fileobj.write("# throttle wait summary at %f\n" % nonportable.getruntime())
+
+  resources = throttle_wait_histograms.keys()
+  resources.sort()
+  for resource in resources:
+    histogram = throttle_wait_histograms[resource]
+    line = "resource " + resource + " waits " + str(sum(histogram)) + " histogram"
+    for index in range(len(histogram)):
+      if index < len(throttle_wait_bucket_limits):
+        line += " <=%gs:%d" % (throttle_wait_bucket_limits[index], histogram[index])
+      else:
+        line += " >%gs:%d" % (throttle_wait_bucket_limits[-1], histogram[index])
+    fileobj.write(line + "\n")
+
+    calls = []
+    for (callresource, call) in throttle_wait_calls.keys():
+      if callresource == resource:
+        calls.append(call)
+    calls.sort()
+
+    for call in calls:
+      (count, totalwait, longestwait, totalquantity) = throttle_wait_calls[(resource, call)]
+      fileobj.write("  call %s waits %d total %f longest %f quantity %s\n" % (
+          call, count, totalwait, longestwait, totalquantity))
+
+  fileobj.flush()
+
+
+# Dumps the summary to the trace file (if there is one).   This is run on 
+# exit.
+def dump_throttle_waits():
+  if throttle_trace_file is None:
+    return
+
+  throttle_wait_lock.acquire()
+  try:
+    write_throttle_wait_summary(throttle_trace_file)
+  finally:
+    throttle_wait_lock.release()
+
+
+# Handles SIGUSR1.   The dump is done by another thread since this thread 
+# may be holding the throttle_wait_lock.
+def handle_throttle_dump_signal(signum, frame):
+  threading.Thread(target=dump_throttle_waits, name="ThrottleWaitDump").start()
+
+
+# Opens the trace file and arranges for the summary to be written on exit 
+# and on SIGUSR1.   This must be called from the main thread.
+def start_throttle_trace(filename):
+  global throttle_trace_file
+
+  throttle_trace_file = open(filename, "w")
+
+  harshexit.exitfunctions.append(dump_throttle_waits)
+
+  # There is no SIGUSR1 on Windows
+  try:
+    dumpsignal = signal.SIGUSR1
+  except AttributeError:
+    return
+  signal.signal(dumpsignal, handle_throttle_dump_signal)
+
+  # Restart system calls the signal interrupts rather than failing them 
+  # (this isn't in older versions of python)
+  try:
+    siginterrupt = signal.siginterrupt
+  except AttributeError:
+    return
+  siginterrupt(dumpsignal, False)
+
 
 
 
@@ -195,6 +519,11 @@ def start_resource_nanny():
 
   nonportable.monitor_cpu_disk_and_mem()
 
+  # Only repy gets here (not the resource monitor), so this is where repy's
+  # throttle waits start being traced
+  if repy_constants.THROTTLE_TRACE_FILE:
+    start_throttle_trace(repy_constants.THROTTLE_TRACE_FILE)
+
 
 
 # let the nanny know that the process is consuming some resource
@@ -219,7 +548,8 @@ def tattle_quantity(resource, quantity):
       None.
 
    <Side Effects>
-      May sleep the program until the resource is available.
+      May sleep the program until the resource is available.   Small charges
+      may be batched up and charged later (see flush_thread_charges).
 
    <Returns>
       None.
@@ -233,34 +563,49 @@ def tattle_quantity(resource, quantity):
     tracebackrepy.handle_internalerror("Resource '" + resource + 
         "' has a negative quantity " + str(quantity) + "!", 132)
     
-  # get the lock for this resource
-  renewable_resource_lock_table[resource].acquire()
-  
-  # release the lock afterwards no matter what
-  try: 
-    # update the resource counters based upon the current time.
-    update_resource_consumption_table(resource)
+  # Small charges are batched up per thread when possible.   This avoids 
+  # taking the lock and reading the clock on every send / recv / read...
+  if repy_constants.NANNY_BATCH_SMALL_CHARGES:
+    quantity = batch_thread_charge(resource, quantity)
+    if quantity is None:
+      return
 
-    # It's renewable, so I can wait for it to clear
-    if resource not in renewable_resources:
-      # Should never have a quantity tattle for a non-renewable resource
-      # This will cause the program to exit and log things if logging is
-      # enabled. -Brent
-      tracebackrepy.handle_internalerror("Resource '" + resource + 
-          "' is not renewable!", 133)
-  
+  charge_renewable_resource(resource, quantity)
 
-    resource_consumption_table[resource] = resource_consumption_table[resource] + quantity
-    # I'll block if I'm over...
-    sleep_until_resource_drains(resource)
-  
-  finally:
-    # release the lock for this resource
-    renewable_resource_lock_table[resource].release()
-    
 
 
 
+def flush_thread_charges():
+  """
+   <Purpose>
+      Charges any renewable resource use the current thread has batched up.
+      This should be called before a thread blocks or finishes so that its
+      use is accounted for in a timely manner.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      May sleep the program until the resources are available.
+
+   <Returns>
+      None.
+  """
+
+  try:
+    pending = thread_charge_state.pending
+  except AttributeError:
+    # Nothing to do...
+    return
+
+  for resource in pending.keys():
+    (quantity, flushtime) = pending.pop(resource)
+    charge_renewable_resource(resource, quantity)
+
+
 
 
 def tattle_add_item(resource, item):
@@ -305,6 +650,7 @@ def tattle_add_item(resource, item):
 
     # add the item to the list.   We're done now...
     resource_consumption_table[resource].add(item)
+    nanny_resource_limits.resource_consumption_version += 1
 
   finally:
     fungible_resource_lock_table[resource].release()
@@ -347,12 +693,103 @@ def tattle_remove_item(resource, item):
     except KeyError:
       # may happen because removal is idempotent
       pass
+    else:
+      nanny_resource_limits.resource_consumption_version += 1
 
   finally:
     fungible_resource_lock_table[resource].release()
 
 
 
+def tattle_throttle_wait(resource, quantity, waittime):
+  """
+   <Purpose>
+      Let the nanny know that the current thread had to wait for a resource.
+      The wait is attributed to the API call the thread is in.
+
+   <Arguments>
+      resource:
+         A string with the resource name.
+      quantity:
+         The amount of the resource that was requested.
+      waittime:
+         How long the thread waited, in seconds.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      Writes the wait to the trace file if there is one.
+
+   <Returns>
+      None.
+  """
+
+  call = get_api_call()
+  if call is None:
+    # Not in an API call (e.g. the thread that delivers network events)
+    call = "internal"
+
+  # Find the bucket for the histogram
+  bucket = 0
+  while bucket < len(throttle_wait_bucket_limits) and waittime > throttle_wait_bucket_limits[bucket]:
+    bucket += 1
+
+  throttle_wait_lock.acquire()
+  try:
+    if resource not in throttle_wait_histograms:
+      throttle_wait_histograms[resource] = [0] * (len(throttle_wait_bucket_limits) + 1)
+    throttle_wait_histograms[resource][bucket] += 1
+
+    if (resource, call) not in throttle_wait_calls:
+      throttle_wait_calls[(resource, call)] = [0, 0.0, 0.0, 0]
+    callstats = throttle_wait_calls[(resource, call)]
+    callstats[0] += 1
+    callstats[1] += waittime
+    callstats[2] = max(callstats[2], waittime)
+    callstats[3] += quantity
+
+    if throttle_trace_file is not None:
+      throttle_trace_file.write("%f %s %s %s %f\n" % (nonportable.getruntime(),
+          resource, call, quantity, waittime))
+      throttle_trace_file.flush()
+  finally:
+    throttle_wait_lock.release()
+
+
+
+def tattle_disk_change(quantity):
+  """
+   <Purpose>
+      Let the nanny know that the files in the vessel's directory are about
+      to grow or shrink.   This keeps a running count of the disk used so 
+      that going over the limit is caught before the data is written.
+
+   <Arguments>
+      quantity:
+         The number of bytes the files will grow by.   This is negative if 
+         space is being freed.
+         
+   <Exceptions>
+      Exception if the program attempts to use too much disk.   The count
+      is not changed in this case.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      None.
+  """
+
+  diskused = nanny_resource_limits.adjust_disk_used(quantity)
+
+  if quantity > 0 and diskused > resource_restriction_table['diskused']:
+    # Give the space back, the caller won't use it
+    nanny_resource_limits.adjust_disk_used(-quantity)
+    raise Exception, "Resource 'diskused' limit exceeded!!"
+
+
+
 # used for individual_item_resources
 def tattle_check(resource, item):
   """
@@ -380,4 +817,6 @@ def tattle_check(resource, item):
   if item not in resource_restriction_table[resource]:
     raise Exception, "Resource '"+resource+" "+str(item)+"' not allowed!!!"
 
-  resource_consumption_table[resource].add(item)
+  if item not in resource_consumption_table[resource]:
+    resource_consumption_table[resource].add(item)
+    nanny_resource_limits.resource_consumption_version += 1
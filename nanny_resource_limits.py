@@ -3,13 +3,38 @@
 # init:   Call immediately after import, passing nonportable.getruntime.
 # calculate_cpu_sleep_interval:   Calculates sleep interval to try and meet
 #   target CPU usage.
+# CPUThrottleController:   Stops a process for many short periods to meet a
+#   target CPU usage.
+# calculate_polling_interval:   Calculates how often a resource should be 
+#   checked given how close it is to its limit.
+# get_disk_used / set_disk_used / adjust_disk_used:   Access the running count
+#   of the disk space used, which is shared with the resource monitor.
+# get_counted_disk_used / set_disk_correction:   Used by the resource monitor
+#   to correct the count of the disk space used.
+# MonitorState:   Counters the resource monitor shares with repy.
 # resource_limit:   Returns the limit/availability of a resource.
+# count_queued_messages / get_message_queue_counters:   Counters for the
+#   recvmess message queues, which get_resources includes in the usage.
+# count_accepted_connections / get_accept_counters:   Counters for the 
+#   connections accepted on waitforconn sockets, which get_resources includes
+#   in the usage.
 
 
 
 # Needed for threading.Lock
 import threading
 
+# Needed to pack the disk used count into shared memory
+import struct
+
+# The disk used count and the monitor's counters are kept in shared memory
+# so repy and the resource monitor can both see them.   This may fail on 
+# Windows CE.
+try:
+  import mmap
+except ImportError:
+  mmap = None
+
 
 
 # These are resources that drain / replenish over time
@@ -36,8 +61,13 @@ individual_item_resources = ['messport', 'connport']
 item_resources = fungible_item_resources + individual_item_resources
 
 
+# These aren't used up, they change how repy delivers messages to recvmess
+# handlers and sets up waitforconn sockets (see emulcomm).   They are 
+# optional, 0 means use the default.
+setting_resources = ['messqueue', 'messrcvbuf', 'connbacklog', 'connbuffer']
+
 # This is used by restrictions.py to set up our tables
-known_resources = quantity_resources + item_resources 
+known_resources = quantity_resources + item_resources + setting_resources
 
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
@@ -55,6 +85,13 @@ resource_restriction_table = {}
 resource_consumption_table = {}
 
 
+# This is incremented whenever resource_consumption_table changes, so that 
+# copies of the table (like the snapshot returned by get_resources) can tell 
+# when they are out of date.   Increments from different threads may race, 
+# so copies should also have an age limit.
+resource_consumption_version = 0
+
+
 # Locks for resource_consumption_table
 # I only need to lock the renewable resources because the other resources use
 # sets (which handle locking internally)
@@ -63,6 +100,16 @@ for init_resource in renewable_resources:
   renewable_resource_lock_table[init_resource] = threading.Lock()
 
 
+# The last thread to queue up waiting on each renewable resource.   A 
+# throttled thread waits for the thread ahead of it (this is a 
+# threading.Event that is set when that thread is done waiting) before it 
+# sleeps out its own charge.   This way waiters are woken in the order they 
+# arrived and the lock above is never held while sleeping.
+renewable_resource_wait_queue_tail = {}
+for init_resource in renewable_resources:
+  renewable_resource_wait_queue_tail[init_resource] = None
+
+
 # This lock is used to prevent race conditions for tattle_add_item and 
 # tattle_remove_item.   
 fungible_resource_lock_table = {}
@@ -74,6 +121,39 @@ for init_resource in fungible_item_resources:
 renewable_resource_update_time = {}
 
 
+# The disk space used by the files in the vessel's directory, including the 
+# 4K charged per file.   This is two numbers, the count kept by repy as files
+# are written, truncated, created and removed, and a correction set by the 
+# resource monitor when a full scan of the directory disagrees with the 
+# count.   Each has only one writer.   They are in an anonymous shared memory
+# map created on import, so they are shared with the resource monitor once 
+# repy forks.
+disk_used_format = "q"
+disk_used_size = struct.calcsize(disk_used_format)
+if mmap is not None:
+  disk_used_map = mmap.mmap(-1, disk_used_size * 2)
+else:
+  disk_used_map = None
+  disk_used_list = [0L, 0L]
+
+# This lock serializes updates to the disk used count
+disk_used_lock = threading.Lock()
+
+
+# Counters for the messages queued for recvmess handlers: how many are in the
+# queues now, and how many have been delivered and dropped
+message_queue_counters = {'messqueued':0, 'messdelivered':0, 'messdropped':0}
+message_queue_lock = threading.Lock()
+
+
+# Counters for the connections accepted on waitforconn sockets: how many 
+# were accepted, how many times a socket was ready, and how many times the 
+# accept queue was found full (so that more connections were likely refused
+# or had to retry)
+accept_counters = {'connaccepted':0, 'connacceptbatches':0, 'connqueuefull':0}
+accept_lock = threading.Lock()
+
+
 # Set up individual_item_resources to be in the restriction_table (as a set)
 for init_resource in individual_item_resources:
   resource_restriction_table[init_resource] = set()
@@ -141,6 +221,657 @@ def calculate_cpu_sleep_interval(cpulimit, percentused, elapsedtime):
 
 
 
+# A duty cycle regulator for the CPU limit.   Rather than stopping the process
+# for however long it takes to make up for an entire polling interval, the
+# process is stopped for many short periods.   The controller keeps track of 
+# the CPU time used beyond the allowance (the integral of the error) and 
+# estimates the fraction of the CPU the process uses while it runs (used as a
+# feed forward term to pick how long to let the process run between stops).
+class CPUThrottleController:
+  """
+  <Purpose>
+    Decides how long to stop a process and how long to let it run so that it
+    stays under a CPU limit without long stops.
+
+  <Side Effects>
+    None.
+
+  <Example Use>
+    controller = CPUThrottleController(0.1, 0.005, 0.002, 0.1, 1.0)
+    while True:
+      ... measure the CPU used, and the time spent running and stopped ...
+      controller.update(cpuused, runtime, stoptime)
+      (stoptime, runtime) = controller.get_next_interval()
+      ... stop the process for stoptime, then let it run for runtime ...
+  """
+
+  # How quickly the usage estimate follows the measured usage (0 to 1)
+  usage_smoothing = 0.5
+
+  # Stops shorter than this fraction of the minimum run time are skipped
+  # (the debt is kept for later).   This avoids stopping for a few micro-
+  # seconds at a time.
+  min_stop_fraction = 0.1
+
+  # The process is considered idle if it uses less than this fraction of its
+  # limit while running
+  idle_fraction = 0.5
+
+  def __init__(self, cpulimit, maxstop, minrun, idleinterval, maxidleinterval):
+    """
+    <Purpose>
+      Creates a new controller.
+
+    <Arguments>
+      cpulimit:
+        The fraction of the CPU the process may use.
+      maxstop:
+        The longest the process should normally be stopped for.   This may
+        be exceeded when the limit is so low that minrun would otherwise
+        use too much CPU.
+      minrun:
+        The shortest time to let the process run between stops.
+      idleinterval:
+        How often to check the process when it is under its limit.
+      maxidleinterval:
+        How often to check the process when it has been idle for a while.
+        The time between checks doubles (up to this) while it is idle.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      None.
+    """
+    self.cpulimit = cpulimit
+    self.maxstop = maxstop
+    self.minrun = minrun
+    self.idleinterval = idleinterval
+    self.maxidleinterval = maxidleinterval
+
+    # How long to wait before the next check if the process is under its 
+    # limit.   This backs off while the process is idle.
+    self.currentidleinterval = idleinterval
+
+    # The CPU time used beyond the allowance.   This is negative if the 
+    # process has unused allowance (up to one idle interval's worth)
+    self.debt = 0.0
+
+    # The fraction of the CPU used while the process is running
+    self.usage = 0.0
+
+
+  def update(self, cpuused, runtime, stoptime):
+    """
+    <Purpose>
+      Tells the controller how much CPU was used since the last update.
+
+    <Arguments>
+      cpuused:
+        The CPU time used since the last update.
+      runtime:
+        The time the process was allowed to run since the last update.
+      stoptime:
+        The time the process was stopped since the last update.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      None.
+    """
+    self.debt += cpuused - self.cpulimit * (runtime + stoptime)
+
+    # Don't let the process save up its allowance while it is idle and then
+    # use it in one burst.
+    self.debt = max(self.debt, -self.cpulimit * self.idleinterval)
+
+    if runtime > 0:
+      # CPU time includes the time before the process actually stopped, so 
+      # this may be a little high.   That's okay, this is only an estimate.
+      measuredusage = cpuused / runtime
+      self.usage += (measuredusage - self.usage) * self.usage_smoothing
+
+
+  def get_next_interval(self):
+    """
+    <Purpose>
+      Determines how long to stop the process and then how long to let it 
+      run before the next update.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      A tuple (stoptime, runtime).   stoptime is 0.0 if the process should
+      not be stopped.
+    """
+    # Is the process using more than its share while it runs?
+    overuse = self.usage - self.cpulimit
+
+    # The longest stop.   If the limit is low, a short run needs a long stop
+    # to even out, so use that instead.   The factor of 2 lets any debt be
+    # paid off.
+    if overuse > 0:
+      longeststop = max(self.maxstop, 2 * self.minrun * overuse / self.cpulimit)
+    else:
+      longeststop = self.maxstop
+
+    # Stopping the process pays the debt off at the rate of the limit
+    stoptime = min(self.debt / self.cpulimit, longeststop)
+    if stoptime < self.minrun * self.min_stop_fraction:
+      stoptime = 0.0
+
+    # Let the process run until it has built up enough debt to need another
+    # full length stop.
+    if overuse > 0:
+      remainingdebt = self.debt - stoptime * self.cpulimit
+      runtime = (self.cpulimit * self.maxstop - remainingdebt) / overuse
+      runtime = min(max(runtime, self.minrun), self.idleinterval)
+      self.currentidleinterval = self.idleinterval
+
+    # Back off if the process has been idle (or blocked) and has no debt
+    elif self.debt <= 0 and self.usage < self.cpulimit * self.idle_fraction:
+      runtime = self.currentidleinterval
+      self.currentidleinterval = min(self.currentidleinterval * 2, self.maxidleinterval)
+
+    else:
+      runtime = self.idleinterval
+      self.currentidleinterval = self.idleinterval
+
+    return (stoptime, runtime)
+
+
+
+def calculate_polling_interval(interval, used, limit, mininterval, maxinterval):
+  """
+  <Purpose>
+    Calculates how long to wait before checking a resource again.   The 
+    resource is checked often when it is near its limit and the interval 
+    backs off exponentially while use is low.
+
+  <Arguments>
+    interval:
+      The current polling interval.
+    used:
+      The amount of the resource used at the last check.
+    limit:
+      The limit for the resource.
+    mininterval:
+      The shortest polling interval.
+    maxinterval:
+      The longest polling interval.
+
+  <Exceptions>
+    None.
+
+  <Returns>
+    The new polling interval.
+  """
+  # Near the limit, check as often as possible
+  if used >= limit * 0.75:
+    return mininterval
+
+  # Well under the limit, back off
+  if used < limit * 0.5:
+    return min(interval * 2, maxinterval)
+
+  # Somewhere in between, keep the current interval
+  return min(max(interval, mininterval), maxinterval)
+
+
+
+# Counters the resource monitor shares with repy.   This is what the monitor
+# measured at its last sample, so it can be a little out of date, but repy can
+# read it without a system call or a message from the monitor.
+class MonitorState:
+  """
+  <Purpose>
+    Keeps the counters the resource monitor shares with repy (like the CPU
+    time and memory repy has used and when it was stopped) in shared memory.
+    There is only one writer (the monitor), so the counters are protected by
+    a sequence number rather than a lock.   The writer makes the sequence 
+    number odd while it is writing, and a reader tries again if the sequence
+    number was odd or changed while it was reading.
+
+  <Side Effects>
+    Creates an anonymous shared memory map.   This must be created before 
+    the monitor is forked.
+
+  <Example Use>
+    state = MonitorState(100)
+    ... fork ...
+    In the monitor:
+      state.add_stop(getruntime(), 0.005)
+      state.publish({"cpu":1.5, "memory":10000000, ...})
+    In repy:
+      (counters, stoptimes) = state.read()
+  """
+
+  # The counters and their struct formats, in the order they are stored
+  counters = [("cpu", "d"), ("memory", "Q"), ("monitorcpu", "d"), 
+      ("monitorwakeups", "Q"), ("throttledebt", "d"), ("throttleusage", "d")]
+
+  sequence_format = "Q"
+
+  # A reader gives up after this many tries (e.g. if the monitor died while
+  # writing)
+  read_attempts = 1000
+
+  def __init__(self, maxstops):
+    """
+    <Purpose>
+      Creates the shared memory for the counters.
+
+    <Arguments>
+      maxstops:
+        How many of the most recent stops are kept.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      None.
+    """
+    self.maxstops = maxstops
+
+    # The counters, how many stops there have been, then the most recent 
+    # stops as a ring of (time, amount) pairs
+    self.data_format = ""
+    for (name, counterformat) in self.counters:
+      self.data_format += counterformat
+    self.data_format += "Q" + "dd" * maxstops
+
+    self.data_offset = struct.calcsize(self.sequence_format)
+
+    if mmap is None:
+      self.map = None
+    else:
+      self.map = mmap.mmap(-1, self.data_offset + struct.calcsize(self.data_format))
+
+    # The writer's copies of the sequence number and the stops
+    self.sequence = 0
+    self.stopcount = 0
+    self.stops = [0.0] * (2 * maxstops)
+
+
+  def add_stop(self, stoptime, amount):
+    """
+    <Purpose>
+      Records that repy was stopped.   This is seen by readers after the next
+      publish.   Only the writer may call this.
+
+    <Arguments>
+      stoptime:
+        When repy was stopped (from getruntime()).
+      amount:
+        How long repy was stopped for.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      None.
+    """
+    index = (self.stopcount % self.maxstops) * 2
+    self.stops[index] = stoptime
+    self.stops[index + 1] = amount
+    self.stopcount += 1
+
+
+  def publish(self, countervalues):
+    """
+    <Purpose>
+      Makes new counter values (and any new stops) visible to readers.   Only
+      the writer may call this.
+
+    <Arguments>
+      countervalues:
+        A dictionary with a value for each counter.
+
+    <Exceptions>
+      KeyError if a counter is missing.
+
+    <Returns>
+      None.
+    """
+    if self.map is None:
+      return
+
+    values = []
+    for (name, counterformat) in self.counters:
+      values.append(countervalues[name])
+    values.append(self.stopcount)
+    values.extend(self.stops)
+
+    # Odd while writing
+    self.sequence += 1
+    struct.pack_into(self.sequence_format, self.map, 0, self.sequence)
+
+    struct.pack_into(self.data_format, self.map, self.data_offset, *values)
+
+    self.sequence += 1
+    struct.pack_into(self.sequence_format, self.map, 0, self.sequence)
+
+
+  def read(self):
+    """
+    <Purpose>
+      Reads the counters without locking.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      None.
+
+    <Returns>
+      A tuple (counters, stoptimes) or None if nothing has been published
+      (or a consistent copy couldn't be read).   counters is a dictionary 
+      with the value of each counter.   stoptimes is a list of (time, amount)
+      tuples for the most recent stops, oldest first.
+    """
+    if self.map is None:
+      return None
+
+    for attempt in xrange(self.read_attempts):
+      before = struct.unpack_from(self.sequence_format, self.map, 0)[0]
+      if before % 2 == 1:
+        continue
+
+      values = struct.unpack_from(self.data_format, self.map, self.data_offset)
+
+      if struct.unpack_from(self.sequence_format, self.map, 0)[0] == before:
+        break
+    else:
+      return None
+
+    # Nothing has been published yet
+    if before == 0:
+      return None
+
+    countervalues = {}
+    for index in range(len(self.counters)):
+      countervalues[self.counters[index][0]] = values[index]
+
+    stopcount = values[len(self.counters)]
+    stops = values[len(self.counters) + 1:]
+
+    # Put the stops back in order, oldest first
+    stoptimes = []
+    for count in range(max(stopcount - self.maxstops, 0), stopcount):
+      index = (count % self.maxstops) * 2
+      stoptimes.append((stops[index], stops[index + 1]))
+
+    return (countervalues, stoptimes)
+
+
+
+def get_disk_used():
+  """
+  <Purpose>
+    Returns the running count of the disk space used.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The number of bytes used.
+  """
+  return _load_disk_used(0) + _load_disk_used(1)
+
+
+
+def get_counted_disk_used():
+  """
+  <Purpose>
+    Returns the disk space used according to repy's count, without the
+    resource monitor's correction.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The number of bytes repy has counted.
+  """
+  return _load_disk_used(0)
+
+
+
+def set_disk_used(diskused):
+  """
+  <Purpose>
+    Sets the running count of the disk space used (e.g. from a full scan of
+    the directory) and clears any correction.   This should be called 
+    before the resource monitor is started.
+
+  <Arguments>
+    diskused:
+      The number of bytes used.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Changes the count seen by the resource monitor.
+
+  <Returns>
+    None.
+  """
+  disk_used_lock.acquire()
+  try:
+    _store_disk_used(0, diskused)
+    _store_disk_used(1, 0)
+  finally:
+    disk_used_lock.release()
+
+
+
+def adjust_disk_used(quantity):
+  """
+  <Purpose>
+    Adds to (or subtracts from) the running count of the disk space used.
+
+  <Arguments>
+    quantity:
+      The number of bytes to add.   This is negative if space was freed.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Changes the count seen by the resource monitor.
+
+  <Returns>
+    The new number of bytes used.
+  """
+  disk_used_lock.acquire()
+  try:
+    counted = _load_disk_used(0) + quantity
+    _store_disk_used(0, counted)
+  finally:
+    disk_used_lock.release()
+
+  return counted + _load_disk_used(1)
+
+
+
+def set_disk_correction(correction):
+  """
+  <Purpose>
+    Sets the correction to repy's count of the disk space used.   This is 
+    only called by the resource monitor (or the thread that checks the disk
+    on Windows).
+
+  <Arguments>
+    correction:
+      The number of bytes to add to repy's count.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Changes the disk used seen by repy.
+
+  <Returns>
+    None.
+  """
+  _store_disk_used(1, correction)
+
+
+
+# Helpers to read and write the disk used count (slot 0) and correction 
+# (slot 1)
+def _load_disk_used(slot):
+  if disk_used_map is None:
+    return disk_used_list[slot]
+
+  return struct.unpack_from(disk_used_format, disk_used_map, slot * disk_used_size)[0]
+
+
+def _store_disk_used(slot, diskused):
+  if disk_used_map is None:
+    disk_used_list[slot] = diskused
+  else:
+    struct.pack_into(disk_used_format, disk_used_map, slot * disk_used_size, diskused)
+
+
+
+def count_queued_messages(queued, delivered, dropped):
+  """
+  <Purpose>
+    Updates the counters for the recvmess message queues.
+
+  <Arguments>
+    queued:
+      The number of messages added to the queues.
+    delivered:
+      The number of messages taken from the queues and delivered.
+    dropped:
+      The number of messages dropped, either because a queue was full or
+      because the handle was stopped.   Messages dropped from a queue must
+      also be counted as taken from it, with a negative queued.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    None.
+  """
+  message_queue_lock.acquire()
+  try:
+    message_queue_counters['messqueued'] += queued - delivered
+    message_queue_counters['messdelivered'] += delivered
+    message_queue_counters['messdropped'] += dropped
+  finally:
+    message_queue_lock.release()
+
+
+
+def get_message_queue_counters():
+  """
+  <Purpose>
+    Returns the counters for the recvmess message queues.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    A dictionary with messqueued (the number of messages in the queues), 
+    messdelivered and messdropped.
+  """
+  message_queue_lock.acquire()
+  try:
+    return message_queue_counters.copy()
+  finally:
+    message_queue_lock.release()
+
+
+
+
+def count_accepted_connections(accepted, queuefull):
+  """
+  <Purpose>
+    Updates the counters for the waitforconn sockets after a socket was 
+    ready and its connections were accepted.
+
+  <Arguments>
+    accepted:
+      The number of connections accepted.
+    queuefull:
+      True if the accept queue was full.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    None.
+  """
+  accept_lock.acquire()
+  try:
+    accept_counters['connaccepted'] += accepted
+    accept_counters['connacceptbatches'] += 1
+    if queuefull:
+      accept_counters['connqueuefull'] += 1
+  finally:
+    accept_lock.release()
+
+
+
+def get_accept_counters():
+  """
+  <Purpose>
+    Returns the counters for the waitforconn sockets.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    A dictionary with connaccepted (the number of connections accepted), 
+    connacceptbatches (how many times a waitforconn socket was ready) and
+    connqueuefull (how many of those times its accept queue was full).
+  """
+  accept_lock.acquire()
+  try:
+    return accept_counters.copy()
+  finally:
+    accept_lock.release()
+
+
+
 # Armon: This is an extremely basic wrapper function, that just allows
 # for pre/post processing if required in the future
 def resource_limit(resource):
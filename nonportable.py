@@ -20,6 +20,9 @@ import sys
 # needed for signal numbers
 import signal
 
+# needed for errno.EINTR
+import errno
+
 # needed for harshexit
 import harshexit
 
@@ -51,8 +54,21 @@ import nmstatusinterface
 # This gives us our restrictions information
 import nanny_resource_limits
 
-# This is used for IPC
-import marshal
+# The resource monitor waits on a pipe to notice when repy exits
+import select
+
+# Used to keep the exit pipe from being inherited.   This will fail on 
+# Windows, but it isn't needed there.
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Used to set kernel enforced memory limits.   This will fail on Windows
+try:
+  import resource
+except ImportError:
+  resource = None
 
 # This will fail on non-windows systems
 try:
@@ -90,7 +106,7 @@ def compute_disk_use(dirname):
     # charge an extra 4K for each file to prevent lots of little files from 
     # using up the disk.   I'm doing this outside of the except clause in
     # the failure to get the size wasn't related to deletion
-    diskused = diskused + 4096
+    diskused = diskused + repy_constants.DISK_USE_PER_FILE
         
   return diskused
 
@@ -123,6 +139,10 @@ def preparesocket(socketobject):
 # This will result in an internal thread on Windows
 # and a thread on the external process for *NIX
 def monitor_cpu_disk_and_mem():
+  # Start the running count of the disk used from what is there now.   This
+  # is done before forking so the monitor starts with the same count.
+  nanny_resource_limits.set_disk_used(compute_disk_use(repy_constants.REPY_CURRENT_DIR))
+
   if ostype == 'Linux' or ostype == 'Darwin':  
     # Startup a CPU monitoring thread/process
     do_forked_resource_monitor()
@@ -165,6 +185,12 @@ granularity = 1
 # This ensures only one thread calling getruntime at any given time
 runtimelock = threading.Lock()
 
+# On Linux, getruntime reads the monotonic clock instead.   It never goes
+# backwards and isn't changed by NTP, so there is nothing to correct and no 
+# lock is needed.   This is the time of the monotonic clock when we were 
+# loaded, or None if the clock can't be used.
+monotonic_starttime = None
+
 def getruntime():
   """
    <Purpose>
@@ -182,7 +208,10 @@ def getruntime():
       None
 
    <Remarks>
-      By default this will have the same granularity as the system clock. However, if time 
+      On Linux this uses the monotonic clock, which has a fine granularity
+      and is not affected by NTP.
+
+      Elsewhere, by default this will have the same granularity as the system clock. However, if time 
       goes backward due to NTP or other issues, getruntime falls back to system uptime.
       This has much lower granularity, and varies by each system.
 
@@ -190,6 +219,10 @@ def getruntime():
       The elapsed time as float
   """
   global starttime, last_uptime, last_timestamp, elapsedtime, granularity, runtimelock
+
+  # Use the monotonic clock if we have it
+  if monotonic_starttime is not None:
+    return os_api.get_monotonic_time() - monotonic_starttime
   
   # Get the lock
   runtimelock.acquire()
@@ -263,7 +296,7 @@ def getruntime():
   return elapsedtime
  
 
-# This lock is used to serialize calls to get_resouces
+# This lock is used to serialize rebuilding the get_resources snapshot
 get_resources_lock = threading.Lock()
 
 # These are the resources we expose in get_resources
@@ -271,61 +304,51 @@ exposed_resources = set(["cpu","memory","diskused","events",
                      "filewrite","fileread","filesopened",
                      "insockets","outsockets","netsend",
                      "netrecv","loopsend","looprecv",
-                     "lograte","random","messport","connport"])
+                     "lograte","random","messport","connport",
+                     "messqueue","messrcvbuf","connbacklog",
+                     "connbuffer"])
             
 # These are the resources that we don't flatten using
 # len() for the usage. For example, instead of given the
 # set of thread's, we flatten this into N number of threads.
 flatten_exempt_resources = set(["connport","messport"])
 
-# Cache the disk used from the external process
-cached_disk_used = 0L
+# These are the type we need to copy or flatten
+check_types = set([list,dict,set])
 
 # This array holds the times that repy was stopped.
 # It is an array of tuples, of the form (time, amount)
 # where time is when repy was stopped (from getruntime()) and amount
 # is the stop time in seconds. The last process_stopped_max_entries are retained
+# On Linux / Mac, the stop times are kept by the resource monitor in 
+# monitor_state instead.
 process_stopped_timeline = []
 process_stopped_max_entries = 100
 
-# Method to expose resource limits and usage
-def get_resources():
-  """
-  <Purpose>
-    Returns the resouce utilization limits as well
-    as the current resource utilization.
-
-  <Arguments>
-    None.
-
-  <Returns>
-    A tuple of dictionaries and an array (limits, usage, stoptimes).
-
-    Limits is the dictionary which maps the resouce name
-    to its maximum limit.
+# On Linux / Mac, the resource monitor shares what it measures with repy 
+# through this.   It has to be set up before the monitor is forked.
+monitor_state = nanny_resource_limits.MonitorState(process_stopped_max_entries)
 
-    Usage is the dictionary which maps the resource name
-    to its current usage.
+# The last snapshot of the resource limits and usage.   This is a tuple 
+# (version, snapshottime, limits, usage, stoptimes) where version is the 
+# nanny_resource_limits.resource_consumption_version the snapshot was built 
+# from and snapshottime is when it was built (from getruntime()).   A 
+# snapshot is never changed once it is built, a new one replaces it.
+resources_snapshot = None
 
-    Stoptimes is an array of tuples with the times which the Repy proces
-    was stopped and for how long, due to CPU over-use.
-    Each entry in the array is a tuple (TOS, Sleep Time) where TOS is the
-    time of stop (respective to getruntime()) and Sleep Time is how long the
-    repy process was suspended.
 
-    The stop times array holds a fixed number of the last stop times.
-    Currently, it holds the last 100 stop times.
-  """
-  # Acquire the lock
-  get_resources_lock.acquire()
+# Builds a new snapshot for get_resources.   The caller must hold the 
+# get_resources_lock.
+def build_resources_snapshot():
+  # Get the version first, so that a change made while the tables are copied
+  # makes the snapshot out of date
+  version = nanny_resource_limits.resource_consumption_version
+  snapshottime = getruntime()
 
   # Construct the dictionaries as copies from nanny
   limits = nanny_resource_limits.resource_restriction_table.copy()
   usage = nanny_resource_limits.resource_consumption_table.copy()
 
-  # These are the type we need to copy or flatten
-  check_types = set([list,dict,set])
-
   # Check the limits dictionary for bad keys
   for resource in limits.keys():
     # Remove any resources we should not expose
@@ -333,7 +356,7 @@ def get_resources():
       del limits[resource]
 
     # Check the type
-    if type(limits[resource]) in check_types:
+    elif type(limits[resource]) in check_types:
       # Copy the data structure
       limits[resource] = limits[resource].copy()
 
@@ -346,7 +369,7 @@ def get_resources():
     # Check the type, copy any data structures
     # Flatten any structures using len() other than
     # "connport" and "messport"
-    if type(usage[resource]) in check_types:
+    elif type(usage[resource]) in check_types:
       # Check if they are exempt from flattening, store a shallow copy
       if resource in flatten_exempt_resources:
         usage[resource] = usage[resource].copy()
@@ -360,17 +383,24 @@ def get_resources():
   # Calculate all the usage's
   pid = os.getpid()
 
-  # Get CPU and memory, this is thread specific
+  # Get the stop times
+  stoptimes = None
+
+  # Get CPU and memory
   if ostype in ["Linux", "Darwin"]:
     
-    # Get CPU first, then memory
-    usage["cpu"] = os_api.get_process_cpu_time(pid)
+    # Use what the resource monitor last measured, if it is running
+    monitorinfo = monitor_state.read()
+    if monitorinfo is not None:
+      (counters, stoptimes) = monitorinfo
+      usage.update(counters)
 
-    # This uses the cached PID data from the CPU check
-    usage["memory"] = os_api.get_process_rss()
+    else:
+      # Get CPU first, then memory
+      usage["cpu"] = os_api.get_process_cpu_time(pid)
 
-    # Get the thread specific CPU usage
-    usage["threadcpu"] = os_api.get_current_thread_cpu_time() 
+      # This uses the cached PID data from the CPU check
+      usage["memory"] = os_api.get_process_rss()
 
 
   # Windows Specific versions
@@ -382,21 +412,120 @@ def get_resources():
     # Get the memory, use the resident set size
     usage["memory"] = windows_api.process_memory_info(pid)['WorkingSetSize'] 
 
-    # Get thread-level CPU 
-    usage["threadcpu"] = windows_api.get_current_thread_cpu_time()
-
   # Unknown OS
   else:
     raise EnvironmentError("Unsupported Platform!")
 
-  # Use the cached disk used amount
-  usage["diskused"] = cached_disk_used
+  # Copy the stop times
+  if stoptimes is None:
+    stoptimes = process_stopped_timeline[:]
 
-  # Release the lock
-  get_resources_lock.release()
+  return (version, snapshottime, limits, usage, stoptimes)
 
-  # Copy the stop times
-  stoptimes = process_stopped_timeline[:]
+
+
+# Copies a dictionary from a snapshot, along with any data structures in it
+def copy_snapshot_dict(snapshotdict):
+  copieddict = snapshotdict.copy()
+
+  for resource in copieddict:
+    if type(copieddict[resource]) in check_types:
+      copieddict[resource] = copieddict[resource].copy()
+
+  return copieddict
+
+
+
+# Method to expose resource limits and usage
+def get_resources(maxage=None):
+  """
+  <Purpose>
+    Returns the resouce utilization limits as well
+    as the current resource utilization.   These come from a snapshot that 
+    is rebuilt when the nanny's tables change or when it gets too old.
+
+  <Arguments>
+    maxage:
+      How old (in seconds) the snapshot is allowed to be.   This defaults to
+      repy_constants.RESOURCE_SNAPSHOT_MAX_AGE.   Use 0 to always get the 
+      current values.
+
+  <Returns>
+    A tuple of dictionaries and an array (limits, usage, stoptimes).
+
+    Limits is the dictionary which maps the resouce name
+    to its maximum limit.
+
+    Usage is the dictionary which maps the resource name
+    to its current usage.   The thread CPU time and disk used are always 
+    current, the rest may be up to maxage seconds old.
+
+    Usage also has messqueued, messdelivered and messdropped, the number of
+    messages waiting in the recvmess queues (see the messqueue resource) and
+    how many have been delivered and dropped.   These are always current.
+    Likewise, connaccepted, connacceptbatches and connqueuefull count the 
+    connections accepted on waitforconn sockets, how many times one was 
+    ready, and how many of those times its accept queue (see the 
+    connbacklog resource) was full.
+
+    On Linux / Mac, CPU and memory are what the resource monitor measured
+    at its last check.   Usage also has statistics about the resource 
+    monitoring itself.   monitorcpu is the CPU time used by the resource 
+    monitor, monitorwakeups is how many times it has checked repy, and 
+    throttledebt and throttleusage are the CPU time repy has used beyond its
+    allowance and the estimated fraction of the CPU it uses while running.
+
+    Stoptimes is an array of tuples with the times which the Repy proces
+    was stopped and for how long, due to CPU over-use.
+    Each entry in the array is a tuple (TOS, Sleep Time) where TOS is the
+    time of stop (respective to getruntime()) and Sleep Time is how long the
+    repy process was suspended.
+
+    The stop times array holds a fixed number of the last stop times.
+    Currently, it holds the last 100 stop times.
+  """
+  global resources_snapshot
+
+  if maxage is None:
+    maxage = repy_constants.RESOURCE_SNAPSHOT_MAX_AGE
+
+  # Use the current snapshot if it is still good.   This doesn't need the
+  # lock, snapshots are never changed.
+  snapshot = resources_snapshot
+  if snapshot is None or snapshot[0] != nanny_resource_limits.resource_consumption_version or getruntime() - snapshot[1] > maxage:
+
+    get_resources_lock.acquire()
+    try:
+      # Someone else may have just rebuilt it
+      snapshot = resources_snapshot
+      if snapshot is None or snapshot[0] != nanny_resource_limits.resource_consumption_version or getruntime() - snapshot[1] > maxage:
+        snapshot = build_resources_snapshot()
+        resources_snapshot = snapshot
+    finally:
+      get_resources_lock.release()
+
+  (version, snapshottime, limits, usage, stoptimes) = snapshot
+
+  # Give the caller copies they can change
+  limits = copy_snapshot_dict(limits)
+  usage = copy_snapshot_dict(usage)
+  stoptimes = stoptimes[:]
+
+  # Get the thread specific CPU usage, this can't be shared
+  if ostype in ["Linux", "Darwin"]:
+    usage["threadcpu"] = os_api.get_current_thread_cpu_time() 
+  else:
+    usage["threadcpu"] = windows_api.get_current_thread_cpu_time()
+
+  # Use the running count of the disk used
+  usage["diskused"] = nanny_resource_limits.get_disk_used()
+
+  # How many messages are waiting in the recvmess queues, and how many have
+  # been delivered and dropped
+  usage.update(nanny_resource_limits.get_message_queue_counters())
+
+  # How many connections waitforconn sockets have accepted
+  usage.update(nanny_resource_limits.get_accept_counters())
 
   # Return the dictionaries and the stoptimes
   return (limits,usage,stoptimes)
@@ -410,11 +539,11 @@ class WindowsNannyThread(threading.Thread):
     threading.Thread.__init__(self,name="NannyThread")
 
   def run(self):
-    # Calculate how often disk should be checked
+    # Calculate how often the directory should be scanned
     if ostype == "WindowsCE":
-      disk_interval = int(repy_constants.RESOURCE_POLLING_FREQ_WINCE / repy_constants.CPU_POLLING_FREQ_WINCE)
+      disk_interval = int(repy_constants.DISK_RESCAN_INTERVAL / repy_constants.CPU_POLLING_FREQ_WINCE)
     else:
-      disk_interval = int(repy_constants.RESOURCE_POLLING_FREQ_WIN / repy_constants.CPU_POLLING_FREQ_WIN)
+      disk_interval = int(repy_constants.DISK_RESCAN_INTERVAL / repy_constants.CPU_POLLING_FREQ_WIN)
     current_interval = 0 # What cycle are we on  
     
     # Elevate our priority, above normal is higher than the usercode, and is enough for disk/mem
@@ -436,12 +565,15 @@ class WindowsNannyThread(threading.Thread):
         # Increment the interval we are on
         current_interval += 1
 
-        # Check if we should check the disk
+        # Check if we should check the count of the disk used against 
+        # what is really there
         if (current_interval % disk_interval) == 0:
-          # Check diskused
-          diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
-          if diskused > nanny_resource_limits.resource_limit("diskused"):
-            raise Exception, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'"
+          rescan_disk_use()
+
+        # Check diskused
+        diskused = nanny_resource_limits.get_disk_used()
+        if diskused > nanny_resource_limits.resource_limit("diskused"):
+          raise Exception, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'"
         
         if ostype == 'WindowsCE':
           time.sleep(repy_constants.CPU_POLLING_FREQ_WINCE)
@@ -571,24 +703,15 @@ class WinCPUNannyThread(threading.Thread):
 
 ##############     *nix specific functions (may include Mac)  ###############
 
-# This method handles messages on the "diskused" channel from
-# the external process. When the external process measures disk used,
-# it is piped in and cached for calls to getresources.
-def IPC_handle_diskused(bytes):
-  cached_disk_used = bytes
-
+# Checks the running count of the disk used against a scan of the directory
+# and corrects it if they disagree.   If repy changed the count during the 
+# scan, the scan is ignored.
+def rescan_disk_use():
+  counted = nanny_resource_limits.get_counted_disk_used()
+  scanned = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
 
-# This method handles meessages on the "repystopped" channel from
-# the external process. When the external process stops repy, it sends
-# a tuple with (TOS, amount) where TOS is time of stop (getruntime()) and
-# amount is the amount of time execution was suspended.
-def IPC_handle_stoptime(info):
-  # Push this onto the timeline
-  process_stopped_timeline.append(info)
-
-  # Drop the first element if the length is greater than the max
-  if len(process_stopped_timeline) > process_stopped_max_entries:
-    process_stopped_timeline.pop(0)
+  if nanny_resource_limits.get_counted_disk_used() == counted:
+    nanny_resource_limits.set_disk_correction(scanned - counted)
 
 
 # Use a special class of exception for when
@@ -597,118 +720,9 @@ class ResourceException(Exception):
   pass
 
 
-# Armon: Method to write a message to the pipe, used for IPC.
-# This allows the pipe to be multiplexed by sending simple dictionaries
-def write_message_to_pipe(writehandle, channel, data):
-  """
-  <Purpose>
-    Writes a message to the pipe
-
-  <Arguments>
-    writehandle:
-        A handle to a pipe which can be written to.
-
-    channel:
-        The channel used to describe the data. Used for multiplexing.
-
-    data:
-        The data to send.
-
-  <Exceptions>
-    As with os.write()
-    EnvironmentError will be thrown if os.write() sends 0 bytes, indicating the
-    pipe is broken.
-  """
-  # Construct the dictionary
-  mesg_dict = {"ch":channel,"d":data}
-
-  # Convert to a string
-  mesg_dict_str = marshal.dumps(mesg_dict)
-
-  # Make a full string
-  mesg = str(len(mesg_dict_str)) + ":" + mesg_dict_str
-
-  # Send this
-  index = 0
-  while index < len(mesg):
-    bytes = os.write(writehandle, mesg[index:])
-    if bytes == 0:
-      raise EnvironmentError, "Write send 0 bytes! Pipe broken!"
-    index += bytes
-
-
-# Armon: Method to read a message from the pipe, used for IPC.
-# This allows the pipe to be multiplexed by sending simple dictionaries
-def read_message_from_pipe(readhandle):
-  """
-  <Purpose>
-    Reads a message from a pipe.
-
-  <Arguments>
-    readhandle:
-        A handle to a pipe which can be read from
-
-  <Exceptions>
-    As with os.read().
-    EnvironmentError will be thrown if os.read() returns a 0-length string, indicating
-    the pipe is broken.
-
-  <Returns>
-    A tuple (Channel, Data) where Channel is used to multiplex the pipe.
-  """
-  # Read until we get to a colon
-  data = ""
-  index = 0
-
-  # Loop until we get a message
-  while True:
-
-    # Read in data if the buffer is empty
-    if index >= len(data):
-      # Read 8 bytes at a time
-      mesg = os.read(readhandle,8)
-      if len(mesg) == 0:
-        raise EnvironmentError, "Read returned emtpy string! Pipe broken!"
-      data += mesg
-
-    # Increment the index while there is data and we have not found a colon
-    while index < len(data) and data[index] != ":":
-      index += 1
-
-    # Check if we've found a colon
-    if len(data) > index and data[index] == ":":
-      # Get the message length
-      mesg_length = int(data[:index])
-
-      # Determine how much more data we need
-      more_data = mesg_length - len(data) + index + 1
-
-      # Read in the rest of the message
-      while more_data > 0:
-        mesg = os.read(readhandle, more_data)
-        if len(mesg) == 0:
-          raise EnvironmentError, "Read returned emtpy string! Pipe broken!"
-        data += mesg
-        more_data -= len(mesg)
-
-      # Done, convert the message to a dict
-      whole_mesg = data[index+1:]
-      mesg_dict = marshal.loads(whole_mesg)
-
-      # Return a tuple (Channel, Data)
-      return (mesg_dict["ch"],mesg_dict["d"])
-
-
-
-# This dictionary defines the functions that handle messages
-# on each channel. E.g. when a message arrives on the "repystopped" channel,
-# the IPC_handle_stoptime function should be invoked to handle it.
-IPC_HANDLER_FUNCTIONS = {"repystopped":IPC_handle_stoptime,
-                         "diskused":IPC_handle_diskused }
-
-
-# This thread checks that the parent process is alive and invokes
-# delegate methods when messages arrive on the pipe.
+# This thread checks that the parent process is alive.   Nothing is sent on
+# the pipe (the monitor shares what it measures through monitor_state), so it
+# only becomes readable when the parent dies.
 class parent_process_checker(threading.Thread):
   def __init__(self, readhandle):
     """
@@ -727,21 +741,17 @@ class parent_process_checker(threading.Thread):
   def run(self):
     # Run forever
     while True:
-      # Read a message
+      # Wait for the pipe to close
       try:
-        mesg = read_message_from_pipe(self.readhandle)
-      except Exception, e:
+        mesg = os.read(self.readhandle, 8)
+      except OSError, e:
+        # Interrupted, try again
+        if e.errno == errno.EINTR:
+          continue
         break
 
-      # Check for a handler function
-      if mesg[0] in IPC_HANDLER_FUNCTIONS:
-        # Invoke the handler function with the data
-        handler = IPC_HANDLER_FUNCTIONS[mesg[0]]
-        handler(mesg[1])
-
-      # Print a message if there is a message on an unknown channel
-      else:
-        print "[WARN] Message on unknown channel from parent process:", mesg[0]
+      if len(mesg) == 0:
+        break
 
 
     ### We only leave the loop on a fatal error, so we need to exit now
@@ -757,14 +767,87 @@ class parent_process_checker(threading.Thread):
 # pid for the actual repy process is stored here
 repy_process_id = None
 
+# The kernel enforced memory limits set on the repy process.   This is a list
+# of tuples (rlimit, soft limit, hard limit) or None if they aren't used.
+memory_rlimits = None
+
+
+# Default size of a thread's stack if there isn't a stack limit
+DEFAULT_THREAD_STACK_SIZE = 8 * 1024 * 1024
+
+# Determines the kernel enforced memory limits to set on the repy process
+def get_memory_rlimits():
+  """
+  <Purpose>
+    Determines what RLIMIT_AS and RLIMIT_DATA should be set to for repy, given
+    its memory limit.   These limit virtual memory, so what is already mapped
+    and room for the thread stacks are added to the memory limit.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Returns>
+    A list of tuples (rlimit, soft limit, hard limit) or None if kernel 
+    enforced limits shouldn't or can't be used.
+  """
+  if not repy_constants.MEMORY_RLIMIT_ENABLED or resource is None or ostype != "Linux":
+    return None
+
+  try:
+    (vmsize, vmdata) = os_api.get_process_virtual_memory(os.getpid())
+  except Exception:
+    # We can't tell how much is already mapped, so we can't pick a limit
+    return None
+
+  # Each thread gets a stack the size of the stack limit (or a default if 
+  # there isn't a limit)
+  stacksize = resource.getrlimit(resource.RLIMIT_STACK)[0]
+  if stacksize == resource.RLIM_INFINITY:
+    stacksize = DEFAULT_THREAD_STACK_SIZE
+
+  threadcount = nanny_resource_limits.resource_limit("events") + repy_constants.MEMORY_RLIMIT_EXTRA_THREADS
+
+  datalimit = vmdata + long(nanny_resource_limits.resource_limit("memory") + 
+      threadcount * stacksize + repy_constants.MEMORY_RLIMIT_HEADROOM)
+
+  # malloc may also reserve (but not use) an arena of address space per 
+  # thread.   This counts against RLIMIT_AS but not RLIMIT_DATA.
+  aslimit = datalimit - vmdata + vmsize + threadcount * repy_constants.MEMORY_RLIMIT_THREAD_ARENA_SIZE
+
+  rlimits = []
+  for (rlimit, limit) in [(resource.RLIMIT_AS, aslimit), (resource.RLIMIT_DATA, datalimit)]:
+    (soft, hard) = resource.getrlimit(rlimit)
+
+    # We can't go over the hard limit
+    if hard != resource.RLIM_INFINITY:
+      limit = min(limit, hard)
+
+    rlimits.append((rlimit, limit, hard))
+
+  return rlimits
+
+
 # Forks Repy. The child will continue execution, and the parent
 # will become a resource monitor
 def do_forked_resource_monitor():
   global repy_process_id
+  global memory_rlimits
 
   # Get a pipe
   (readhandle, writehandle) = os.pipe()
 
+  # This pipe is never written to.   The child holds the write end open, so
+  # the read end becomes readable (EOF) as soon as the child exits.   This 
+  # lets the monitor sleep for a long time and still notice right away.
+  (exitreadhandle, exitwritehandle) = os.pipe()
+
+  # Figure out the memory limits before forking so the monitor knows if the
+  # kernel is enforcing the memory limit
+  memory_rlimits = get_memory_rlimits()
+
   # I'll fork a copy of myself
   childpid = os.fork()
 
@@ -772,6 +855,15 @@ def do_forked_resource_monitor():
     # We are the child, close the write end of the pipe
     os.close(writehandle)
 
+    # Keep the exit pipe to ourselves, processes we start shouldn't hold it
+    os.close(exitreadhandle)
+    fcntl.fcntl(exitwritehandle, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    # Have the kernel enforce the memory limit before any user code runs
+    if memory_rlimits is not None:
+      for (rlimit, soft, hard) in memory_rlimits:
+        resource.setrlimit(rlimit, (soft, hard))
+
     # Start a thread to check on the survival of the parent
     parent_process_checker(readhandle).start()
 
@@ -779,6 +871,7 @@ def do_forked_resource_monitor():
   else:
     # We are the parent, close the read end
     os.close(readhandle)
+    os.close(exitwritehandle)
 
   # Store the childpid
   repy_process_id = childpid
@@ -812,7 +905,7 @@ def do_forked_resource_monitor():
     (pid, status) = os.waitpid(childpid,os.WNOHANG)
     
     # Launch the resource monitor, if it fails determine why and restart if necessary
-    resource_monitor(childpid, writehandle)
+    resource_monitor(childpid, exitreadhandle)
     
   except ResourceException, exp:
     # Repy exceeded its resource limit, kill it
@@ -835,118 +928,215 @@ def do_forked_resource_monitor():
       _internal_error(str(exp)+" Monitor death! Impolitely killing child!")
       raise
   
-def resource_monitor(childpid, pipe_handle):
+def resource_monitor(childpid, exit_handle):
   """
   <Purpose>
     Function runs in a loop forever, checking resource usage and throttling CPU.
-    Checks CPU, memory, and disk.
+    Checks CPU, memory, and disk.   Memory is checked often when it is near
+    its limit, and less and less often while use is low or repy is blocked.
+    Disk use is counted by repy as files change, so it is checked on every 
+    wake up and the directory is only scanned once in a while.   What is 
+    measured is shared with repy through monitor_state.
     
   <Arguments>
     childpid:
       The child pid, e.g. the pid of repy
 
-    pipe_handle:
-      A handle to the pipe to the repy process. Allows sending resource use information.
+    exit_handle:
+      A handle to a pipe that becomes readable when repy exits.
   """
   # Get our pid
   ourpid = os.getpid()
-  
-  # Calculate how often disk should be checked
-  disk_interval = int(repy_constants.RESOURCE_POLLING_FREQ_LINUX / repy_constants.CPU_POLLING_FREQ_LINUX)
-  current_interval = -1 # What cycle are we on  
-  
-  # Store time of the last interval
-  last_time = getruntime()
-  last_CPU_time = 0
-  resume_time = 0 
+
+  # Use the high resolution clocks if we have them, the CPU is throttled with
+  # many short stops so jiffies are too coarse
+  if ostype == "Linux":
+    get_cpu_time = os_api.get_precise_process_cpu_time
+    get_time = os_api.get_monotonic_time
+  else:
+    get_cpu_time = os_api.get_process_cpu_time
+    get_time = getruntime
+
+  # This decides when and how long to stop repy
+  controller = nanny_resource_limits.CPUThrottleController(
+      nanny_resource_limits.resource_limit("cpu"),
+      repy_constants.CPU_THROTTLE_MAX_STOP,
+      repy_constants.CPU_THROTTLE_MIN_RUN,
+      repy_constants.CPU_POLLING_FREQ_LINUX,
+      repy_constants.CPU_POLLING_MAX_INTERVAL_LINUX)
+
+  # Store time and CPU use at the start and at the last sample
+  start_time = get_time()
+  start_our_CPU_time = get_cpu_time(ourpid)
+  start_CPU_time = start_our_CPU_time + get_cpu_time(childpid)
+  last_time = start_time
+  last_CPU_time = start_CPU_time
+
+  # How long repy was stopped since the last sample
+  stoptime = 0.0
+
+  # Stops are recorded in batches rather than one entry per stop, so the 
+  # stop times cover a useful amount of time.   This is the time of the 
+  # first unrecorded stop and the total unrecorded stop time.
+  unreported_stop_start = None
+  unreported_stop_time = 0.0
+  longest_stop = 0.0
+
+  # When the other resources should be checked next, and how often they are
+  # being checked.   If repy has barely used the CPU since a resource was 
+  # last checked, its use can't have changed much.   If the kernel enforces
+  # the memory limit, the memory check is only a safety net and is done as
+  # rarely as the disk check.
+  if memory_rlimits is None:
+    min_memory_interval = repy_constants.CPU_POLLING_FREQ_LINUX
+    max_memory_interval = repy_constants.CPU_POLLING_MAX_INTERVAL_LINUX
+  else:
+    min_memory_interval = repy_constants.RESOURCE_POLLING_FREQ_LINUX
+    max_memory_interval = repy_constants.RESOURCE_POLLING_MAX_INTERVAL_LINUX
+  memory_interval = min_memory_interval
+  next_memory_check = start_time
+  memory_check_CPU_time = None
+
+  # Repy keeps a running count of the disk used, which is checked every time.
+  # The directory is only scanned once in a while to correct the count.
+  next_disk_scan = start_time + repy_constants.DISK_RESCAN_INTERVAL
+
+  # Stops are recorded and the report file is written at most this often
+  next_report = start_time
+  wakeups = 0
+
+  # What is shared with repy through monitor_state
+  counters = {"memory":0}
+
+  # Open the report file if we were asked to write one
+  reportfile = None
+  if repy_constants.CPU_THROTTLE_REPORT_FILE:
+    reportfile = open(repy_constants.CPU_THROTTLE_REPORT_FILE, "w")
+  report_time = start_time
+  report_CPU_time = start_CPU_time
   
   # Run forever...
   while True:
     ########### Check CPU ###########
-    # Get elasped time
-    currenttime = getruntime()
-    elapsedtime1 = currenttime - last_time     # Calculate against last run
-    elapsedtime2 = currenttime - resume_time   # Calculate since we last resumed repy
-    elapsedtime = min(elapsedtime1, elapsedtime2) # Take the minimum interval
-    last_time = currenttime  # Save the current time
-    
-    # Safety check, prevent ZeroDivisionError
-    if elapsedtime == 0.0:
-      continue
+    # Get the current time and the total cpu at this point, ours and repy's
+    wakeups += 1
+    currenttime = get_time()
+    ourCPU = get_cpu_time(ourpid)
+    childCPU = get_cpu_time(childpid)
+    totalCPU = ourCPU + childCPU
+
+    # Tell the controller how much was used since the last sample, split into
+    # the time repy was running and the time it was stopped
+    elapsedtime = currenttime - last_time
+    controller.update(totalCPU - last_CPU_time, max(elapsedtime - stoptime, 0.0), stoptime)
+    last_time = currenttime
+    last_CPU_time = totalCPU
     
-    # Get the total cpu at this point
-    totalCPU =  os_api.get_process_cpu_time(ourpid)   # Our own usage
-    totalCPU += os_api.get_process_cpu_time(childpid) # Repy's usage
-    
-    # Calculate percentage of CPU used
-    percentused = (totalCPU - last_CPU_time) / elapsedtime
-    
-    # Do not throttle for the first interval, wrap around
-    # Store the totalCPU for the next cycle
-    if last_CPU_time == 0:
-      last_CPU_time = totalCPU    
-      continue
-    else:
-      last_CPU_time = totalCPU
-      
-    # Calculate stop time
-    stoptime = nanny_resource_limits.calculate_cpu_sleep_interval(nanny_resource_limits.resource_limit("cpu"), percentused, elapsedtime)
+    # Calculate stop time and how long to let repy run afterwards
+    (stoptime, runtime) = controller.get_next_interval()
     
     # If we are supposed to stop repy, then suspend, sleep and resume
     if stoptime > 0.0:
       # They must be punished by stopping
       os.kill(childpid, signal.SIGSTOP)
+      stopstart = get_time()
 
       # Sleep until time to resume
       time.sleep(stoptime)
 
       # And now they can start back up!
       os.kill(childpid, signal.SIGCONT)
-      
-      # Save the resume time
-      resume_time = getruntime()
 
-      # Send this information as a tuple containing the time repy was stopped and
-      # for how long it was stopped
-      write_message_to_pipe(pipe_handle, "repystopped", (currenttime, stoptime))
-      
+      # Keep track of how long they were actually stopped
+      stoptime = get_time() - stopstart
+      if unreported_stop_start is None:
+        unreported_stop_start = getruntime()
+      unreported_stop_time += stoptime
+      longest_stop = max(longest_stop, stoptime)
     
     ########### End Check CPU ###########
+    #
+    ########### Report ###########
+
+    if currenttime >= next_report:
+      next_report = currenttime + repy_constants.CPU_POLLING_FREQ_LINUX
+
+      # Record the time repy was first stopped and for how long it was 
+      # stopped in total
+      if unreported_stop_start is not None:
+        monitor_state.add_stop(unreported_stop_start, unreported_stop_time)
+        unreported_stop_start = None
+        unreported_stop_time = 0.0
+
+      # Write a line to the report file, if there is one
+      if reportfile:
+        reportfile.write("%f %f %f %f %f\n" % (
+            (totalCPU - start_CPU_time) / max(currenttime - start_time, 0.000001),
+            (totalCPU - report_CPU_time) / max(currenttime - report_time, 0.000001),
+            totalCPU - start_CPU_time, currenttime - start_time, longest_stop))
+        reportfile.flush()
+        report_time = currenttime
+        report_CPU_time = totalCPU
+
+    ########### End Report ###########
     # 
     ########### Check Memory ###########
     
-    # Get how much memory repy is using
-    memused = os_api.get_process_rss()
+    if currenttime >= next_memory_check:
+      # Get how much memory repy is using
+      memused = os_api.get_process_rss(force_update=True, pid=childpid)
     
-    # Check if it is using too much memory
-    if memused > nanny_resource_limits.resource_limit("memory"):
-      raise ResourceException, "Memory use '"+str(memused)+"' over limit '"+str(nanny_resource_limits.resource_limit("memory"))+"'."
+      # Check if it is using too much memory
+      if memused > nanny_resource_limits.resource_limit("memory"):
+        raise ResourceException, "Memory use '"+str(memused)+"' over limit '"+str(nanny_resource_limits.resource_limit("memory"))+"'."
+
+      counters["memory"] = memused
+
+      # Decide when to check again, back off if repy is blocked
+      if memory_check_CPU_time is not None and childCPU - memory_check_CPU_time < repy_constants.MONITOR_BLOCKED_CPU_TIME:
+        memused = 0
+      memory_interval = nanny_resource_limits.calculate_polling_interval(
+          memory_interval, memused, nanny_resource_limits.resource_limit("memory"),
+          min_memory_interval, max_memory_interval)
+      next_memory_check = currenttime + memory_interval
+      memory_check_CPU_time = childCPU
     
     ########### End Check Memory ###########
     # 
     ########### Check Disk Usage ###########
-    # Increment our current cycle
-    current_interval += 1;
-    
-    # Check if it is time to check the disk usage
-    if (current_interval % disk_interval) == 0:
-      # Reset the interval
-      current_interval = 0
-       
-      # Calculate disk used
-      diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
-
-      # Raise exception if we are over limit
-      if diskused > nanny_resource_limits.resource_limit("diskused"):
-        raise ResourceException, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'."
-
-      # Send the disk usage information, raw bytes used
-      write_message_to_pipe(pipe_handle, "diskused", diskused)
+    diskused = nanny_resource_limits.get_disk_used()
+
+    # Check if it is time to scan the directory.   If the count is off (e.g.
+    # something other than repy changed the files), correct it.
+    if currenttime >= next_disk_scan:
+      rescan_disk_use()
+      diskused = nanny_resource_limits.get_disk_used()
+      next_disk_scan = currenttime + repy_constants.DISK_RESCAN_INTERVAL
+
+    # Raise exception if we are over limit
+    if diskused > nanny_resource_limits.resource_limit("diskused"):
+      raise ResourceException, "Disk use '"+str(diskused)+"' over limit '"+str(nanny_resource_limits.resource_limit("diskused"))+"'."
     
     ########### End Check Disk ###########
+
+    # Share what we measured with repy
+    counters["cpu"] = childCPU
+    counters["monitorcpu"] = ourCPU - start_our_CPU_time
+    counters["monitorwakeups"] = wakeups
+    counters["throttledebt"] = controller.debt
+    counters["throttleusage"] = controller.usage
+    monitor_state.publish(counters)
     
-    # Sleep before the next iteration
-    time.sleep(repy_constants.CPU_POLLING_FREQ_LINUX)
+    # Let repy run until the next sample or check, whichever is first
+    currenttime = get_time()
+    sleeptime = min(runtime, next_memory_check - currenttime, next_disk_scan - currenttime)
+
+    # Wake up early if repy exits
+    (readable, writable, exceptional) = select.select([exit_handle], [], [], max(sleeptime, 0.0))
+    if readable:
+      # Repy is gone, wait for it to finish exiting and then exit ourselves
+      os.waitpid(childpid, 0)
+      sys.exit(0)
 
 
 ###########     functions that help me figure out the os type    ###########
@@ -1021,6 +1211,13 @@ else:
   # Reset elapsed time 
   elapsedtime = 0
 
+  # Use the monotonic clock on Linux if it works
+  if osrealtype == "Linux":
+    try:
+      monotonic_starttime = os_api.get_monotonic_time()
+    except Exception:
+      monotonic_starttime = None
+
 
 # Conrad: initialize nanny (Prevents circular imports)
 # Note: nanny_resource_limits can be initialized at any time after getruntime()
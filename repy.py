@@ -38,6 +38,10 @@
   --status filename.txt  : Write status information into this file
   --cwd dir              : Set Current working directory
   --servicelog           : Enable usage of the servicelogger for internal errors
+  --norestrictions       : Disable the use of function restrictions, but not resource limits
+  --cputhrottlereport filename.txt : Write CPU usage and throttling information into this file
+  --throttletrace filename.txt : Write every wait for a resource and a summary (on exit or SIGUSR1) into this file
+  --memoryrlimit         : Have the kernel also enforce the memory limit (Linux only)
 """
 
 
@@ -73,6 +77,9 @@ import virtual_namespace
 ## we'll use tracebackrepy to print our exceptions
 import tracebackrepy
 
+# So the idle event threads don't keep the program from exiting
+import eventpool
+
 
 # This block allows or denies different actions in the safe module.   I'm 
 # doing this here rather than the natural place in the safe module because
@@ -213,6 +220,9 @@ def main(restrictionsfn, program, args):
 
   try:
     main_namespace.evaluate(usercontext)
+
+    # charge anything that was batched up during the event
+    nanny.flush_thread_charges()
   except SystemExit:
     raise
   except:
@@ -224,8 +234,9 @@ def main(restrictionsfn, program, args):
 
 
   # I've changed to the threading library, so this should increase if there are
-  # pending events
-  while threading.activeCount() > idlethreadcount:
+  # pending events.   The event threads stay around after the events finish,
+  # so the idle ones are not counted
+  while threading.activeCount() - eventpool.get_idle_thread_count() > idlethreadcount:
     # do accounting here?
     time.sleep(0.25)
 
@@ -298,6 +309,9 @@ Where [options] are some combination of the following:
 --cwd dir              : Set Current working directory
 --servicelog           : Enable usage of the servicelogger for internal errors
 --norestrictions       : Disable the use of function restrictions, but not resource limits
+--cputhrottlereport filename.txt : Write CPU usage and throttling information into this file
+--throttletrace filename.txt : Write every wait for a resource and a summary (on exit or SIGUSR1) into this file
+--memoryrlimit         : Have the kernel also enforce the memory limit (Linux only)
 """
   return
 
@@ -344,7 +358,8 @@ if __name__ == '__main__':
   try:
     optlist, fnlist = getopt.getopt(args, '', [
       'simple', 'execinfo', 'ip=', 'iface=', 'nootherips', 'logfile=',
-      'stop=', 'status=', 'cwd=', 'servicelog', 'norestrictions'
+      'stop=', 'status=', 'cwd=', 'servicelog', 'norestrictions',
+      'cputhrottlereport=', 'throttletrace=', 'memoryrlimit'
       ])
 
   except getopt.GetoptError:
@@ -426,6 +441,18 @@ if __name__ == '__main__':
     elif option == '--execinfo':
       displayexecinfo = True
 
+    # Have the resource monitor write out how the CPU is throttled
+    elif option == '--cputhrottlereport':
+      repy_constants.CPU_THROTTLE_REPORT_FILE = os.path.abspath(value)
+
+    # Record which resources and calls are being throttled
+    elif option == '--throttletrace':
+      repy_constants.THROTTLE_TRACE_FILE = os.path.abspath(value)
+
+    # Set RLIMIT_AS / RLIMIT_DATA so the kernel enforces the memory limit
+    elif option == '--memoryrlimit':
+      repy_constants.MEMORY_RLIMIT_ENABLED = True
+
   # Update repy current directory
   repy_constants.REPY_CURRENT_DIR = os.path.abspath(os.getcwd())
 
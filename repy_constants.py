@@ -36,6 +36,114 @@ CPU_POLLING_FREQ_LINUX = .1 # Linux
 CPU_POLLING_FREQ_WIN = .1 # Windows
 CPU_POLLING_FREQ_WINCE = .5 # Mobile devices are pretty slow
 
+# On Linux / Mac the resources are checked less often while use is low or 
+# repy is blocked.   The time between checks doubles up to these values.   
+# CPU and memory back off to CPU_POLLING_MAX_INTERVAL_LINUX (or 
+# RESOURCE_POLLING_MAX_INTERVAL_LINUX if the kernel enforces the memory 
+# limit).
+CPU_POLLING_MAX_INTERVAL_LINUX = 1.0
+RESOURCE_POLLING_MAX_INTERVAL_LINUX = 4.0
+
+# If repy uses less CPU time than this between two checks of memory, it is 
+# considered blocked and those checks back off as well.
+MONITOR_BLOCKED_CPU_TIME = .001
+
+# get_resources returns a snapshot of the resource usage.   The snapshot is 
+# rebuilt when the nanny's tables change, or when it is older than this (in 
+# seconds) since the CPU and memory use change all the time.
+RESOURCE_SNAPSHOT_MAX_AGE = .1
+
+# The disk used is counted as files are written, truncated, created and 
+# removed.   Each file is also charged DISK_USE_PER_FILE bytes so that lots
+# of little files can't use up the disk.   The count is checked against the 
+# directory's actual contents every DISK_RESCAN_INTERVAL seconds.
+DISK_USE_PER_FILE = 4096
+DISK_RESCAN_INTERVAL = 30.0
+
+# When the CPU limit is being enforced on Linux / Mac, the process is stopped
+# for many short periods rather than a few long ones.   This is the longest
+# it is normally stopped for, and the shortest it will be allowed to run 
+# between stops.   Very low CPU limits may require longer stops.
+CPU_THROTTLE_MAX_STOP = .005
+CPU_THROTTLE_MIN_RUN = .002
+
+# On Linux, the kernel also enforces the memory limit by setting RLIMIT_AS and
+# RLIMIT_DATA on the repy process.   These limit virtual memory rather than
+# RSS, so the limits are what repy already has mapped, plus the memory limit,
+# plus room for a thread stack per event (and MEMORY_RLIMIT_EXTRA_THREADS 
+# internal threads), plus MEMORY_RLIMIT_HEADROOM.   RLIMIT_AS also has room
+# for the address space malloc reserves for each thread (this is 64MB on 
+# 64 bit glibc).   RSS is still checked by the resource monitor, but less 
+# often.   This is off unless the --memoryrlimit option is given.
+MEMORY_RLIMIT_ENABLED = False
+MEMORY_RLIMIT_EXTRA_THREADS = 8
+MEMORY_RLIMIT_HEADROOM = 16 * 1024 * 1024
+MEMORY_RLIMIT_THREAD_ARENA_SIZE = 64 * 1024 * 1024
+
+# If set, the Linux / Mac resource monitor writes a line with the CPU usage 
+# into this file about every CPU_POLLING_FREQ_LINUX seconds.   The columns are
+# the average CPU fraction, the CPU fraction over the last interval, total 
+# CPU time, total elapsed time, and the longest stop so far.   This is set by
+# the --cputhrottlereport option.
+CPU_THROTTLE_REPORT_FILE = None
+
+
+# If set, repy writes a line into this file every time a thread has to wait 
+# for a resource (a renewable resource to drain or a free event).   The 
+# columns are the time (from getruntime()), the resource, the API call the 
+# thread was in, the quantity requested and how long it waited.   A summary
+# with a histogram of the waits for each resource is written on exit and on
+# SIGUSR1.   This is set by the --throttletrace option.
+THROTTLE_TRACE_FILE = None
+
+# Small renewable resource charges (like a 1 byte recv) are added up per thread
+# and charged all at once.   A batch is charged when it reaches 
+# NANNY_BATCH_MAX_QUANTITY or NANNY_BATCH_LIMIT_FRACTION of the resource's 
+# limit (whichever is smaller), when it is older than NANNY_BATCH_MAX_DELAY 
+# seconds, or when the thread blocks or finishes its event.
+NANNY_BATCH_SMALL_CHARGES = True
+NANNY_BATCH_MAX_QUANTITY = 4096
+NANNY_BATCH_LIMIT_FRACTION = .05
+NANNY_BATCH_MAX_DELAY = .05
+
+
+# recvmess sockets have a receive buffer of MESS_RCVBUF_DEFAULT bytes (a 
+# little more than the largest UDP message, see ticket #887) unless the 
+# restrictions set messrcvbuf.   If the restrictions set messqueue, the 
+# messages for each recvmess handle are read into a queue of up to that many
+# messages and delivered one at a time, in the order they arrived.
+MESS_RCVBUF_DEFAULT = 66000
+
+# waitforconn sockets have a listen backlog of CONN_BACKLOG_DEFAULT and 
+# receive / send buffers of CONN_BUFFER_DEFAULT bytes (to prevent excessive 
+# TCP buffering, see #895) unless the restrictions set connbacklog and 
+# connbuffer.   Each time a waitforconn socket is ready, up to a backlog's 
+# worth of connections are accepted.
+CONN_BACKLOG_DEFAULT = 5
+CONN_BUFFER_DEFAULT = 10000
+
+# When --ip or --iface is given, the IPs repy may use are cached.   The cache
+# is rebuilt when it is IP_CACHE_TTL seconds old, and on Linux whenever the 
+# kernel says an interface or IPv4 address changed.
+IP_CACHE_TTL = 5.0
+
+# gethostbyname_ex caches up to HOSTNAME_CACHE_SIZE names for 
+# HOSTNAME_CACHE_TTL seconds, and is only charged for names that aren't 
+# cached.   gethostbyname_ex_batch looks names up with up to 
+# HOSTNAME_LOOKUP_THREADS threads.
+HOSTNAME_CACHE_TTL = 60.0
+HOSTNAME_CACHE_SIZE = 256
+HOSTNAME_LOOKUP_THREADS = 8
+
+# Connections opened with openconn(..., reuse=True) are kept open when they
+# are closed so another openconn can use them.   At most CONNECTION_POOL_SIZE
+# are kept, each for up to CONNECTION_POOL_IDLE_TIME seconds.   Every 
+# CONNECTION_POOL_CHECK_INTERVAL seconds, the ones that expired or that the
+# other side closed are closed.
+CONNECTION_POOL_SIZE = 8
+CONNECTION_POOL_IDLE_TIME = 30.0
+CONNECTION_POOL_CHECK_INTERVAL = 1.0
+
 
 # These IP addresses are used to resolve our external IP address
 # We attempt to connect to these IP addresses, and then check our local IP
@@ -361,6 +361,11 @@ disablerestrictions = False
 
 
 def assertisallowed(call,*args):
+  # Remember the call so throttle waits can be attributed to it.   If this is
+  # called from within another API call, the outer call is kept
+  if nanny.get_api_call() is None:
+    nanny.set_api_call(call)
+
   if disablerestrictions:
     return True
 
@@ -0,0 +1,77 @@
+# This is a microbenchmark for getruntime.   A number of threads call 
+# getruntime as fast as they can for a few seconds, first with the lock and
+# /proc/uptime based implementation and then with the monotonic clock (if it
+# is available).
+#
+# This is run with python (not repy) from a directory containing the repy
+# files, e.g.:   python benchmark_getruntime.py [threads] [seconds]
+
+import sys
+import time
+import threading
+
+import nonportable
+
+
+def call_loop(stopevent, counts, index):
+  calls = 0
+  while not stopevent.isSet():
+    for num in xrange(100):
+      nonportable.getruntime()
+    calls += 100
+
+  counts[index] = calls
+
+
+def run_benchmark(threadcount, seconds):
+  stopevent = threading.Event()
+  counts = [0] * threadcount
+
+  threads = []
+  for index in range(threadcount):
+    threads.append(threading.Thread(target=call_loop, args=(stopevent, counts, index)))
+
+  start = time.time()
+  for thread in threads:
+    thread.start()
+
+  time.sleep(seconds)
+  stopevent.set()
+
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+
+  return sum(counts) / elapsed
+
+
+def main():
+  threadcount = 32
+  seconds = 3.0
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    seconds = float(sys.argv[2])
+
+  monotonic_starttime = nonportable.monotonic_starttime
+
+  # Force the old implementation
+  nonportable.monotonic_starttime = None
+  locked = run_benchmark(threadcount, seconds)
+
+  print "Threads:", threadcount
+  print "Lock and uptime: %.0f calls/sec" % locked
+
+  if monotonic_starttime is None:
+    print "The monotonic clock isn't available"
+    return
+
+  nonportable.monotonic_starttime = monotonic_starttime
+  monotonic = run_benchmark(threadcount, seconds)
+
+  print "Monotonic clock: %.0f calls/sec" % monotonic
+  print "Speedup:         %.2fx" % (monotonic / locked)
+
+
+if __name__ == '__main__':
+  main()
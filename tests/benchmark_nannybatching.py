@@ -0,0 +1,72 @@
+# This is a microbenchmark for the nanny's accounting of small renewable
+# resource charges.   It does 1 byte recvs from a local socket pair and does
+# the same accounting emulated_socket.recv does (a check with quantity 0 and
+# then a charge for the data), first with per thread batching turned off and
+# then with it turned on.
+#
+# This is run with python (not repy) from a directory containing the repy
+# files, e.g.:   python benchmark_nannybatching.py [number of recvs]
+
+import sys
+import time
+import socket
+import threading
+
+import repy_constants
+import nanny
+
+
+def do_recv_loop(recvsocket, count):
+  for num in xrange(count):
+    nanny.tattle_quantity('looprecv', 0)
+    data = recvsocket.recv(1)
+    nanny.tattle_quantity('looprecv', len(data))
+
+  nanny.flush_thread_charges()
+
+
+def sender(sendsocket, count):
+  sendsocket.sendall('x' * count)
+
+
+def run_benchmark(count, batching):
+  repy_constants.NANNY_BATCH_SMALL_CHARGES = batching
+
+  (recvsocket, sendsocket) = socket.socketpair()
+  senderthread = threading.Thread(target=sender, args=(sendsocket, count))
+  senderthread.start()
+
+  start = time.time()
+  do_recv_loop(recvsocket, count)
+  elapsed = time.time() - start
+
+  senderthread.join()
+  recvsocket.close()
+  sendsocket.close()
+
+  return count / elapsed
+
+
+def main():
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  else:
+    count = 100000
+
+  nanny.initialize_consumed_resource_tables()
+
+  # Set the limit high enough that we are never throttled.   We're measuring
+  # the cost of the accounting, not the limit
+  nanny.resource_restriction_table['looprecv'] = 1000000000.0
+
+  unbatched = run_benchmark(count, False)
+  batched = run_benchmark(count, True)
+
+  print "1 byte recvs:", count
+  print "Unbatched: %.0f ops/sec" % unbatched
+  print "Batched:   %.0f ops/sec" % batched
+  print "Speedup:   %.2fx" % (batched / unbatched)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+# This is a benchmark for delivering UDP messages to a recvmess handler.   It
+# runs a repy program that sends itself messages over the loopback interface
+# for a few seconds and prints how many were delivered to the handler per
+# second.   The resource limits are set high enough that the program is not
+# throttled, so this mostly measures the cost of starting an event for each
+# message.
+#
+# This is run with python (not repy) from a directory containing the repy
+# files, e.g.:   python benchmark_recvmess.py [seconds] [events]
+
+import sys
+import os
+import subprocess
+
+
+RESTRICTIONS = """
+resource cpu .99
+resource memory 100000000
+resource diskused 100000000
+resource events %(events)d
+resource filewrite 100000
+resource fileread 100000
+resource filesopened 5
+resource insockets 5
+resource outsockets 5
+resource netsend 100000000
+resource netrecv 100000000
+resource loopsend 100000000
+resource looprecv 100000000
+resource lograte 100000
+resource random 100
+resource messport 12345
+
+call recvmess allow
+call sendmess allow
+call stopcomm allow
+call getlock allow
+call sleep allow
+call getruntime allow
+call exitall allow
+call log.write allow
+call log.writelines allow
+"""
+
+PROGRAM = """
+def got_message(ip, port, message, commhandle):
+  mycontext['lock'].acquire()
+  mycontext['count'] = mycontext['count'] + 1
+  mycontext['lock'].release()
+
+if callfunc == 'initialize':
+  mycontext['lock'] = getlock()
+  mycontext['count'] = 0
+  recvhandle = recvmess('127.0.0.1', 12345, got_message)
+
+  start = getruntime()
+  while getruntime() - start < %(seconds)f:
+    for num in xrange(100):
+      sendmess('127.0.0.1', 12345, 'x')
+    # let the handlers run
+    sleep(.001)
+
+  # wait for the messages in flight
+  sleep(.5)
+  elapsed = getruntime() - start
+  stopcomm(recvhandle)
+  print mycontext['count'] / elapsed
+  exitall()
+"""
+
+
+def main():
+  if len(sys.argv) > 1:
+    seconds = float(sys.argv[1])
+  else:
+    seconds = 5.0
+
+  if len(sys.argv) > 2:
+    events = int(sys.argv[2])
+  else:
+    events = 10
+
+  restrictionsfile = "benchmark_recvmess_restrictions"
+  programfile = "benchmark_recvmess_program.py"
+
+  fileobj = open(restrictionsfile, "w")
+  fileobj.write(RESTRICTIONS % {'events':events})
+  fileobj.close()
+
+  fileobj = open(programfile, "w")
+  fileobj.write(PROGRAM % {'seconds':seconds})
+  fileobj.close()
+
+  try:
+    process = subprocess.Popen([sys.executable, "repy.py", restrictionsfile,
+        programfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, erroutput) = process.communicate()
+  finally:
+    os.remove(restrictionsfile)
+    os.remove(programfile)
+
+  try:
+    rate = float(output.strip())
+  except ValueError:
+    print "The benchmark program failed:"
+    print output + erroutput
+    sys.exit(1)
+
+  print "%d events: %.0f messages delivered per second" % (events, rate)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,96 @@
+# This is a benchmark for sending small UDP messages with sendmess.   It runs
+# a repy program that sends one byte messages over the loopback interface
+# for a few seconds, first from any local port and then from a specific local
+# IP and port, and prints how many messages were sent per second for each.
+# Nothing receives the messages, so this measures the cost of sendmess 
+# itself (checking the restrictions and getting a socket to send from).
+#
+# This is run with python (not repy) from a directory containing the repy
+# files, e.g.:   python benchmark_sendmess.py [seconds]
+
+import sys
+import os
+import subprocess
+
+
+RESTRICTIONS = """
+resource cpu .99
+resource memory 100000000
+resource diskused 100000000
+resource events 10
+resource filewrite 100000
+resource fileread 100000
+resource filesopened 5
+resource insockets 5
+resource outsockets 5
+resource netsend 100000000
+resource netrecv 100000000
+resource loopsend 100000000
+resource looprecv 100000000
+resource lograte 100000
+resource random 100
+resource messport 12345
+
+call sendmess allow
+call getruntime allow
+call exitall allow
+call log.write allow
+call log.writelines allow
+"""
+
+PROGRAM = """
+def send_for(seconds, localip, localport):
+  count = 0
+  start = getruntime()
+  while getruntime() - start < seconds:
+    for num in xrange(100):
+      sendmess('127.0.0.1', 12346, 'x', localip, localport)
+    count = count + 100
+  return count / (getruntime() - start)
+
+if callfunc == 'initialize':
+  print send_for(%(seconds)f, None, None), send_for(%(seconds)f, '127.0.0.1', 12345)
+  exitall()
+"""
+
+
+def main():
+  if len(sys.argv) > 1:
+    seconds = float(sys.argv[1])
+  else:
+    seconds = 5.0
+
+  restrictionsfile = "benchmark_sendmess_restrictions"
+  programfile = "benchmark_sendmess_program.py"
+
+  fileobj = open(restrictionsfile, "w")
+  fileobj.write(RESTRICTIONS)
+  fileobj.close()
+
+  fileobj = open(programfile, "w")
+  fileobj.write(PROGRAM % {'seconds':seconds})
+  fileobj.close()
+
+  try:
+    process = subprocess.Popen([sys.executable, "repy.py", restrictionsfile,
+        programfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, erroutput) = process.communicate()
+  finally:
+    os.remove(restrictionsfile)
+    os.remove(programfile)
+
+  try:
+    (anyportrate, localportrate) = output.split()
+    anyportrate = float(anyportrate)
+    localportrate = float(localportrate)
+  except ValueError:
+    print "The benchmark program failed:"
+    print output + erroutput
+    sys.exit(1)
+
+  print "%.0f messages sent per second from any local port" % anyportrate
+  print "%.0f messages sent per second from 127.0.0.1:12345" % localportrate
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,165 @@
+# This summarizes how well the CPU limit is enforced.   It reads the CPU trace
+# files (cpu_f{polling frequency}_restrictions.cpu{limit}) and prints the CPU
+# fraction that was actually used, how far that is from the limit, and the
+# longest stop.   The trace files have a line per sample with the average CPU
+# fraction, the CPU fraction over the last interval, the total CPU time and
+# the elapsed time.   Reports written by repy.py --cputhrottlereport have the
+# longest stop so far as a fifth column.   For the older traces, which don't
+# have this, the longest gap between samples is shown instead.
+#
+# This is run with python (not repy) from a directory containing the repy
+# files and the tests, e.g.:
+#
+#   python cpu_throttle_report.py
+#       Summarizes all of the cpu_f* traces in the current directory
+#
+#   python cpu_throttle_report.py cpu_f.1_restrictions.cpu.2 ...
+#       Summarizes the given traces
+#
+#   python cpu_throttle_report.py --run seconds
+#       Runs special_testcputhrottle.py for each CPU limit in the trace
+#       matrix with the current resource monitor and shows the results next
+#       to the existing traces
+
+import sys
+import os
+import glob
+import re
+import subprocess
+
+
+# Don't count the first second, repy is still starting up
+WARMUP_TIME = 1.0
+
+
+# Get the CPU limit from a trace file name
+def get_trace_limit(filename):
+  match = re.search(r"restrictions\.cpu(\d*\.?\d+)$", filename)
+  if match is None:
+    return None
+  return float(match.group(1))
+
+
+# Reads a trace file, returns a list of tuples (cpu, elapsed, longeststop)
+# where longeststop is None if it isn't in the trace
+def read_trace(filename):
+  samples = []
+  for line in open(filename):
+    fields = line.split()
+    if len(fields) < 4:
+      continue
+
+    if len(fields) >= 5:
+      longeststop = float(fields[4])
+    else:
+      longeststop = None
+
+    samples.append((float(fields[2]), float(fields[3]), longeststop))
+
+  return samples
+
+
+# Returns a tuple (overall fraction, steady fraction, longest stop or gap,
+# whether the longest value is a stop)
+def summarize_trace(samples):
+  (lastcpu, lastelapsed, longeststop) = samples[-1]
+  overall = lastcpu / lastelapsed
+
+  # Find the first sample after the warm up
+  steady = overall
+  for (cpu, elapsed, stop) in samples:
+    if elapsed >= WARMUP_TIME and lastelapsed > elapsed:
+      steady = (lastcpu - cpu) / (lastelapsed - elapsed)
+      break
+
+  if longeststop is not None:
+    return (overall, steady, longeststop, True)
+
+  longestgap = 0.0
+  for index in range(1, len(samples)):
+    longestgap = max(longestgap, samples[index][1] - samples[index-1][1])
+
+  return (overall, steady, longestgap, False)
+
+
+def print_header():
+  print "%-40s %6s %8s %8s %7s %10s" % ("trace", "limit", "overall", "steady",
+      "error", "longest")
+
+
+def print_summary(filename, limit):
+  samples = read_trace(filename)
+  if not samples:
+    print "%-40s %6.2f (no samples)" % (os.path.basename(filename), limit)
+    return
+
+  (overall, steady, longest, isstop) = summarize_trace(samples)
+  if isstop:
+    longesttext = "%.4fs" % longest
+  else:
+    longesttext = "%.4fs gap" % longest
+
+  print "%-40s %6.2f %8.3f %8.3f %6.1f%% %10s" % (os.path.basename(filename),
+      limit, overall, steady, (steady - limit) / limit * 100, longesttext)
+
+
+# Runs special_testcputhrottle.py with the current code and the given limit
+def run_trace(limit, limittext, seconds):
+  # The restrictions file has port placeholders which need to be filled in
+  restrictionsfile = "cpu_report_restrictions.cpu" + limittext
+  restrictions = open("restrictions.cpu" + limittext).read()
+  restrictions = restrictions.replace("<messport>", "12345")
+  restrictions = restrictions.replace("<connport>", "12346")
+  fileobj = open(restrictionsfile, "w")
+  fileobj.write(restrictions)
+  fileobj.close()
+
+  reportfile = "cpu_report_restrictions.cpu" + limittext + ".trace"
+
+  # The restrictions files for the CPU limits don't allow getruntime, so only
+  # the resource limits are used
+  process = subprocess.Popen([sys.executable, "repy.py", "--norestrictions",
+      "--cputhrottlereport", reportfile, restrictionsfile, 
+      "special_testcputhrottle.py", "-t", str(seconds)], 
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  process.communicate()
+
+  os.remove(restrictionsfile)
+  return reportfile
+
+
+def main():
+  args = sys.argv[1:]
+
+  runseconds = None
+  if args and args[0] == "--run":
+    runseconds = int(args[1])
+    args = args[2:]
+
+  if args:
+    tracefiles = args
+  else:
+    tracefiles = glob.glob("cpu_f*_restrictions.cpu*")
+
+  # Group the traces by limit
+  limits = {}
+  for filename in tracefiles:
+    limit = get_trace_limit(filename)
+    if limit is None:
+      print "Skipping '"+filename+"', can't tell the CPU limit from the name"
+      continue
+    limittext = re.search(r"restrictions\.cpu(.*)$", filename).group(1)
+    limits.setdefault((limit, limittext), []).append(filename)
+
+  print_header()
+  for (limit, limittext) in sorted(limits.keys()):
+    for filename in sorted(limits[(limit, limittext)]):
+      print_summary(filename, limit)
+
+    if runseconds is not None:
+      reportfile = run_trace(limit, limittext, runseconds)
+      print_summary(reportfile, limit)
+
+
+if __name__ == '__main__':
+  main()
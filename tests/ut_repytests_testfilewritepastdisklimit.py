@@ -0,0 +1,17 @@
+#pragma repy
+
+# Writing far past the end of the file needs more disk than the vessel has.
+# The write should fail before anything is written.
+
+if callfunc == "initialize":
+  fobj = open("junk_test.out", "w")
+  fobj.seek(200000000)
+  try:
+    fobj.write("x")
+  except Exception, e:
+    pass
+  else:
+    print "Write past the disk limit was allowed"
+
+  fobj.close()
+  removefile("junk_test.out")
@@ -0,0 +1,29 @@
+#pragma repy
+
+# Looking up a name again shouldn't be charged.   Each lookup is charged 4K of
+# netsend, which is limited to 10K per second, so looking up localhost ten 
+# times would take several seconds without the cache
+
+if callfunc == 'initialize':
+  result = gethostbyname_ex('localhost')
+  if '127.0.0.1' not in result[2]:
+    print "gethostbyname_ex returned",result
+
+  start = getruntime()
+  for count in range(10):
+    if gethostbyname_ex('localhost') != result:
+      print "The cached result is different"
+
+  resultlist = gethostbyname_ex_batch(['localhost', 'localhost', 'nonexistent.invalid'])
+  if resultlist[0] != result or resultlist[1] != result:
+    print "gethostbyname_ex_batch returned",resultlist
+  if type(resultlist[2]) is not str:
+    print "gethostbyname_ex_batch didn't return an error for an unknown name"
+
+  if getruntime() - start > 2:
+    print "The cached lookups were charged"
+
+  # Errors for names the resolver rejects are returned as strings too
+  resultlist = gethostbyname_ex_batch(['localhost', 'a\x00b'])
+  if resultlist[0] != result or type(resultlist[1]) is not str:
+    print "gethostbyname_ex_batch returned",resultlist
@@ -0,0 +1,61 @@
+#pragma repy
+
+# openconn with reuse should hand back a connection that was closed, instead
+# of connecting again, and the closed socket object shouldn't work any more
+
+def foo(ip,port,sockobj, ch,mainch):
+  mycontext['lock'].acquire()
+  mycontext['accepted'] = mycontext['accepted'] + 1
+  mycontext['lock'].release()
+
+  # Echo until the other side really closes
+  while True:
+    try:
+      data = sockobj.recv(100)
+    except Exception:
+      break
+    sockobj.send(data)
+
+if callfunc == 'initialize':
+  mycontext['lock'] = getlock()
+  mycontext['accepted'] = 0
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+
+  sock = openconn('127.0.0.1',<connport>, reuse=True)
+  sock.send("hello")
+  if sock.recvexactly(5) != "hello":
+    print "Didn't get the echo"
+  if not sock.close():
+    print "The first close returned False"
+  if sock.close():
+    print "The second close returned True"
+
+  try:
+    sock.send("hello")
+  except Exception:
+    pass
+  else:
+    print "send on a closed socket that was kept for reuse worked"
+
+  # The default restrictions allow only a few outsockets, so this only works
+  # if the connection is used again
+  for count in range(10):
+    sock = openconn('127.0.0.1',<connport>, reuse=True)
+    sock.send("again")
+    if sock.recvexactly(5) != "again":
+      print "Didn't get the echo from a reused connection"
+    sock.close()
+
+  sleep(.2)
+  if mycontext['accepted'] != 1:
+    print "Expected one connection, got", mycontext['accepted']
+
+  # Without reuse, a new connection is made
+  sock = openconn('127.0.0.1',<connport>)
+  sock.close()
+  sleep(.2)
+  if mycontext['accepted'] != 2:
+    print "Expected two connections, got", mycontext['accepted']
+
+  stopcomm(ch)
+  exitall()
@@ -0,0 +1,37 @@
+#pragma repy restrictions.messqueue
+
+# With a message queue, the messages for a handle are delivered one at a time
+# in the order they arrived
+
+def foo(ip,port,mess, ch):
+  mycontext['lock'].acquire()
+  mycontext['running'] = mycontext['running'] + 1
+  if mycontext['running'] > 1:
+    print "Messages were delivered at the same time"
+  mycontext['lock'].release()
+
+  # Give the other messages time to arrive
+  sleep(.01)
+  mycontext['received'].append(int(mess))
+
+  mycontext['lock'].acquire()
+  mycontext['running'] = mycontext['running'] - 1
+  mycontext['lock'].release()
+
+if callfunc == 'initialize':
+  mycontext['lock'] = getlock()
+  mycontext['running'] = 0
+  mycontext['received'] = []
+  ch = recvmess('127.0.0.1',<messport>,foo)
+  sleep(.1)
+
+  messagelist = []
+  for num in range(50):
+    messagelist.append(('127.0.0.1',<messport>,str(num)))
+  sendmess_batch(messagelist)
+
+  sleep(2)
+  if mycontext['received'] != range(50):
+    print "Received",mycontext['received']
+
+  stopcomm(ch)
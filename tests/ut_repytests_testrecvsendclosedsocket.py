@@ -0,0 +1,49 @@
+#pragma repy
+
+# A recv or send that is waiting when another thread closes the socket should
+# raise the usual "Socket closed" exception
+
+def foo(ip,port,sockobj, ch,mainch):
+  mycontext['serversockets'].append(sockobj)
+
+def blockedrecv(sock):
+  try:
+    sock.recv(100)
+  except Exception, e:
+    mycontext['errors'].append(str(e))
+  else:
+    mycontext['errors'].append("recv returned")
+
+def blockedsend(sock):
+  try:
+    while True:
+      sock.send("x" * 10000)
+  except Exception, e:
+    mycontext['errors'].append(str(e))
+
+if callfunc == 'initialize':
+  mycontext['serversockets'] = []
+  mycontext['errors'] = []
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+
+  for count in range(5):
+    sock = openconn('127.0.0.1',<connport>)
+    settimer(0, blockedrecv, (sock,))
+    sleep(.1)
+    sock.close()
+
+    sock = openconn('127.0.0.1',<connport>)
+    settimer(0, blockedsend, (sock,))
+    sleep(.3)
+    sock.close()
+
+  sleep(.5)
+  for error in mycontext['errors']:
+    if error != "Socket closed":
+      print "A recv or send on a closed socket raised", error
+  if len(mycontext['errors']) != 10:
+    print "Only", len(mycontext['errors']), "of the recvs and sends returned"
+
+  for sock in mycontext['serversockets']:
+    sock.close()
+  stopcomm(ch)
@@ -0,0 +1,53 @@
+#pragma repy
+
+# Checks recvuntil and recvexactly, and that recv returns the data they leave
+# in the buffer
+
+def sendall(sock, data):
+  while data:
+    data = data[sock.send(data):]
+
+def foo(ip,port,sockobj, ch,mainch):
+  sendall(sockobj, "hello*world*" + "x" * 10 + "12345")
+  sleep(.5)
+  sockobj.close()
+
+if callfunc == 'initialize':
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+  sock = openconn('127.0.0.1',<connport>)
+
+  data = sock.recvuntil("*", 100)
+  if data != "hello*":
+    print "recvuntil returned '"+data+"'"
+
+  data = sock.recv(1)
+  if data != "w":
+    print "recv returned '"+data+"'"
+
+  # The delimiter isn't in the first 3 bytes
+  data = sock.recvuntil("*", 3)
+  if data != "orl":
+    print "recvuntil with a small maxbytes returned '"+data+"'"
+
+  data = sock.recvuntil("*", 100)
+  if data != "d*":
+    print "recvuntil returned '"+data+"'"
+
+  data = sock.recvexactly(10)
+  if data != "x" * 10:
+    print "recvexactly returned '"+data+"'"
+
+  # The socket is closed before the delimiter arrives, the data should still
+  # be there for recv
+  try:
+    sock.recvuntil("*", 100)
+  except Exception:
+    pass
+  else:
+    print "recvuntil didn't raise an exception when the socket was closed"
+
+  data = sock.recv(100)
+  if data != "12345":
+    print "recv after the close returned '"+data+"'"
+
+  stopcomm(ch)
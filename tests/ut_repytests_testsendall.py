@@ -0,0 +1,32 @@
+#pragma repy
+
+# Checks sendall and send with an offset
+
+def foo(ip,port,sockobj, ch,mainch):
+  message = "abcdefghij" * 20000
+  sockobj.sendall(message)
+
+  sent = 0
+  while sent < len(message):
+    sent = sent + sockobj.send(message, sent)
+
+  try:
+    sockobj.send(message, len(message) + 1)
+  except ValueError:
+    pass
+  else:
+    print "send with an offset past the end didn't raise ValueError"
+
+  mycontext['serversocket'] = sockobj
+
+if callfunc == 'initialize':
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+  sock = openconn('127.0.0.1',<connport>)
+
+  for count in range(2):
+    data = sock.recvexactly(200000)
+    if data != "abcdefghij" * 20000:
+      print "Received the wrong data"
+
+  stopcomm(ch)
+  sock.close()
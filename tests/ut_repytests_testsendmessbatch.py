@@ -0,0 +1,35 @@
+#pragma repy
+
+# Checks that sendmess_batch delivers every message and returns the number of
+# bytes sent for each, or an error for a message that is too big
+
+def foo(ip,port,mess, ch):
+  mycontext['lock'].acquire()
+  mycontext['received'].append(mess)
+  mycontext['lock'].release()
+
+if callfunc == 'initialize':
+  mycontext['lock'] = getlock()
+  mycontext['received'] = []
+  ch = recvmess('127.0.0.1',<messport>,foo)
+  sleep(.1)
+
+  results = sendmess_batch([('127.0.0.1',<messport>,'one'),
+      ('127.0.0.1',<messport>,'x' * 70000), ('127.0.0.1',<messport>,'three')])
+
+  if results[0] != 3 or results[2] != 5:
+    print "sendmess_batch returned",results
+  if type(results[1]) is not str:
+    print "sendmess_batch didn't return an error for a message that is too big"
+
+  # Send from the port we're listening on
+  results = sendmess_batch([('127.0.0.1',<messport>,'four')], '127.0.0.1', <messport>)
+  if results != [4]:
+    print "sendmess_batch from the listening port returned",results
+
+  sleep(.5)
+  mycontext['received'].sort()
+  if mycontext['received'] != ['four', 'one', 'three']:
+    print "Received",mycontext['received']
+
+  stopcomm(ch)
@@ -0,0 +1,49 @@
+#pragma repy
+
+# sendmess_batch from the local ip / port of a cached sendmess socket must not
+# have the socket closed to make room for openconn while it waits to send
+
+def gotconn(ip,port,sockobj, ch,mainch):
+  pass
+
+def bigbatchsend():
+  sendmess_batch([('127.0.0.1',<connport>,'x' * 60000)] * 60)
+
+def batchsend():
+  resultlist = sendmess_batch([('127.0.0.1',<connport>,'hello')] * 3, '127.0.0.1', <messport>)
+  for result in resultlist:
+    if type(result) is not int:
+      print "sendmess_batch while the socket was needed for openconn failed:", result
+  mycontext['done'] = True
+
+if callfunc == 'initialize':
+  mycontext['done'] = False
+
+  # This leaves a socket bound to the port in the cache
+  sendmess('127.0.0.1',<connport>,'hi','127.0.0.1',<messport>)
+
+  listench = waitforconn('127.0.0.1',<connport>,gotconn)
+
+  # Use up the loopsend allowance, so the other batch has to wait.   A batch
+  # is charged all at once after it is sent
+  settimer(0, bigbatchsend, ())
+  sleep(.1)
+  settimer(0, batchsend, ())
+  sleep(.3)
+
+  # The cached socket is the only thing that can be given up for the fifth
+  # connection, but it is in use
+  socklist = []
+  for count in range(5):
+    try:
+      socklist.append(openconn('127.0.0.1',<connport>))
+    except Exception:
+      # There's no outsocket for it
+      pass
+
+  while not mycontext['done']:
+    sleep(.1)
+
+  for sock in socklist:
+    sock.close()
+  stopcomm(listench)
@@ -0,0 +1,38 @@
+#pragma repy
+
+# sendmess keeps its sockets open.   recvmess on the same port and openconn
+# when all of the outsockets are used should still work
+
+def gotmess(ip,port,mess, ch):
+  mycontext['received'] = mess
+
+def gotconn(ip,port,sockobj, ch,mainch):
+  pass
+
+if callfunc == 'initialize':
+  mycontext['received'] = None
+
+  # These leave two sockets open
+  sendmess('127.0.0.1',<connport>,'hi')
+  sendmess('127.0.0.1',<connport>,'hi','127.0.0.1',<messport>)
+
+  # The socket sendmess used is bound to this port
+  ch = recvmess('127.0.0.1',<messport>,gotmess)
+  sendmess('127.0.0.1',<messport>,'hello')
+  sleep(.5)
+  if mycontext['received'] != 'hello':
+    print "recvmess got",mycontext['received']
+  stopcomm(ch)
+
+  # recvmess closed the socket sendmess had bound to the port
+  sendmess('127.0.0.1',<connport>,'hi','127.0.0.1',<messport>)
+
+  # Two cached sockets and four connections are more than the 5 outsockets
+  listench = waitforconn('127.0.0.1',<connport>,gotconn)
+  socklist = []
+  for count in range(4):
+    socklist.append(openconn('127.0.0.1',<connport>))
+
+  for sock in socklist:
+    sock.close()
+  stopcomm(listench)
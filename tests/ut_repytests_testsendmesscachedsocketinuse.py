@@ -0,0 +1,44 @@
+#pragma repy
+
+# A cached sendmess socket must not be closed to make room for openconn while
+# another sendmess is waiting to send from it
+
+def gotconn(ip,port,sockobj, ch,mainch):
+  pass
+
+def bigsend():
+  # Uses up the netsend allowance, so the next send has to wait
+  sendmess('192.0.2.2',<messport>,'x' * 30000)
+
+def smallsend():
+  try:
+    sendmess('192.0.2.2',<messport>,'x' * 100)
+  except Exception, e:
+    print "sendmess while the socket was needed for openconn failed:", e
+  mycontext['done'] = True
+
+if callfunc == 'initialize':
+  mycontext['done'] = False
+  listench = waitforconn('127.0.0.1',<connport>,gotconn)
+
+  settimer(0, bigsend, ())
+  sleep(.3)
+  settimer(0, smallsend, ())
+  sleep(.3)
+
+  # The cached socket is the only thing that can be given up for the fifth
+  # connection, but it is in use
+  socklist = []
+  for count in range(5):
+    try:
+      socklist.append(openconn('127.0.0.1',<connport>))
+    except Exception:
+      # There's no outsocket for it
+      pass
+
+  while not mycontext['done']:
+    sleep(.1)
+
+  for sock in socklist:
+    sock.close()
+  stopcomm(listench)
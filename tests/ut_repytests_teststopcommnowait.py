@@ -0,0 +1,51 @@
+#pragma repy
+
+# stopcomm with wait=False should return right away and the listener should
+# be gone shortly after
+
+def foo(ip,port,sockobj, ch,mainch):
+  print "Connected to a stopped listener"
+
+def busy():
+  sleep(1)
+
+if callfunc == 'initialize':
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+  sleep(.1)
+  if not stopcomm(ch, False):
+    print "stopcomm returned False"
+  sleep(.1)
+
+  try:
+    openconn('127.0.0.1',<connport>, timeout=1)
+  except Exception:
+    pass
+  else:
+    print "openconn succeeded after stopcomm"
+
+  # The handle is already gone
+  if stopcomm(ch):
+    print "stopcomm of a stopped handle returned True"
+
+  # Use up the events, so the SocketSelector waits for an event for the 
+  # connection and can't clean up the handle yet
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+  while True:
+    try:
+      settimer(0, busy, ())
+    except Exception:
+      break
+  sleep(.1)
+  sock = openconn('127.0.0.1',<connport>)
+  sleep(.1)
+
+  if not stopcomm(ch, False):
+    print "stopcomm returned False"
+
+  # It is stopped, even though it isn't closed yet
+  if stopcomm(ch, False):
+    print "A second stopcomm returned True"
+
+  # No event should start for the connection once the events are free
+  sleep(1.5)
+  sock.close()
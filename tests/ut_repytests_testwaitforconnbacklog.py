@@ -0,0 +1,37 @@
+#pragma repy restrictions.connbacklog
+
+# With a larger backlog, a burst of connections should all connect right away
+# even while every event is busy.   With the default backlog of 5, the 
+# connections that don't fit would have to retry and openconn would time out.
+
+def foo(ip,port,sockobj, ch,mainch):
+  mycontext['lock'].acquire()
+  mycontext['accepted'] = mycontext['accepted'] + 1
+  mycontext['lock'].release()
+
+  # Hold the event so the rest of the connections wait in the accept queue
+  sleep(1)
+  sockobj.close()
+
+if callfunc == 'initialize':
+  mycontext['lock'] = getlock()
+  mycontext['accepted'] = 0
+  ch = waitforconn('127.0.0.1',<connport>,foo)
+
+  socklist = []
+  for count in range(30):
+    try:
+      socklist.append(openconn('127.0.0.1',<connport>, timeout=.5))
+    except Exception, e:
+      print "Connection", count, "failed:", e
+      break
+
+  # Wait for the handlers
+  sleep(5)
+  if mycontext['accepted'] != len(socklist):
+    print "Expected", len(socklist), "connections, got", mycontext['accepted']
+
+  for sock in socklist:
+    sock.close()
+  stopcomm(ch)
+  exitall()